@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_user_storage_quota_gb'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='download_rate_kb',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='max_download_streams',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -10,5 +10,9 @@ class User(AbstractUser):
     
     storage_quota_gb = models.IntegerField(default=10)
 
+    # Download shaping overrides, empty = the tier default (settings.DOWNLOAD_LIMITS), 0 = unlimited
+    download_rate_kb = models.PositiveIntegerField(null=True, blank=True) # KB/s
+    max_download_streams = models.PositiveIntegerField(null=True, blank=True)
+
     def __str__(self):
         return self.username
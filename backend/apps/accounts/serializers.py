@@ -1,6 +1,5 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
-from django.db.models import Sum
 
 User = get_user_model()
 
@@ -24,8 +23,6 @@ class UserSerializer(serializers.ModelSerializer):
         return obj.first_name or obj.username
 
     def get_storage_used(self, obj):
-        # Sum size of all files belonging to user
-        # Note: 'files' is the related_name in File model
-        # using aggregate to sum the 'size' field
-        total_bytes = obj.files.aggregate(total=Sum('size'))['total'] or 0
-        return total_bytes
+        # Read from the per-user storage ledger (files + versions) instead of summing every file
+        from apps.files.quota import get_usage
+        return get_usage(obj).used_bytes
@@ -0,0 +1,117 @@
+import asyncio
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.http import Http404, JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import ValidationError
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from .models import File, ChunkedUpload
+from .views import file_download_response, upload_status_data
+from . import bandwidth, chunked
+
+# Async (ASGI) versions of the long-lived file views: downloads, chunk uploads
+# and the upload-status long poll. Under uvicorn a slow client no longer pins a
+# thread: lookups use the async ORM, file reads/writes run on worker threads one
+# block at a time, and waiting happens on the event loop. They share their
+# logic with the DRF views in views.py and also run under WSGI.
+# Enabled with FILES_ASYNC_VIEWS = True, see urls.py.
+
+_jwt = JWTAuthentication()
+
+
+async def authenticate(request):
+    """The request's user from its JWT (same rules as DRF's JWTAuthentication), or None."""
+    header = _jwt.get_header(request)
+    raw_token = _jwt.get_raw_token(header) if header else None
+    if raw_token is None:
+        return None
+    try:
+        token = await sync_to_async(_jwt.get_validated_token)(raw_token)
+    except (InvalidToken, TokenError):
+        return None
+    user = await get_user_model().objects.filter(
+        **{jwt_settings.USER_ID_FIELD: token.get(jwt_settings.USER_ID_CLAIM)}, is_active=True
+    ).afirst()
+    if user is not None:
+        request.user = user # for the audit middleware, like DRF does
+    return user
+
+
+def _unauthorized():
+    return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+
+
+def _not_found(detail='Not found.'):
+    # DRF's body for Http404, not Django's HTML page
+    return JsonResponse({'detail': detail}, status=404)
+
+
+def _too_many_streams():
+    return JsonResponse({'detail': 'Too many downloads in progress, wait for one to finish.'}, status=429)
+
+
+class AsyncFileDownloadView(View):
+    async def get(self, request, pk):
+        user = await authenticate(request)
+        if user is None:
+            return _unauthorized()
+        file_instance = await File.objects.filter(pk=pk, user=user).afirst()
+        if file_instance is None:
+            return _not_found()
+        try:
+            # Builds the response (headers, file handle); the body is an async iterator
+            return await sync_to_async(file_download_response)(request, file_instance, use_async=True)
+        except Http404 as e:
+            return _not_found(str(e))
+        except bandwidth.TooManyStreams:
+            return _too_many_streams()
+
+
+@method_decorator(csrf_exempt, name='dispatch') # JWT in a header, no cookies involved
+class AsyncChunkedUploadChunkView(View):
+    async def post(self, request, upload_id):
+        user = await authenticate(request)
+        if user is None:
+            return _unauthorized()
+        upload = await ChunkedUpload.objects.filter(upload_id=upload_id, user=user).afirst()
+        if upload is None:
+            return _not_found()
+
+        # Parsing reads the spooled request body, keep it off the event loop
+        files, data = await sync_to_async(lambda: (request.FILES, request.POST))()
+        chunk = files.get('file')
+        try:
+            chunk_index = chunked.validate_chunk(upload, chunk, data.get('chunk_index'))
+            block_digests = await asyncio.to_thread(chunked.hash_chunk, chunk)
+            await sync_to_async(chunked.store_chunk)(upload_id, chunk_index, chunk, block_digests)
+        except ValidationError as e:
+            return JsonResponse(e.detail, status=400, safe=False)
+
+        return JsonResponse({
+            'status': 'received',
+            'chunk_index': chunk_index,
+            'block_sha256': [block_digests[i:i + 32].hex() for i in range(0, len(block_digests), 32)],
+        })
+
+
+class AsyncChunkedUploadStatusView(View):
+    async def get(self, request, upload_id):
+        user = await authenticate(request)
+        if user is None:
+            return _unauthorized()
+        upload = await ChunkedUpload.objects.filter(upload_id=upload_id, user=user).afirst()
+        if upload is None:
+            return _not_found()
+
+        try:
+            wait = min(float(request.GET.get('wait', 0)), chunked.MAX_LONG_POLL_SECONDS)
+        except ValueError:
+            wait = 0
+        if wait > 0:
+            upload = await chunked.await_while_processing(upload, wait)
+
+        return JsonResponse(await sync_to_async(upload_status_data)(upload))
@@ -0,0 +1,193 @@
+import asyncio
+import time
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import DownloadBudget
+
+# Per-user download shaping: a token bucket for bytes/sec and a cap on
+# concurrent streams. State lives in one DownloadBudget row per user, so every
+# worker process sees the same budget. Like the storage ledger (quota.py) it is
+# only changed by conditional UPDATEs or under a row lock: exact on any
+# database, unlike cache incr/decr, which is a plain get+set on DatabaseCache.
+#
+# The bucket is charged *after* each piece is sent and the stream sleeps off
+# any debt before the next one, so the first bytes always go out immediately
+# and only the sustained rate is shaped.
+
+DEFAULT_LIMITS = {
+    'default': {'rate': 25 * 1024 * 1024, 'burst': 8 * 1024 * 1024, 'streams': 4},
+    'staff': {'rate': 0, 'burst': 0, 'streams': 0},
+}
+
+# Bytes charged per bucket update at least; faster streams charge rate / GRANTS_PER_SECOND at a time,
+# so each one costs a few queries a second whatever its rate
+GRANT_SIZE = 256 * 1024
+GRANTS_PER_SECOND = 4
+
+# A stream slot count nothing has touched for this long is stale (killed workers never release)
+STREAM_LEASE_SECONDS = 6 * 3600
+
+
+class TooManyStreams(Exception):
+    pass
+
+
+def get_limits(user=None):
+    """
+    {'rate', 'burst', 'streams'} for a user: their own overrides, else their tier's.
+    0 means unlimited. Pass None for the default tier (e.g. signed URLs, which have no User loaded).
+    """
+    tiers = getattr(settings, 'DOWNLOAD_LIMITS', DEFAULT_LIMITS)
+    tier = 'staff' if user is not None and user.is_staff and 'staff' in tiers else 'default'
+    limits = dict(tiers[tier])
+    if user is not None:
+        if getattr(user, 'download_rate_kb', None) is not None:
+            limits['rate'] = user.download_rate_kb * 1024
+            limits['burst'] = max(limits.get('burst') or 0, limits['rate'])
+        if getattr(user, 'max_download_streams', None) is not None:
+            limits['streams'] = user.max_download_streams
+    return limits
+
+
+def grant_size(rate):
+    return max(GRANT_SIZE, int(rate / GRANTS_PER_SECOND))
+
+
+# --- Concurrent streams ---
+
+def acquire_stream(user_id, max_streams):
+    """Take one of the user's stream slots. False when streams are unlimited (nothing to release)."""
+    if not max_streams:
+        return False
+    now = timezone.now()
+
+    def take_slot():
+        # Single conditional UPDATE: two requests can't both take the last slot
+        return DownloadBudget.objects.filter(user_id=user_id, streams__lt=max_streams).update(
+            streams=F('streams') + 1, streams_changed_at=now
+        ) == 1
+
+    if take_slot():
+        return True
+    # No row yet, or all slots taken: maybe by workers that died, whose slots nothing has moved for a lease
+    DownloadBudget.objects.get_or_create(user_id=user_id)
+    DownloadBudget.objects.filter(
+        user_id=user_id, streams__gt=0, streams_changed_at__lt=now - timedelta(seconds=STREAM_LEASE_SECONDS)
+    ).update(streams=0)
+    if not take_slot():
+        raise TooManyStreams()
+    return True
+
+
+def release_stream(user_id):
+    DownloadBudget.objects.filter(user_id=user_id, streams__gt=0).update(
+        streams=F('streams') - 1, streams_changed_at=timezone.now()
+    )
+
+
+def active_streams(user_id):
+    return DownloadBudget.objects.filter(user_id=user_id).values_list('streams', flat=True).first() or 0
+
+
+# --- Token bucket ---
+
+def take(user_id, nbytes, rate, burst, now=None):
+    """
+    Charge nbytes to the user's bucket. Returns how long to sleep before sending more.
+    The bucket may go into debt, which is what spaces the next pieces out.
+    """
+    if not rate:
+        return 0.0
+    now = now if now is not None else time.time()
+    with transaction.atomic():
+        budget = DownloadBudget.objects.select_for_update().filter(user_id=user_id).first()
+        if budget is None:
+            budget, _ = DownloadBudget.objects.get_or_create(user_id=user_id)
+        # refilled_at 0 (new row) refills to a full bucket
+        tokens = min(burst or rate, budget.tokens + (now - budget.refilled_at) * rate) - nbytes
+        budget.tokens, budget.refilled_at = tokens, now
+        budget.save(update_fields=['tokens', 'refilled_at'])
+    return max(0.0, -tokens / rate)
+
+
+class ThrottledStream:
+    """Wraps a response's byte iterator, pacing it and holding a stream slot until closed."""
+
+    def __init__(self, iterable, user_id, limits, holds_slot=False):
+        self._iterable = iterable
+        self._user_id = user_id
+        self._rate = limits.get('rate') or 0
+        self._burst = limits.get('burst') or 0
+        self._holds_slot = holds_slot
+        self._grant = grant_size(self._rate)
+
+    def __iter__(self):
+        pending = 0
+        for chunk in self._iterable:
+            yield chunk
+            pending += len(chunk)
+            if pending >= self._grant:
+                wait = take(self._user_id, pending, self._rate, self._burst)
+                pending = 0
+                if wait:
+                    time.sleep(wait)
+        if pending:
+            take(self._user_id, pending, self._rate, self._burst)
+
+    def close(self):
+        if self._holds_slot:
+            self._holds_slot = False
+            release_stream(self._user_id)
+        close = getattr(self._iterable, 'close', None)
+        if close:
+            close()
+
+
+class AsyncThrottledStream(ThrottledStream):
+    """ThrottledStream for async responses (ASGI views): waits with asyncio.sleep, no thread held."""
+
+    async def __aiter__(self):
+        pending = 0
+        async for chunk in self._iterable:
+            yield chunk
+            pending += len(chunk)
+            if pending >= self._grant:
+                wait = await sync_to_async(take)(self._user_id, pending, self._rate, self._burst)
+                pending = 0
+                if wait:
+                    await asyncio.sleep(wait)
+        if pending:
+            await sync_to_async(take)(self._user_id, pending, self._rate, self._burst)
+
+    # Not iterable synchronously, so StreamingHttpResponse treats it as async
+    __iter__ = None
+
+
+def limit(response, user_id, limits):
+    """
+    Apply a user's limits to a download response.
+    Streams are paced in Python. Offloaded responses hand the rate to nginx
+    (X-Accel-Limit-Rate), which does its own pacing. Raises TooManyStreams.
+    Offloaded responses take no stream slot: their end is never seen here, so
+    concurrency is nginx's limit_conn; X-Sendfile responses are not limited at all.
+    """
+    if 'X-Accel-Redirect' in response:
+        if limits.get('rate'):
+            response['X-Accel-Limit-Rate'] = str(limits['rate'])
+        return response
+    if not getattr(response, 'streaming', False):
+        return response
+
+    try:
+        holds_slot = acquire_stream(user_id, limits.get('streams'))
+    except TooManyStreams:
+        response.close()
+        raise
+    # Setting streaming_content registers stream.close with the response, next to the file's own closer
+    stream_class = AsyncThrottledStream if response.is_async else ThrottledStream
+    response.streaming_content = stream_class(response.streaming_content, user_id, limits, holds_slot)
+    return response
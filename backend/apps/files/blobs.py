@@ -0,0 +1,120 @@
+import os
+from django.core.files import File as DjangoFile
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+from .models import Blob, blob_directory_path
+
+# Content-addressed blob store.
+# A Blob row is the single physical copy of some content, keyed by its digest.
+# Files and FileVersions point at it and hold one reference each, so storing
+# the same bytes again (another family member's copy of a photo, re-uploading
+# an unchanged document, archiving a version) only bumps ref_count.
+
+
+def _blob_name(digest):
+    return blob_directory_path(Blob(sha256=digest), None)
+
+
+def place_local_file(src, name):
+    """Rename src into storage at exactly `name` (streams it for remote storages)."""
+    try:
+        dest = default_storage.path(name)
+    except NotImplementedError:
+        if default_storage.exists(name):
+            default_storage.delete(name)
+        with open(src, 'rb') as f:
+            default_storage.save(name, DjangoFile(f))
+        os.remove(src)
+        return
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    # Same volume as MEDIA_ROOT, so this is metadata only. Overwrites a leftover from a crashed ingest.
+    os.replace(src, dest)
+
+
+def _acquire(digest, size, store):
+    """
+    Add a reference to the blob for digest, creating it with store(name) if it's new.
+    Returns (blob, created).
+    """
+    with transaction.atomic():
+        blob, created = Blob.objects.select_for_update().get_or_create(
+            sha256=digest,
+            defaults={'size': size, 'ref_count': 0}
+        )
+        if created:
+            name = _blob_name(digest)
+            store(name)
+            blob.file.name = name
+        blob.ref_count = F('ref_count') + 1
+        blob.save()
+        blob.refresh_from_db()
+    return blob, created
+
+
+def ingest_path(src, digest, size):
+    """
+    Take ownership of a finished local file (e.g. a chunked upload target).
+    New content is renamed into the blob store, duplicate content is just unlinked.
+    digest must have been computed from exactly the bytes at src: later uploads of
+    that digest, by any user, are served whatever was stored here.
+    """
+    blob, created = _acquire(digest, size, lambda name: place_local_file(src, name))
+    if not created and os.path.exists(src):
+        os.remove(src)
+    return blob
+
+
+def ingest_upload(uploaded_file, digest):
+    """Store an UploadedFile under its digest, only writing it if the content is new."""
+    def store(name):
+        if default_storage.exists(name):
+            default_storage.delete(name)
+        uploaded_file.seek(0)
+        default_storage.save(name, uploaded_file)
+
+    blob, _ = _acquire(digest, uploaded_file.size, store)
+    return blob
+
+
+def ingest_bytes(data, digest):
+    """Store a small in-memory piece (e.g. a delta chunk) under its digest."""
+    def store(name):
+        if default_storage.exists(name):
+            default_storage.delete(name)
+        default_storage.save(name, ContentFile(data))
+
+    blob, _ = _acquire(digest, len(data), store)
+    return blob
+
+
+def acquire_existing(digest):
+    """Add a reference to an already stored blob. None if there's no blob for digest."""
+    with transaction.atomic():
+        blob = Blob.objects.select_for_update().filter(pk=digest).first()
+        if blob is None:
+            return None
+        Blob.objects.filter(pk=digest).update(ref_count=F('ref_count') + 1)
+    return blob
+
+
+def add_ref(blob_id):
+    Blob.objects.filter(pk=blob_id).update(ref_count=F('ref_count') + 1)
+
+
+def release(blob_id):
+    """Drop one reference, deleting the row and the physical file with the last one."""
+    with transaction.atomic():
+        blob = Blob.objects.select_for_update().filter(pk=blob_id).first()
+        if blob is None:
+            return
+        if blob.ref_count > 1:
+            Blob.objects.filter(pk=blob_id).update(ref_count=F('ref_count') - 1)
+            return
+        # Delete under the row lock, so a concurrent ingest of the same content waits and rewrites it
+        for sidecar in blob.encodings.all():
+            sidecar.file.delete(save=False)
+        if blob.file:
+            blob.file.delete(save=False)
+        blob.delete()
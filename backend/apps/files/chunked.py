@@ -0,0 +1,338 @@
+import asyncio
+import os
+import shutil
+import time
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from .hashing import BlockHasher, get_block_size, tree_digest
+from . import quota, blobs, versions
+from .models import File, ChunkedUpload, ChunkedUploadPart
+
+# Default chunk size handed to clients that don't pick their own (5 MB)
+DEFAULT_CHUNK_SIZE = 5 * 1024 * 1024
+
+# Upper bound for ?wait= on the status endpoint, keeps a request from hanging forever
+MAX_LONG_POLL_SECONDS = 30
+
+# Same for the sync (WSGI) view, where waiting holds a whole worker: a few polling clients could take them all.
+# The async view (FILES_ASYNC_VIEWS) waits on the event loop and gets the full MAX_LONG_POLL_SECONDS.
+MAX_SYNC_LONG_POLL_SECONDS = 2
+
+# O_BINARY only exists on Windows, it's a no-op flag everywhere else
+_O_BINARY = getattr(os, 'O_BINARY', 0)
+
+
+def get_chunk_size():
+    return getattr(settings, 'CHUNK_UPLOAD_SIZE', DEFAULT_CHUNK_SIZE)
+
+
+def session_dir(upload_id):
+    # Scratch space lives under MEDIA_ROOT so the final move is a same-volume rename
+    return os.path.join(settings.MEDIA_ROOT, 'chunk_uploads', str(upload_id))
+
+
+def target_path(upload_id):
+    return os.path.join(session_dir(upload_id), 'data')
+
+
+def preallocate(upload):
+    """
+    Create the sparse target file for an upload session.
+    ftruncate sets the final length without writing any blocks, chunks are then
+    written straight to their offset in this single file.
+    """
+    os.makedirs(session_dir(upload.upload_id), exist_ok=True)
+    fd = os.open(target_path(upload.upload_id), os.O_WRONLY | os.O_CREAT | _O_BINARY, 0o600)
+    try:
+        os.ftruncate(fd, upload.file_size)
+    finally:
+        os.close(fd)
+
+
+def _pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    if hasattr(os, 'pwrite'):
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        # Windows has no pwrite. Each request opens its own fd so seek+write is still safe.
+        os.lseek(fd, offset, os.SEEK_SET)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+
+
+def hash_chunk(chunk):
+    """Concatenated block digests of an uploaded chunk, worked out before it goes anywhere near the target."""
+    hasher = BlockHasher()
+    for piece in chunk.chunks():
+        hasher.update(piece)
+    return hasher.finish()
+
+
+def write_chunk(upload_id, offset, chunk):
+    """Stream an uploaded chunk into the target file at its byte offset. Returns the bytes written."""
+    try:
+        fd = os.open(target_path(upload_id), os.O_WRONLY | _O_BINARY)
+    except FileNotFoundError:
+        raise ValidationError("Upload session not found or expired")
+    written = 0
+    try:
+        for piece in chunk.chunks():
+            _pwrite_all(fd, piece, offset + written)
+            written += len(piece)
+    finally:
+        os.close(fd)
+    return written
+
+
+# --- Received-chunk manifest ---
+
+def expected_chunk_length(upload, chunk_index):
+    # Every chunk is exactly chunk_size except the tail
+    offset = chunk_index * upload.chunk_size
+    return max(0, min(upload.chunk_size, upload.file_size - offset))
+
+
+def validate_chunk(upload, chunk, chunk_index):
+    """Checks an incoming chunk against the session, returns the chunk index as an int."""
+    if not chunk or chunk_index is None:
+         raise ValidationError("file and chunk_index are required")
+
+    if upload.status != 'INIT':
+        raise ValidationError("Upload session is no longer accepting chunks")
+
+    try:
+        chunk_index = int(chunk_index)
+    except (TypeError, ValueError):
+        raise ValidationError("chunk_index must be an integer")
+
+    if chunk_index < 0 or chunk_index >= upload.total_chunks:
+        raise ValidationError("Chunk lies outside the declared file size")
+
+    # Chunks must be exactly chunk_size (except the last) so the manifest means "these bytes are on disk"
+    if chunk.size != expected_chunk_length(upload, chunk_index):
+        raise ValidationError(f"Chunk {chunk_index} must be {expected_chunk_length(upload, chunk_index)} bytes")
+
+    if not os.path.exists(target_path(upload.upload_id)):
+        raise ValidationError("Upload session not found or expired")
+    return chunk_index
+
+
+def received_indexes(upload):
+    bitmap = bytes(upload.received_chunks or b'')
+    return [
+        i for i in range(upload.total_chunks)
+        if i // 8 < len(bitmap) and bitmap[i // 8] & (1 << (i % 8))
+    ]
+
+
+def missing_indexes(upload):
+    received = set(received_indexes(upload))
+    return [i for i in range(upload.total_chunks) if i not in received]
+
+
+def as_ranges(indexes):
+    """Collapse sorted chunk indexes into inclusive [start, end] ranges."""
+    ranges = []
+    for i in indexes:
+        if ranges and ranges[-1][1] == i - 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return ranges
+
+
+def store_chunk(upload_id, chunk_index, chunk, block_digests):
+    """
+    Write the chunk at its offset, record its digests and set its bit in the manifest.
+    The upload row stays locked across all three, so two requests for the same index
+    can't leave one's bytes on disk and the other's digests in the manifest.
+    A chunk that already landed is never rewritten: its leaves are what the
+    whole-file digest is built from. Sending the same bytes again is a no-op.
+    """
+    with transaction.atomic():
+        # Lock and state check in one statement, before the target is opened: begin_processing
+        # and the reaper queue behind chunks that are writing, later chunks find the session moved on
+        if not ChunkedUpload.objects.filter(upload_id=upload_id, status='INIT').update(last_activity_at=timezone.now()):
+            raise ValidationError("Upload session is no longer accepting chunks")
+        upload = ChunkedUpload.objects.get(upload_id=upload_id)
+        part = upload.parts.filter(chunk_index=chunk_index).first()
+        if part is not None:
+            if bytes(part.block_digests) != block_digests:
+                raise ValidationError(f"Chunk {chunk_index} was already received with different content")
+        else:
+            written = write_chunk(upload_id, chunk_index * upload.chunk_size, chunk)
+            ChunkedUploadPart.objects.create(upload=upload, chunk_index=chunk_index, size=written, block_digests=block_digests)
+            bitmap = bytearray(upload.received_chunks or b'')
+            byte_index = chunk_index // 8
+            if len(bitmap) <= byte_index:
+                bitmap.extend(b'\0' * (byte_index + 1 - len(bitmap)))
+            bitmap[byte_index] |= 1 << (chunk_index % 8)
+            upload.received_chunks = bytes(bitmap)
+            upload.save(update_fields=['received_chunks'])
+    return upload
+
+
+def manifest(upload):
+    received = received_indexes(upload)
+    missing = missing_indexes(upload)
+    return {
+        'upload_id': upload.upload_id,
+        'status': upload.status,
+        'file_size': upload.file_size,
+        'chunk_size': upload.chunk_size,
+        'total_chunks': upload.total_chunks,
+        'received_chunks': as_ranges(received),
+        'missing_chunks': as_ranges(missing),
+        'received_bytes': sum(expected_chunk_length(upload, i) for i in received),
+    }
+
+
+def chunk_size_is_aligned(chunk_size):
+    # Chunks have to start on a hash block boundary so their leaves can be computed independently
+    return chunk_size % get_block_size() == 0
+
+
+def content_digest(upload):
+    """Root of the hash tree, built from the stored per-chunk leaves (no file reads)."""
+    leaves = b''.join(
+        bytes(digests) for digests in
+        upload.parts.order_by('chunk_index').values_list('block_digests', flat=True)
+    )
+    return tree_digest(leaves)
+
+
+# --- Finalization ---
+
+def begin_processing(upload_id):
+    """
+    Atomically move a session INIT -> PROCESSING. False if someone else got there first.
+    The update waits for chunks holding the row lock (store_chunk), so nothing is still
+    writing to the target when it's renamed into the blob store.
+    """
+    # Restart the reaper's clock: the last chunk may have arrived long before /complete
+    return ChunkedUpload.objects.filter(upload_id=upload_id, status='INIT').update(
+        status='PROCESSING', last_activity_at=timezone.now()
+    ) == 1
+
+
+def settle(upload, **fields):
+    """
+    Move a PROCESSING session on (COMPLETED or FAILED, with fields) and release its
+    quota reservation, unless the reaper expired it first: whichever side wins
+    the conditional update releases, so the reservation goes exactly once.
+    """
+    if ChunkedUpload.objects.filter(upload_id=upload.upload_id, status='PROCESSING').update(**fields) != 1:
+        return False
+    quota.release(upload.user_id, upload.file_size)
+    for name, value in fields.items():
+        setattr(upload, name, value)
+    return True
+
+
+def wait_while_processing(upload, timeout):
+    deadline = time.monotonic() + timeout
+    while upload.status == 'PROCESSING' and time.monotonic() < deadline:
+        time.sleep(0.5)
+        upload.refresh_from_db()
+    return upload
+
+
+async def await_while_processing(upload, timeout):
+    """wait_while_processing for async views: the long poll holds no thread while it waits."""
+    deadline = time.monotonic() + timeout
+    while upload.status == 'PROCESSING' and time.monotonic() < deadline:
+        await asyncio.sleep(0.5)
+        await upload.arefresh_from_db()
+    return upload
+
+
+def finalize(upload_id, metadata=None, parent_id=None):
+    """
+    Turn a fully received PROCESSING session into a File, archiving the old
+    content when the name already exists. Runs inline or on the worker pool.
+    Leaves the session COMPLETED, or FAILED with the reason in upload.error.
+    """
+    upload = ChunkedUpload.objects.select_related('user').get(upload_id=upload_id)
+    try:
+        file_obj = _finalize(upload, metadata or {}, parent_id)
+    except Exception as e:
+        settle(upload, status='FAILED', error='; '.join(str(d) for d in e.detail) if isinstance(e, ValidationError) else str(e))
+        shutil.rmtree(session_dir(upload_id), ignore_errors=True)
+        raise
+    # The bytes are charged to used_bytes by now (File post_save), the reservation can go
+    if not settle(upload, status='COMPLETED', sha256=file_obj.sha256, error=None, completed_file=file_obj):
+        print(f"Upload {upload_id} expired while finalizing, its file {file_obj.pk} was kept")
+    return file_obj
+
+
+def _finalize(upload, metadata, parent_id):
+    # The digest becomes the name of a blob other users' uploads dedupe onto, so the leaves
+    # have to cover every byte: each part is written and recorded together (store_chunk)
+    parts = upload.parts.aggregate(count=Count('pk'), size=Sum('size'))
+    if parts['count'] != upload.total_chunks or (parts['size'] or 0) != upload.file_size:
+        raise ValidationError("Received chunks don't cover the whole file")
+
+    # Whole-file digest from the per-chunk leaves, no need to read the data again
+    digest = content_digest(upload)
+    if upload.sha256 and upload.sha256.lower() != digest:
+        raise ValidationError(f"Checksum mismatch, computed sha256 {digest}")
+
+    # 1. Quota was reserved at init, finalize() releases it (settle) once the File save has charged the real bytes
+
+    # 2. Create File Object
+    file_instance = File(
+        user=upload.user,
+        name=upload.filename,
+        size=upload.file_size,
+        mime_type=upload.mime_type,
+        sha256=digest,
+        metadata=metadata,
+    )
+
+    # Categorization logic (re-use?)
+    if upload.mime_type and upload.mime_type.startswith('image/'):
+        file_instance.file_type = 'PHOTO'
+        file_instance.category = 'PHOTO'
+    elif upload.mime_type and upload.mime_type.startswith('video/'):
+        file_instance.file_type = 'VIDEO'
+        file_instance.category = 'VIDEO'
+
+    # Parent ID
+    if parent_id and parent_id != 'root':
+        file_instance.parent_id = parent_id
+
+    # VERSIONING HANDLER
+    existing = File.objects.filter(user=upload.user, parent_id=file_instance.parent_id, name=upload.filename, is_folder=False).first()
+    replaced_name = None
+    if existing:
+        # Archive logic (blob hand-over or hardlink, constant time whatever the size)
+        if versions.archive_current(existing) and not existing.blob_id:
+            replaced_name = existing.file.name
+        file_instance = existing # Update existing
+        file_instance.size = upload.file_size
+        file_instance.mime_type = upload.mime_type
+        file_instance.sha256 = digest
+        if metadata:
+            file_instance.metadata = metadata
+
+    # 3. Hand the target file to the blob store: a rename if the content is new, an unlink if it's a duplicate
+    blob = blobs.ingest_path(target_path(upload.upload_id), digest, upload.file_size)
+    file_instance.blob = blob
+    file_instance.file.name = blob.file.name
+    try:
+        file_instance.save() # ledger charge happens in the post_save signal
+    except Exception:
+        blobs.release(blob.pk)
+        raise
+    versions.drop_replaced(replaced_name)
+
+    # Cleanup
+    shutil.rmtree(session_dir(upload.upload_id), ignore_errors=True)
+    return file_instance
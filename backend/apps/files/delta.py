@@ -0,0 +1,239 @@
+import bisect
+import hashlib
+import io
+import os
+import tempfile
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from .hashing import BlockHasher, digest_stream, tree_digest
+from .models import FileVersion, FileVersionChunk
+from . import blobs
+
+# Block-level delta storage for FileVersion history.
+#
+# A version's content is cut into content-defined chunks with a Gear rolling
+# hash (FastCDC style): a boundary is wherever the hash of the last few bytes
+# hits a mask, so inserting or editing bytes only moves the boundaries around
+# the edit. Each chunk is stored as a Blob, and the version keeps an ordered
+# list of FileVersionChunk rows. Consecutive versions of a spreadsheet or VM
+# image therefore share all their unchanged chunks.
+
+# (min, avg, max) chunk sizes in bytes
+DEFAULT_CHUNK_SIZES = (64 * 1024, 256 * 1024, 1024 * 1024)
+
+# Versions smaller than this stay as whole blobs, chunking them saves nothing
+DEFAULT_MIN_VERSION_SIZE = 1024 * 1024
+
+# Versions larger than this stay whole too: the chunker runs at a few MB/s in pure Python
+DEFAULT_MAX_VERSION_SIZE = 256 * 1024 * 1024
+
+# Fixed gear table (derived from sha256, not random) so chunk boundaries are
+# identical across processes and releases, otherwise nothing would dedupe.
+_GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'big') for i in range(256)]
+_MASK64 = (1 << 64) - 1
+
+_READ_SIZE = 4 * 1024 * 1024
+
+
+def get_chunk_sizes():
+    return getattr(settings, 'VERSION_CHUNK_SIZES', DEFAULT_CHUNK_SIZES)
+
+
+def _cut_point(buf, start, end, min_size, max_size, mask):
+    """End offset of the chunk starting at start, looking no further than end."""
+    if end - start <= min_size:
+        return end
+    limit = min(end, start + max_size)
+    h = 0
+    gear = _GEAR
+    # Cut-point skipping: the first min_size bytes can never be a boundary
+    for i, b in enumerate(buf[start + min_size:limit], start + min_size):
+        h = ((h << 1) + gear[b]) & _MASK64
+        if not h & mask:
+            return i + 1
+    return limit
+
+
+def iter_chunks(f):
+    """Yield content-defined chunks (bytes) from a binary file object."""
+    min_size, avg_size, max_size = get_chunk_sizes()
+    # Boundary chance of 1/2^k per byte after min_size puts the average chunk near avg_size
+    mask = (1 << max(1, (avg_size - min_size).bit_length() - 1)) - 1
+    buf = b''
+    eof = False
+    while True:
+        while not eof and len(buf) < max_size:
+            data = f.read(_READ_SIZE)
+            if not data:
+                eof = True
+            buf += data
+        if not buf:
+            return
+        start = 0
+        # Only cut where a full max_size window is available (or at EOF), so boundaries don't depend on read sizes
+        while len(buf) - start >= max_size or (eof and start < len(buf)):
+            end = _cut_point(buf, start, len(buf), min_size, max_size, mask)
+            yield buf[start:end]
+            start = end
+        buf = buf[start:]
+        if eof and not buf:
+            return
+
+
+def compact_version(version):
+    """
+    Re-store a blob-backed version as delta chunks and drop its whole-file blob.
+    Safe to re-run: a failed pass removes its partial chunk list.
+    """
+    if not version.blob_id or version.chunks.exists():
+        return False
+
+    rows = []
+    try:
+        with version.file.open('rb') as f:
+            for position, data in enumerate(iter_chunks(f)):
+                blob = blobs.ingest_bytes(data, digest_stream([data]))
+                rows.append(FileVersionChunk(version=version, position=position, blob=blob))
+                if len(rows) >= 500:
+                    FileVersionChunk.objects.bulk_create(rows)
+                    rows = []
+        FileVersionChunk.objects.bulk_create(rows)
+    except Exception:
+        # bulk-created rows have blob refs, the post_delete signal hands them back
+        for chunk in version.chunks.all():
+            chunk.delete()
+        for row in rows:
+            blobs.release(row.blob_id)
+        raise
+
+    with transaction.atomic():
+        old_blob = version.blob_id
+        version.blob = None
+        version.file = ''
+        version.save(update_fields=['blob', 'file'])
+        blobs.release(old_blob)
+    return True
+
+
+def compact_file_versions(file_id, max_size=None):
+    """
+    Compact every version of a File that is the last holder of its whole-file blob.
+    A blob still shared with the current File (or anyone else) stays whole, chunking it would only add bytes.
+    Versions over max_size (default VERSION_DELTA_MAX_SIZE, 0 for no limit) stay whole.
+    Run by `manage.py compact_versions` (cron), never in the web process: chunking is CPU-bound for minutes on big files.
+    """
+    min_size = getattr(settings, 'VERSION_DELTA_MIN_SIZE', DEFAULT_MIN_VERSION_SIZE)
+    if max_size is None:
+        max_size = getattr(settings, 'VERSION_DELTA_MAX_SIZE', DEFAULT_MAX_VERSION_SIZE)
+    compacted = 0
+    candidates = FileVersion.objects.filter(
+        file_item_id=file_id, blob__isnull=False, blob__ref_count=1, size__gte=min_size
+    ).order_by('version_number')
+    if max_size:
+        candidates = candidates.filter(size__lte=max_size)
+    for version in candidates:
+        if compact_version(version):
+            compacted += 1
+    return compacted
+
+
+class VersionReader(io.RawIOBase):
+    """
+    Seekable read-only file over a delta version's chunks, streamed back in order.
+    Only the chunks covering the requested bytes are opened.
+    """
+
+    def __init__(self, version):
+        super().__init__()
+        self.name = version.file_item.name
+        self._chunks = list(version.chunks.values_list('blob__file', 'blob__size'))
+        self._starts = []
+        total = 0
+        for _, size in self._chunks:
+            self._starts.append(total)
+            total += size
+        self._size = total
+        self._pos = 0
+        self._index = None
+        self._handle = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = self._size + offset
+        self._pos = max(0, self._pos)
+        return self._pos
+
+    def _open_chunk(self, index):
+        if self._index != index:
+            if self._handle:
+                self._handle.close()
+            self._handle = default_storage.open(self._chunks[index][0], 'rb')
+            self._index = index
+        return self._handle
+
+    def readinto(self, b):
+        if self._pos >= self._size:
+            return 0
+        # Chunk holding _pos
+        lo = bisect.bisect_right(self._starts, self._pos) - 1
+        handle = self._open_chunk(lo)
+        handle.seek(self._pos - self._starts[lo])
+        data = handle.read(min(len(b), self._chunks[lo][1] - (self._pos - self._starts[lo])))
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def close(self):
+        if self._handle:
+            self._handle.close()
+            self._handle = None
+        super().close()
+
+
+def open_version(version):
+    """Binary file object with a version's content, whichever way it is stored."""
+    if version.is_delta:
+        return io.BufferedReader(VersionReader(version), buffer_size=1024 * 1024)
+    return version.file.open('rb')
+
+
+def materialize(version):
+    """
+    Blob holding a version's full content (with a reference taken for the caller).
+    Reuses the blob if the content is still stored whole somewhere, otherwise
+    rebuilds it from the chunks into scratch space and ingests that.
+    """
+    if version.blob_id:
+        blobs.add_ref(version.blob_id)
+        return version.blob
+    if version.sha256:
+        blob = blobs.acquire_existing(version.sha256)
+        if blob:
+            return blob
+
+    scratch = os.path.join(settings.MEDIA_ROOT, 'tmp')
+    os.makedirs(scratch, exist_ok=True)
+    hasher = BlockHasher()
+    with tempfile.NamedTemporaryFile(dir=scratch, delete=False) as out:
+        with open_version(version) as src:
+            while True:
+                data = src.read(_READ_SIZE)
+                if not data:
+                    break
+                hasher.update(data)
+                out.write(data)
+    return blobs.ingest_path(out.name, tree_digest(hasher.finish()), hasher.size)
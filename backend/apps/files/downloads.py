@@ -0,0 +1,354 @@
+import asyncio
+import hashlib
+import mimetypes
+import os
+import re
+import uuid
+from urllib.parse import quote, unquote
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe
+from . import thumbcache
+
+# Shared response building for the download views:
+# Range / If-Range with 206 Partial Content, multipart/byteranges and 416.
+
+STREAM_BLOCK_SIZE = 64 * 1024
+
+# More ranges than this in one request gets the whole file instead (RFC 9110 lets us ignore Range)
+MAX_RANGES = 20
+
+# Offload modes: 'x-accel' (nginx X-Accel-Redirect) or 'x-sendfile' (Apache/lighttpd)
+OFFLOAD_HEADERS = {
+    'x-accel': 'X-Accel-Redirect',
+    'x-sendfile': 'X-Sendfile',
+}
+
+# nginx `internal` location aliased to MEDIA_ROOT
+DEFAULT_ACCEL_PREFIX = '/protected-media/'
+
+# Long enough to count as forever, the `v` query parameter changes when the thumbnail does
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+_RANGE_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header, size):
+    """
+    Parse a `Range: bytes=...` header against a representation of `size` bytes.
+    Returns a sorted list of merged (start, end) inclusive ranges, or None to
+    ignore the header and send everything. Raises RangeNotSatisfiable (-> 416).
+    """
+    if not header or not header.strip().lower().startswith('bytes='):
+        return None
+    ranges = []
+    for spec in header.split('=', 1)[1].split(','):
+        match = _RANGE_RE.match(spec)
+        if not match or (not match.group(1) and not match.group(2)):
+            return None # Malformed, ignore the whole header
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if last and int(last) < start:
+                return None
+        else:
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length == 0:
+                continue
+            start = max(0, size - length)
+            end = size - 1
+        if start < size:
+            ranges.append((start, end))
+    if not ranges:
+        raise RangeNotSatisfiable()
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    # Merge overlapping/adjacent ranges so we never send the same bytes twice
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        if start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def if_range_matches(request, etag=None, last_modified=None):
+    """If-Range: only honour Range when the client's validator still matches."""
+    value = request.headers.get('If-Range')
+    if not value:
+        return True
+    value = value.strip()
+    if value.startswith('"') or value.startswith('W/'):
+        # Weak validators never match for If-Range
+        return etag is not None and value == etag
+    date = parse_http_date_safe(value)
+    return date is not None and last_modified is not None and int(last_modified.timestamp()) <= date
+
+
+def _iter_range(f, start, length):
+    f.seek(start)
+    remaining = length
+    while remaining > 0:
+        data = f.read(min(STREAM_BLOCK_SIZE, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+
+def _iter_segments(f, segments):
+    # Segments are literal bytes (multipart headers) or (start, length) pieces of f
+    for segment in segments:
+        if isinstance(segment, bytes):
+            yield segment
+        else:
+            yield from _iter_range(f, *segment)
+
+
+async def _aiter_segments(f, segments):
+    """Async _iter_segments: reads run on a worker thread, the event loop never blocks on disk."""
+    for segment in segments:
+        if isinstance(segment, bytes):
+            yield segment
+            continue
+        start, remaining = segment
+        await asyncio.to_thread(f.seek, start)
+        while remaining > 0:
+            data = await asyncio.to_thread(f.read, min(STREAM_BLOCK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def _size_of(f):
+    position = f.tell()
+    size = f.seek(0, os.SEEK_END)
+    f.seek(position)
+    return size
+
+
+def serve_file(request, f, filename, content_type=None, etag=None, last_modified=None, as_attachment=True, use_async=False):
+    """
+    Response for an open, seekable binary file: the whole file, one range (206),
+    several ranges (206 multipart/byteranges), or 416. Only the requested bytes are read.
+    use_async=True streams with an async iterator, for the ASGI views.
+    """
+    content_type = content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    size = _size_of(f)
+
+    try:
+        ranges = parse_range(request.headers.get('Range'), size) if if_range_matches(request, etag, last_modified) else None
+    except RangeNotSatisfiable:
+        f.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        response['Accept-Ranges'] = 'bytes'
+        return response
+
+    status = 206
+    if ranges is None:
+        if not use_async:
+            response = FileResponse(f, as_attachment=as_attachment, filename=filename, content_type=content_type)
+        status = 200
+        segments = [(0, size)]
+        length = size
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        segments = [(start, end - start + 1)]
+        length = end - start + 1
+    else:
+        boundary = uuid.uuid4().hex
+        segments = []
+        for start, end in ranges:
+            segments.append((
+                f'--{boundary}\r\n'
+                f'Content-Type: {content_type}\r\n'
+                f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n'
+            ).encode())
+            segments.append((start, end - start + 1))
+            segments.append(b'\r\n')
+        segments.append(f'--{boundary}--\r\n'.encode())
+        length = sum(len(s) if isinstance(s, bytes) else s[1] for s in segments)
+        content_type = f'multipart/byteranges; boundary={boundary}'
+
+    if ranges is not None or use_async:
+        body = _aiter_segments(f, segments) if use_async else _iter_segments(f, segments)
+        response = StreamingHttpResponse(body, status=status, content_type=content_type)
+        response['Content-Length'] = str(length)
+        response._resource_closers.append(f.close)
+        if ranges is not None and len(ranges) == 1:
+            response['Content-Range'] = f'bytes {ranges[0][0]}-{ranges[0][1]}/{size}'
+        disposition = content_disposition_header(as_attachment, filename)
+        if disposition:
+            response['Content-Disposition'] = disposition
+    response['Accept-Ranges'] = 'bytes'
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    return response
+
+
+def get_offload_mode():
+    mode = getattr(settings, 'FILE_DOWNLOAD_OFFLOAD', None)
+    return mode if mode in OFFLOAD_HEADERS else None
+
+
+def offload_file(name, filename, content_type=None, etag=None, last_modified=None, as_attachment=True, storage=None):
+    """
+    Hand the byte streaming to the front-end server: an empty response with an
+    internal redirect header, the server then sends the file itself (sendfile, Range).
+    `name` is the storage name (FieldFile.name). Returns None when offload is off
+    or the file isn't on local disk, the caller streams it instead.
+    """
+    mode = get_offload_mode()
+    if not mode or not name:
+        return None
+    try:
+        path = (storage or default_storage).path(name)
+    except NotImplementedError:
+        return None
+
+    response = HttpResponse(content_type=content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    if mode == 'x-accel':
+        prefix = getattr(settings, 'FILE_DOWNLOAD_ACCEL_PREFIX', DEFAULT_ACCEL_PREFIX)
+        response[OFFLOAD_HEADERS[mode]] = prefix.rstrip('/') + '/' + quote(name.lstrip('/'))
+    else:
+        response[OFFLOAD_HEADERS[mode]] = path
+    disposition = content_disposition_header(as_attachment, filename)
+    if disposition:
+        response['Content-Disposition'] = disposition
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    return response
+
+
+def resolve_offload(response):
+    """Local path an offloaded response points at (None if it isn't one, or it escapes MEDIA_ROOT)."""
+    root = os.path.realpath(settings.MEDIA_ROOT)
+    if 'X-Accel-Redirect' in response:
+        prefix = getattr(settings, 'FILE_DOWNLOAD_ACCEL_PREFIX', DEFAULT_ACCEL_PREFIX).rstrip('/') + '/'
+        uri = response['X-Accel-Redirect']
+        if not uri.startswith(prefix):
+            return None
+        path = os.path.realpath(os.path.join(root, unquote(uri[len(prefix):])))
+    elif 'X-Sendfile' in response:
+        path = os.path.realpath(response['X-Sendfile'])
+    else:
+        return None
+    if os.path.commonpath([root, path]) != root:
+        return None
+    return path
+
+
+# --- Validators / conditional GET ---
+
+def _etag_from(*parts):
+    return '"{0}"'.format(hashlib.sha256('|'.join(str(p) for p in parts).encode()).hexdigest()[:32])
+
+
+def file_etag(file_obj, thumbnail=False):
+    """
+    Strong ETag for a File's content: its digest, or for thumbnails and pre-digest
+    legacy files the storage key plus updated_at (both change whenever the bytes do).
+    """
+    if thumbnail:
+        return thumbnail_etag(file_obj, file_obj.thumbnail)
+    if file_obj.sha256:
+        return '"{0}"'.format(file_obj.sha256)
+    return _etag_from(file_obj.file.name, file_obj.updated_at.isoformat())
+
+
+def thumbnail_etag(file_obj, field_file):
+    """ETag of File.thumbnail or one of its pyramid variants."""
+    return _etag_from('thumb', field_file.name, file_obj.updated_at.isoformat())
+
+
+def encoded_etag(etag, encoding):
+    # A compressed sidecar is a different representation, it needs its own strong ETag
+    return etag[:-1] + f'-{encoding}"'
+
+
+def version_etag(version):
+    # Versions never change once written
+    if version.sha256:
+        return '"{0}"'.format(version.sha256)
+    return _etag_from('version', version.pk)
+
+
+def path_etag(name):
+    # Storage names are unique per content (blob digests, generated thumbnail names)
+    return _etag_from('path', name)
+
+
+def thumbnail_token(file_obj):
+    """Cache-busting `v` value for thumbnail URLs, changes whenever the thumbnail does."""
+    return file_etag(file_obj, thumbnail=True).strip('"')[:12]
+
+
+def not_modified(request, etag=None, last_modified=None):
+    """
+    304 (or 412 for failed If-Match) when the client's validators still hold, else None.
+    Checked before the file is opened, so a revalidation costs no disk I/O.
+    """
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    return get_conditional_response(request, etag=etag, last_modified=timestamp)
+
+
+def set_validators(response, etag=None, last_modified=None, immutable=False, public_max_age=None):
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    if public_max_age is not None:
+        # Signed URLs: no credentials involved, shared caches may keep it until the link expires
+        response['Cache-Control'] = f'public, max-age={public_max_age}, immutable'
+    elif immutable:
+        response['Cache-Control'] = f'private, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    else:
+        # Cacheable, but revalidate with the ETag each time (cheap 304s)
+        response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+# --- Batched thumbnails ---
+
+# Pack format: per thumbnail, 16-byte file id + 4-byte big-endian length + JPEG bytes
+PACK_CONTENT_TYPE = 'application/x-thumbnail-pack'
+
+
+def iter_thumbnail_pack(files):
+    for file_obj in files:
+        data = thumbcache.get_thumbnail(file_obj)
+        if data is None:
+            continue
+        yield file_obj.pk.bytes + len(data).to_bytes(4, 'big') + data
+
+
+def iter_thumbnail_multipart(files, boundary):
+    for file_obj in files:
+        data = thumbcache.get_thumbnail(file_obj)
+        if data is None:
+            continue
+        yield (
+            f'--{boundary}\r\n'
+            f'Content-Type: image/jpeg\r\n'
+            f'Content-Length: {len(data)}\r\n'
+            f'Content-ID: <{file_obj.pk}>\r\n'
+            f'ETag: {file_etag(file_obj, thumbnail=True)}\r\n\r\n'
+        ).encode() + data + b'\r\n'
+    yield f'--{boundary}--\r\n'.encode()
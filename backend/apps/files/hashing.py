@@ -0,0 +1,63 @@
+import hashlib
+from django.conf import settings
+
+# Content digests are a two-level SHA-256 hash tree:
+#   leaf  = sha256(block) for every HASH_BLOCK_SIZE block of the file
+#   root  = sha256(leaf_0 + leaf_1 + ... + leaf_n)
+# Leaves can be computed independently (one chunk at a time, in any order),
+# so the root is known at completion without reading the data again, and the
+# result doesn't depend on how the client split the upload.
+DEFAULT_HASH_BLOCK_SIZE = 1024 * 1024
+DIGEST_SIZE = 32
+
+
+def get_block_size():
+    return getattr(settings, 'CONTENT_HASH_BLOCK_SIZE', DEFAULT_HASH_BLOCK_SIZE)
+
+
+class BlockHasher:
+    """
+    Feed bytes in order, collect one SHA-256 leaf per block.
+    Used while a chunk (or a whole upload) is being streamed to disk.
+    """
+
+    def __init__(self, block_size=None):
+        self.block_size = block_size or get_block_size()
+        self.digests = []
+        self.size = 0
+        self._current = hashlib.sha256()
+        self._filled = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        self.size += len(view)
+        while view:
+            take = min(len(view), self.block_size - self._filled)
+            self._current.update(view[:take])
+            self._filled += take
+            view = view[take:]
+            if self._filled == self.block_size:
+                self.digests.append(self._current.digest())
+                self._current = hashlib.sha256()
+                self._filled = 0
+
+    def finish(self):
+        """Close the trailing partial block and return the leaf digests as bytes."""
+        if self._filled:
+            self.digests.append(self._current.digest())
+            self._current = hashlib.sha256()
+            self._filled = 0
+        return b''.join(self.digests)
+
+
+def tree_digest(leaf_digests):
+    """Root hex digest from concatenated leaf digests."""
+    return hashlib.sha256(bytes(leaf_digests)).hexdigest()
+
+
+def digest_stream(chunks, block_size=None):
+    """Root digest for an iterable of byte chunks (e.g. FieldFile.chunks())."""
+    hasher = BlockHasher(block_size)
+    for data in chunks:
+        hasher.update(data)
+    return tree_digest(hasher.finish())
@@ -0,0 +1,209 @@
+from io import BytesIO
+from PIL import ExifTags, Image, features
+
+# Image work that runs in the thumbnail worker processes (see thumbnails.py).
+# Pure PIL on purpose: no Django imports, so a freshly spawned worker starts
+# fast and never touches settings or the database.
+
+# Thumbnail pyramid: grid, retina grid / phones, lightbox
+PYRAMID_SIZES = (128, 320, 1280)
+
+# The level stored as File.thumbnail (JPEG), what the batch endpoint and older clients get
+BASE_SIZE = 320
+
+# format: (PIL format, save options, file extension, content type)
+FORMATS = {
+    'jpeg': ('JPEG', {'quality': 85, 'optimize': True}, 'jpg', 'image/jpeg'),
+    'webp': ('WEBP', {'quality': 80, 'method': 4}, 'webp', 'image/webp'),
+    # speed 8: ~10x faster than the default 6 for a few % more bytes, see benchmark_thumbnails
+    'avif': ('AVIF', {'quality': 60, 'speed': 8}, 'avif', 'image/avif'),
+}
+
+
+ORIENTATION = 0x0112
+
+# EXIF orientation -> the transpose that puts the pixels upright
+_UPRIGHT = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# An embedded EXIF thumbnail stands in for the photo only with the same shape
+_ASPECT_TOLERANCE = 0.02
+
+
+def supported_formats():
+    """Formats this Pillow build can write, JPEG always included."""
+    return ['jpeg'] + [f for f in ('webp', 'avif') if features.check(f)]
+
+
+def _flatten(image):
+    # Flatten transparency onto white: JPEG has no alpha, and thumbnails look the same in every format
+    if image.mode in ('RGBA', 'LA'):
+        background = Image.new(image.mode[:-1], image.size, 255 if image.mode == 'LA' else (255, 255, 255))
+        background.paste(image, image.split()[-1])
+        return background
+    if image.mode not in ('RGB', 'L'):
+        return image.convert('RGB')
+    return image
+
+
+def _encode(image, fmt):
+    pil_format, options, _, _ = FORMATS[fmt]
+    out = BytesIO()
+    image.save(out, format=pil_format, **options)
+    return out.getvalue()
+
+
+def embedded_thumbnail(image):
+    """The JPEG's EXIF (IFD1) thumbnail, opened, or None."""
+    raw = image.info.get('exif')
+    if image.format != 'JPEG' or not raw:
+        return None
+    try:
+        ifd1 = image.getexif().get_ifd(ExifTags.IFD.IFD1)
+        offset, length = ifd1.get(0x0201), ifd1.get(0x0202)
+        if not offset or not length:
+            return None
+        start = 6 + offset # Offsets count from the TIFF header, after b'Exif\0\0'
+        thumb = Image.open(BytesIO(raw[start:start + length]))
+        thumb.load()
+        return thumb
+    except Exception:
+        return None # Broken EXIF is common, never worth failing the photo for
+
+
+def _good_enough(thumb, image, size):
+    if max(thumb.size) < size:
+        return False
+    return abs(thumb.width / thumb.height - image.width / image.height) <= _ASPECT_TOLERANCE * image.width / image.height
+
+
+def _open_level(image, size, fast):
+    """The photo, ready to shrink to a largest level of `size`px, decoded as little as possible."""
+    if not fast:
+        image.load() # Full-resolution decode, the reference the benchmark compares against
+        return image
+    # JPEG DCT scaling: libjpeg decodes straight to 1/2, 1/4 or 1/8 size, still at least size px
+    image.draft(None, (size, size))
+    return image
+
+
+def _gps_degrees(value, ref):
+    degrees, minutes, seconds = (float(v) for v in value)
+    result = degrees + minutes / 60 + seconds / 3600
+    return -result if ref in ('S', 'W') else result
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        value = value.decode('ascii', 'ignore')
+    if not isinstance(value, str):
+        return None
+    return value.strip('\x00 ') or None
+
+
+def read_metadata(image):
+    """
+    What the photo says about itself, from its header (no pixel decode):
+    {'width', 'height' (as displayed, after orientation), 'orientation', 'taken_at'
+    (EXIF 'YYYY:MM:DD HH:MM:SS' plus offset, if any), 'camera_make', 'camera_model',
+    'latitude', 'longitude', 'altitude'}. Missing or broken tags are None.
+    """
+    exif = image.getexif()
+    orientation = exif.get(ORIENTATION, 1)
+    width, height = image.size
+    if orientation in (5, 6, 7, 8):
+        width, height = height, width
+    metadata = {
+        'width': width, 'height': height, 'orientation': orientation,
+        'taken_at': None, 'camera_make': _text(exif.get(0x010F)), 'camera_model': _text(exif.get(0x0110)),
+        'latitude': None, 'longitude': None, 'altitude': None,
+    }
+    try:
+        sub = exif.get_ifd(ExifTags.IFD.Exif)
+        taken = _text(sub.get(0x9003)) or _text(exif.get(0x0132)) # DateTimeOriginal, else DateTime
+        if taken:
+            offset = _text(sub.get(0x9011)) # OffsetTimeOriginal, e.g. +02:00
+            metadata['taken_at'] = taken + (offset or '')
+    except Exception:
+        pass
+    try:
+        gps = exif.get_ifd(ExifTags.IFD.GPSInfo)
+        if gps.get(2) and gps.get(4):
+            metadata['latitude'] = _gps_degrees(gps[2], _text(gps.get(1)))
+            metadata['longitude'] = _gps_degrees(gps[4], _text(gps.get(3)))
+        if gps.get(6) is not None:
+            metadata['altitude'] = -float(gps[6]) if gps.get(5) in (1, b'\x01') else float(gps[6])
+    except Exception:
+        pass # Broken GPS blocks are common, the rest is still worth keeping
+    return metadata
+
+
+def read_photo_metadata(source):
+    """read_metadata for an image given as a local path or as its bytes."""
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+    with Image.open(source) as image:
+        return read_metadata(image)
+
+
+def _shrink(level, sizes, formats, orientation):
+    # Shrinks in place, largest size first, each resize starting from the previous level
+    rendered = {}
+    for i, size in enumerate(sizes):
+        # reducing_gap=None: no second draft() undoing _open_level's
+        level.thumbnail((size, size), reducing_gap=None)
+        if i == 0:
+            # Flatten and orient once, on the largest level rather than the decoded photo
+            level = _flatten(level)
+            if orientation in _UPRIGHT:
+                level = level.transpose(_UPRIGHT[orientation])
+        for fmt in formats:
+            rendered[(size, fmt)] = _encode(level, fmt)
+    return rendered
+
+
+def _render(image, sizes, formats, fast):
+    sizes = sorted(sizes, reverse=True)
+    orientation = image.getexif().get(ORIENTATION, 1)
+    # Camera EXIF thumbnails are ~160px: they serve the levels they are big enough for (the grid
+    # size), the photo is decoded only for the rest
+    thumb = embedded_thumbnail(image) if fast else None
+    from_thumb = [size for size in sizes if thumb is not None and _good_enough(thumb, image, size)]
+    from_photo = [size for size in sizes if size not in from_thumb]
+    rendered = {}
+    if from_photo:
+        rendered.update(_shrink(_open_level(image, from_photo[0], fast), from_photo, formats, orientation))
+    if from_thumb:
+        rendered.update(_shrink(thumb, from_thumb, formats, orientation))
+    return rendered
+
+
+def render_pyramid(source, sizes=PYRAMID_SIZES, formats=None, fast=True):
+    """
+    {(size, format): bytes} for an image given as a local path or as its bytes,
+    upright according to its EXIF orientation.
+    Decodes once, at reduced resolution when possible (see _open_level), and
+    shrinks in place level by level, largest first, so each resize starts from
+    the previous level instead of the full image. Levels no bigger than the
+    embedded EXIF thumbnail are made from that instead.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+    with Image.open(source) as image:
+        return _render(image, sizes, formats or supported_formats(), fast)
+
+
+def render_photo(source, sizes=PYRAMID_SIZES, formats=None):
+    """The ingest pass: (render_pyramid's output, read_metadata's) from one open of the file."""
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+    with Image.open(source) as image:
+        metadata = read_metadata(image) # Header only, before the decode
+        return _render(image, sizes, formats or supported_formats(), True), metadata
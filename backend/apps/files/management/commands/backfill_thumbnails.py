@@ -0,0 +1,74 @@
+import json
+import os
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from apps.files import thumbnails
+
+class Command(BaseCommand):
+    help = 'Renders missing photo thumbnails (or one pyramid variant), or reads missing EXIF metadata, on a process pool. Resumable'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--variant', help='Only photos lacking this variant, e.g. thumb-1280.webp (default: no thumbnail at all)')
+        parser.add_argument('--regenerate', action='store_true', help='Re-render every photo')
+        parser.add_argument('--metadata', action='store_true', help='Only read EXIF metadata of photos that have none yet, no rendering')
+        parser.add_argument('--workers', type=int, help='Worker processes (default: one per core)')
+        parser.add_argument('--batch-size', type=int, default=200, help='Photos per batch, progress is saved after each')
+        parser.add_argument('--checkpoint', help='Progress file (default: MEDIA_ROOT/tmp/thumbnail-backfill.json)')
+        parser.add_argument('--reset', action='store_true', help='Ignore saved progress and start from the beginning')
+
+    def handle(self, *args, **options):
+        try:
+            queryset = thumbnails.backfill_queryset(options['variant'], options['regenerate'], options['metadata'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        path = options['checkpoint'] or os.path.join(settings.MEDIA_ROOT, 'tmp', 'thumbnail-backfill.json')
+        if options['regenerate']:
+            mode = 'regenerate'
+        elif options['metadata']:
+            mode = 'metadata'
+        else:
+            mode = options['variant'] or 'thumbnail'
+        verb = 'read' if mode == 'metadata' else 'render'
+        after = None
+        if not options['reset'] and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved.get('mode') == mode:
+                after = saved['last_pk']
+                self.stdout.write(f'Resuming after {after}.')
+            else:
+                self.stdout.write(f"Checkpoint is for '{saved.get('mode')}', starting over.")
+
+        total = queryset.filter(pk__gt=after).count() if after else queryset.count()
+        self.stdout.write(f'{total} photos to {verb}.')
+
+        rendered = failed = 0
+        started = time.monotonic()
+        try:
+            for batch in thumbnails.backfill(queryset, options['workers'], options['batch_size'], after, mode == 'metadata'):
+                rendered += batch['rendered']
+                failed += batch['failed']
+                self._save(path, {'mode': mode, 'last_pk': str(batch['last_pk'])})
+                elapsed = time.monotonic() - started
+                self.stdout.write(
+                    f"{rendered + failed}/{total} ({failed} failed), "
+                    f"{(rendered + failed) / elapsed if elapsed else 0:.1f} photos/s, last {batch['last_pk']}"
+                )
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING('Interrupted, run again to resume after the last saved batch.'))
+            return
+
+        if os.path.exists(path):
+            os.remove(path) # Finished, the next run starts from the beginning
+        self.stdout.write(self.style.SUCCESS(
+            f'Done: {rendered} photos in {time.monotonic() - started:.1f}s, {failed} failed.'
+        ))
+
+    def _save(self, path, data):
+        # Write then rename: an interrupted write never leaves a corrupt checkpoint
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(path + '.tmp', path)
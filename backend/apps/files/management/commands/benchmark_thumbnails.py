@@ -0,0 +1,38 @@
+import json
+import shutil
+import tempfile
+from django.core.management.base import BaseCommand
+from apps.files import thumbbench
+
+class Command(BaseCommand):
+    help = 'Benchmarks the thumbnail engine over a generated corpus: images/sec and peak RSS per size and format'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--megapixels', default=','.join(map(str, thumbbench.DEFAULT_MEGAPIXELS)), help='Source sizes, comma-separated')
+        parser.add_argument('--formats', default=','.join(thumbbench.DEFAULT_FORMATS), help='Source formats: jpeg, png, webp')
+        parser.add_argument('--copies', type=int, default=3, help='Images per group')
+        parser.add_argument('--compare', action='store_true', help='Also run full-resolution decoding, for reference')
+        parser.add_argument('--corpus-dir', help='Keep the corpus here (reused if it exists) instead of a temp dir')
+        parser.add_argument('--json', action='store_true', help='One JSON object per result, for tracking regressions')
+
+    def handle(self, *args, **options):
+        megapixels = [float(mp) if '.' in mp else int(mp) for mp in options['megapixels'].split(',')]
+        formats = [f.strip() for f in options['formats'].split(',')]
+        modes = ('fast', 'full') if options['compare'] else ('fast',)
+        directory = options['corpus_dir'] or tempfile.mkdtemp(prefix='thumbbench-')
+        try:
+            groups = thumbbench.build_corpus(directory, megapixels, formats, options['copies'])
+            results = list(thumbbench.run(groups, modes=modes))
+        finally:
+            if not options['corpus_dir']:
+                shutil.rmtree(directory, ignore_errors=True)
+
+        for result in results:
+            if options['json']:
+                self.stdout.write(json.dumps(result))
+                continue
+            sizes = '/'.join(map(str, result['sizes']))
+            self.stdout.write(
+                f"{result['group']:<18} {result['mode']:<5} {sizes:<13} {result['images']:>3} images  "
+                f"{result['images_per_sec']:>7.2f} img/s  peak RSS {result['peak_rss_mb']:>7.1f} MB"
+            )
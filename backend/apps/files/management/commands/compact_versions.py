@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from apps.files.models import FileVersion
+from apps.files import delta
+
+class Command(BaseCommand):
+    help = 'Re-stores whole-file FileVersions as shared content-defined chunks (delta storage). Run from cron, outside the web processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-size', type=int,
+            help=f'Leave versions larger than this many bytes whole (default: VERSION_DELTA_MAX_SIZE, {delta.DEFAULT_MAX_VERSION_SIZE}; 0 for no limit)'
+        )
+
+    def handle(self, *args, **options):
+        file_ids = FileVersion.objects.filter(blob__isnull=False).values_list('file_item_id', flat=True).distinct()
+
+        total = 0
+        for file_id in file_ids.iterator():
+            try:
+                compacted = delta.compact_file_versions(file_id, options['max_size'])
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(f'Failed to compact versions of {file_id}: {e}'))
+                continue
+            if compacted:
+                self.stdout.write(f'{file_id}: {compacted} versions compacted')
+            total += compacted
+
+        self.stdout.write(self.style.SUCCESS(f'Compacted {total} versions.'))
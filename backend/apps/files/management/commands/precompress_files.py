@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from apps.files.models import File
+from apps.files import precompress
+
+class Command(BaseCommand):
+    help = 'Builds missing gzip/zstd sidecars for compressible documents uploaded before pre-compression existed'
+
+    def handle(self, *args, **options):
+        candidates = File.objects.filter(
+            blob__isnull=False, category__in=precompress.COMPRESSIBLE_CATEGORIES
+        ).only('id', 'blob', 'category', 'size', 'mime_type')
+
+        seen = set()
+        total = 0
+        for file_obj in candidates.iterator():
+            if file_obj.blob_id in seen or not precompress.should_compress(file_obj):
+                continue
+            seen.add(file_obj.blob_id)
+            try:
+                created = precompress.build_sidecars(file_obj.blob_id)
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(f'Failed to compress {file_obj.id}: {e}'))
+                continue
+            total += len(created)
+
+        self.stdout.write(self.style.SUCCESS(f'Built {total} sidecars for {len(seen)} blobs.'))
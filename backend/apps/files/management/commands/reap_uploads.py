@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from apps.files import reaper
+
+class Command(BaseCommand):
+    help = 'Expires abandoned chunked-upload sessions and deletes their scratch files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be removed')
+        parser.add_argument('--workers', type=int, default=4, help='Parallel deletions')
+        parser.add_argument('--idle-hours', type=float, help='Expire INIT sessions with no chunk for this long')
+        parser.add_argument('--max-age-days', type=float, help='Expire INIT sessions older than this')
+
+    def handle(self, *args, **options):
+        result = reaper.reap(
+            dry_run=options['dry_run'],
+            workers=options['workers'],
+            idle_hours=options['idle_hours'],
+            max_age_days=options['max_age_days'],
+        )
+        verb = 'Would free' if options['dry_run'] else 'Freed'
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {result['freed_bytes'] / (1024 ** 2):.1f} MB: "
+            f"{result['sessions']} expired sessions, {result['orphans']} orphaned directories."
+        ))
+
+        usage = reaper.scratch_usage()
+        self.stdout.write(
+            f"Scratch space: {usage['sessions_on_disk']} sessions on disk, {usage['open_sessions']} open, "
+            f"{usage['allocated_bytes'] / (1024 ** 2):.1f} MB allocated ({usage['apparent_bytes'] / (1024 ** 2):.1f} MB apparent)."
+        )
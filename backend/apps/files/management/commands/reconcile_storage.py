@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth import get_user_model
+from apps.files import quota
+
+User = get_user_model()
+
+class Command(BaseCommand):
+    help = 'Rebuilds the per-user storage ledger (used/reserved bytes) from the File, FileVersion and ChunkedUpload tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=str, help='Only reconcile this username')
+
+    def handle(self, *args, **options):
+        users = User.objects.all()
+        if options['user']:
+            users = users.filter(username=options['user'])
+            if not users.exists():
+                self.stdout.write(self.style.ERROR(f'User "{options["user"]}" does not exist'))
+                return
+
+        drifted = 0
+        for user in users.iterator():
+            old_used, used, old_reserved, reserved = quota.reconcile(user)
+            if (old_used, old_reserved) != (used, reserved):
+                drifted += 1
+                self.stdout.write(self.style.WARNING(
+                    f'{user.username}: used {old_used} -> {used}, reserved {old_reserved} -> {reserved}'
+                ))
+
+        self.stdout.write(self.style.SUCCESS(f'Reconciled storage ledger ({drifted} users corrected).'))
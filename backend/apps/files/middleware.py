@@ -0,0 +1,42 @@
+import os
+from datetime import datetime, timezone
+from django.http import HttpResponseNotFound
+from django.utils.cache import cc_delim_re, patch_vary_headers
+from django.utils.http import parse_http_date_safe
+from .downloads import resolve_offload, serve_file
+
+
+class DownloadOffloadMiddleware:
+    """
+    Dev stand-in for nginx: serves X-Accel-Redirect / X-Sendfile responses from
+    MEDIA_ROOT in Python, so the offload code path can be used without a front-end server.
+    Don't install it behind nginx, it would swallow the header before nginx sees it.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+
+        if 'X-Accel-Redirect' not in response and 'X-Sendfile' not in response:
+            return response
+
+        path = resolve_offload(response)
+        if path is None or not os.path.isfile(path):
+            return HttpResponseNotFound("File not found on server")
+        f = open(path, 'rb')
+
+        last_modified = parse_http_date_safe(response.get('Last-Modified', ''))
+        if last_modified is not None:
+            last_modified = datetime.fromtimestamp(last_modified, tz=timezone.utc)
+
+        # Same headers nginx would pass through, plus Range handling on top
+        served = serve_file(request, f, 'download', content_type=response['Content-Type'],
+                            etag=response.get('ETag'), last_modified=last_modified)
+        for header in ('Content-Disposition', 'Last-Modified', 'ETag', 'Cache-Control', 'Content-Encoding'):
+            if header in response:
+                served[header] = response[header]
+        if response.has_header('Vary'):
+            patch_vary_headers(served, cc_delim_re.split(response['Vary']))
+        return served
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0007_chunkedupload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='chunk_size',
+            field=models.BigIntegerField(default=5242880),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0008_chunkedupload_chunk_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='received_chunks',
+            field=models.BinaryField(blank=True, default=b''),
+        ),
+    ]
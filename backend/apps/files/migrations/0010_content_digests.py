@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0009_chunkedupload_received_chunks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='sha256',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='sha256',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.CreateModel(
+            name='ChunkedUploadPart',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chunk_index', models.IntegerField()),
+                ('size', models.BigIntegerField()),
+                ('block_digests', models.BinaryField()),
+                ('received_at', models.DateTimeField(auto_now=True)),
+                ('upload', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='parts', to='files.chunkedupload')),
+            ],
+            options={
+                'ordering': ['chunk_index'],
+                'unique_together': {('upload', 'chunk_index')},
+            },
+        ),
+    ]
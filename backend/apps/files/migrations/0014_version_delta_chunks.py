@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:07
+
+import apps.files.models
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0013_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fileversion',
+            name='sha256',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AlterField(
+            model_name='fileversion',
+            name='file',
+            field=models.FileField(blank=True, upload_to=apps.files.models.version_directory_path),
+        ),
+        migrations.CreateModel(
+            name='FileVersionChunk',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('position', models.IntegerField()),
+                ('blob', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='version_chunks', to='files.blob')),
+                ('version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='files.fileversion')),
+            ],
+            options={
+                'ordering': ['position'],
+                'unique_together': {('version', 'position')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0015_chunkedupload_last_activity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlobEncoding',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('encoding', models.CharField(choices=[('zstd', 'zstd'), ('gzip', 'gzip')], max_length=10)),
+                ('file', models.FileField(max_length=255, upload_to='')),
+                ('size', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('blob', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='encodings', to='files.blob')),
+            ],
+            options={
+                'unique_together': {('blob', 'encoding')},
+            },
+        ),
+    ]
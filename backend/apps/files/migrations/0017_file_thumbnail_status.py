@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:35
+
+from django.db import migrations, models
+
+
+def mark_existing_ready(apps, schema_editor):
+    File = apps.get_model('files', 'File')
+    File.objects.exclude(thumbnail='').exclude(thumbnail__isnull=True).update(thumbnail_status='READY')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0016_blobencoding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='thumbnail_status',
+            field=models.CharField(blank=True, choices=[('PENDING', 'Pending'), ('READY', 'Ready'), ('FAILED', 'Failed')], db_index=True, max_length=10, null=True),
+        ),
+        migrations.RunPython(mark_existing_ready, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:39
+
+import apps.files.models
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0017_file_thumbnail_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThumbnailVariant',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.PositiveSmallIntegerField()),
+                ('format', models.CharField(choices=[('jpeg', 'JPEG'), ('webp', 'WebP'), ('avif', 'AVIF')], max_length=10)),
+                ('file', models.FileField(max_length=255, upload_to=apps.files.models.thumbnail_variant_directory_path)),
+                ('file_item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='thumbnail_variants', to='files.file')),
+            ],
+            options={
+                'unique_together': {('file_item', 'size', 'format')},
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0018_thumbnailvariant'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PhotoMetadata',
+            fields=[
+                ('file_item', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='photo_metadata', serialize=False, to='files.file')),
+                ('taken_at', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('width', models.PositiveIntegerField(blank=True, null=True)),
+                ('height', models.PositiveIntegerField(blank=True, null=True)),
+                ('orientation', models.PositiveSmallIntegerField(default=1)),
+                ('camera_make', models.CharField(blank=True, max_length=100, null=True)),
+                ('camera_model', models.CharField(blank=True, db_index=True, max_length=100, null=True)),
+                ('latitude', models.FloatField(blank=True, null=True)),
+                ('longitude', models.FloatField(blank=True, null=True)),
+                ('altitude', models.FloatField(blank=True, null=True)),
+                ('extracted_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['latitude', 'longitude'], name='files_photo_latitud_cd07a2_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:08
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0003_user_download_limits'),
+        ('files', '0019_photometadata'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DownloadBudget',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='download_budget', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('streams', models.PositiveIntegerField(default=0)),
+                ('streams_changed_at', models.DateTimeField(blank=True, null=True)),
+                ('tokens', models.FloatField(default=0)),
+                ('refilled_at', models.FloatField(default=0)),
+            ],
+        ),
+    ]
@@ -15,9 +15,53 @@ class Tag(models.Model):
     def __str__(self):
         return self.name
 
+def blob_directory_path(instance, filename):
+    # Fan out on the digest so no directory gets huge: blobs/ab/cd/abcd...
+    return 'blobs/{0}/{1}/{2}'.format(instance.sha256[:2], instance.sha256[2:4], instance.sha256)
+
+class Blob(models.Model):
+    """
+    Content-addressed storage: one physical file per distinct content, shared by
+    every File/FileVersion with that digest and freed when the last one goes.
+    See files/blobs.py.
+    """
+    sha256 = models.CharField(max_length=64, primary_key=True) # Hash-tree digest, see files/hashing.py
+    file = models.FileField(upload_to=blob_directory_path, max_length=255)
+    size = models.BigIntegerField()
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sha256} ({self.ref_count} refs)"
+
+class BlobEncoding(models.Model):
+    """
+    Pre-compressed copy of a blob (gzip/zstd sidecar), served to clients that accept it.
+    Lives next to the blob and goes with it. See files/precompress.py.
+    """
+    ENCODING_CHOICES = [
+        ('zstd', 'zstd'),
+        ('gzip', 'gzip'),
+    ]
+
+    blob = models.ForeignKey(Blob, on_delete=models.CASCADE, related_name='encodings')
+    encoding = models.CharField(max_length=10, choices=ENCODING_CHOICES)
+    file = models.FileField(max_length=255)
+    size = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ['blob', 'encoding']
+
+    def __str__(self):
+        return f"{self.blob_id}.{self.encoding}"
+
 def thumbnail_directory_path(instance, filename):
     return 'users/{0}/thumbnails/{1}'.format(instance.user.id, filename)
 
+def thumbnail_variant_directory_path(instance, filename):
+    return 'users/{0}/thumbnails/{1}'.format(instance.file_item.user_id, filename)
+
 def version_directory_path(instance, filename):
     return 'users/{0}/versions/{1}/{2}'.format(instance.file_item.user.id, instance.file_item.id, filename)
 
@@ -37,14 +81,23 @@ class File(models.Model):
         ('FILE', 'File'),
     ]
 
+    THUMBNAIL_STATUS_CHOICES = [
+        ('PENDING', 'Pending'),
+        ('READY', 'Ready'),
+        ('FAILED', 'Failed'),
+    ]
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='files')
     file = models.FileField(upload_to=user_directory_path, null=True, blank=True)
     thumbnail = models.ImageField(upload_to=thumbnail_directory_path, null=True, blank=True)
+    thumbnail_status = models.CharField(max_length=10, choices=THUMBNAIL_STATUS_CHOICES, null=True, blank=True, db_index=True) # Set for photos, see files/thumbnails.py
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, null=True, blank=True, related_name='files') # file.name == blob.file.name when set
     
     name = models.CharField(max_length=255)
     size = models.BigIntegerField(default=0)
     mime_type = models.CharField(max_length=100, blank=True, null=True)
+    sha256 = models.CharField(max_length=64, blank=True, null=True, db_index=True) # Hash-tree digest, see files/hashing.py
     file_type = models.CharField(max_length=10, choices=FILE_TYPE_CHOICES, default='FILE', db_index=True)
     
     # Advanced Organization
@@ -62,9 +115,21 @@ class File(models.Model):
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored size so the storage ledger can charge only the difference on save
+        instance._loaded_size = instance.size if 'size' in field_names else None
+        # and the stored content, so replacing it re-renders the thumbnail
+        instance._loaded_file = instance.file.name if 'file' in field_names else None
+        # and the timestamp that keys its cached thumbnails, so a save can drop them
+        instance._loaded_updated_at = instance.updated_at if 'updated_at' in field_names else None
+        return instance
+
     def delete(self, *args, **kwargs):
         # Delete the file from the filesystem
-        if self.file:
+        # (blob-backed content is shared, its reference is dropped in the post_delete signal instead)
+        if self.file and not self.blob_id:
             self.file.delete(save=False)
         if self.thumbnail:
             self.thumbnail.delete(save=False)
@@ -73,7 +138,9 @@ class File(models.Model):
 class FileVersion(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     file_item = models.ForeignKey(File, on_delete=models.CASCADE, related_name='versions')
-    file = models.FileField(upload_to=version_directory_path)
+    file = models.FileField(upload_to=version_directory_path, blank=True) # Empty once stored as delta chunks
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, null=True, blank=True, related_name='versions')
+    sha256 = models.CharField(max_length=64, blank=True, null=True) # Digest of the version's content (kept after delta compaction)
     version_number = models.IntegerField()
     size = models.BigIntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
@@ -81,9 +148,76 @@ class FileVersion(models.Model):
     class Meta:
         ordering = ['-version_number']
 
+    @property
+    def is_delta(self):
+        return not self.blob_id and not self.file
+
     def __str__(self):
         return f"{self.file_item.name} v{self.version_number}"
 
+class ThumbnailVariant(models.Model):
+    """
+    One size/format of a photo's thumbnail pyramid (see files/thumbnails.py).
+    The 320px JPEG isn't one of these, it is File.thumbnail itself.
+    """
+    FORMAT_CHOICES = [
+        ('jpeg', 'JPEG'),
+        ('webp', 'WebP'),
+        ('avif', 'AVIF'),
+    ]
+
+    file_item = models.ForeignKey(File, on_delete=models.CASCADE, related_name='thumbnail_variants')
+    size = models.PositiveSmallIntegerField() # Bounding box edge in px, not bytes
+    format = models.CharField(max_length=10, choices=FORMAT_CHOICES)
+    file = models.FileField(upload_to=thumbnail_variant_directory_path, max_length=255)
+
+    class Meta:
+        unique_together = ['file_item', 'size', 'format']
+
+    def __str__(self):
+        return f"{self.file_item_id} {self.size}px {self.format}"
+
+class PhotoMetadata(models.Model):
+    """
+    What a photo's EXIF says (capture time, camera, size, GPS), read by the same
+    pass that renders its thumbnails (files/thumbnails.py), so timelines can sort
+    and filter without reopening files. Photos without EXIF still get a row.
+    """
+    file_item = models.OneToOneField(File, on_delete=models.CASCADE, primary_key=True, related_name='photo_metadata')
+    taken_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    width = models.PositiveIntegerField(null=True, blank=True) # As displayed, after orientation
+    height = models.PositiveIntegerField(null=True, blank=True)
+    orientation = models.PositiveSmallIntegerField(default=1)
+    camera_make = models.CharField(max_length=100, blank=True, null=True)
+    camera_model = models.CharField(max_length=100, blank=True, null=True, db_index=True)
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    altitude = models.FloatField(null=True, blank=True)
+    extracted_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['latitude', 'longitude'])]
+
+    def __str__(self):
+        return f"{self.file_item_id} taken {self.taken_at}"
+
+class FileVersionChunk(models.Model):
+    """
+    One content-defined chunk of a delta-stored FileVersion, in order.
+    Chunks are blobs, so consecutive versions share every unchanged one. See files/delta.py.
+    """
+    id = models.BigAutoField(primary_key=True) # Lots of rows: one per ~256 KB of every version
+    version = models.ForeignKey(FileVersion, on_delete=models.CASCADE, related_name='chunks')
+    position = models.IntegerField()
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, related_name='version_chunks')
+
+    class Meta:
+        unique_together = ['version', 'position']
+        ordering = ['position']
+
+    def __str__(self):
+        return f"{self.version} #{self.position}"
+
 class ChunkedUpload(models.Model):
     STATUS_CHOICES = [
         ('INIT', 'Initialized'),
@@ -96,14 +230,67 @@ class ChunkedUpload(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='chunked_uploads')
     filename = models.CharField(max_length=255)
     file_size = models.BigIntegerField()
+    chunk_size = models.BigIntegerField(default=5 * 1024 * 1024) # Chunk N is written at offset N * chunk_size
     mime_type = models.CharField(max_length=100, blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
-    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='INIT')
+    last_activity_at = models.DateTimeField(null=True, blank=True) # Last chunk received, used by the reaper
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='INIT', db_index=True)
+
+    # Manifest of received chunks: bit N set => chunk N is on disk
+    received_chunks = models.BinaryField(default=b'', blank=True)
     
-    # Checksum for verification (optional but good)
-    # sha256 = models.CharField(max_length=64, null=True, blank=True)
+    # Checksum for verification: client may send the expected digest at init, replaced by the computed one on completion
+    sha256 = models.CharField(max_length=64, null=True, blank=True)
 
     completed_file = models.ForeignKey(File, on_delete=models.SET_NULL, null=True, blank=True, related_name='upload_session')
+    error = models.TextField(blank=True, null=True) # Why finalization failed (async mode has no response to put it in)
+
+    @property
+    def total_chunks(self):
+        return -(-self.file_size // self.chunk_size) # ceil division
 
     def __str__(self):
         return f"{self.filename} ({self.status})"
+
+class ChunkedUploadPart(models.Model):
+    """One received chunk with the SHA-256 leaves of the blocks it covers."""
+    upload = models.ForeignKey(ChunkedUpload, on_delete=models.CASCADE, related_name='parts')
+    chunk_index = models.IntegerField()
+    size = models.BigIntegerField()
+    block_digests = models.BinaryField()
+    received_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['upload', 'chunk_index']
+        ordering = ['chunk_index']
+
+    def __str__(self):
+        return f"{self.upload_id} #{self.chunk_index}"
+
+class StorageUsage(models.Model):
+    """
+    Denormalized per-user storage ledger, kept in step by files/signals.py and files/quota.py.
+    used_bytes covers File and FileVersion sizes, reserved_bytes covers in-flight chunked uploads.
+    Rebuild with `manage.py reconcile_storage`.
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True, related_name='storage_usage')
+    used_bytes = models.BigIntegerField(default=0)
+    reserved_bytes = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user} ({self.used_bytes} used, {self.reserved_bytes} reserved)"
+
+class DownloadBudget(models.Model):
+    """
+    Per-user download shaping state shared by every worker, see files/bandwidth.py.
+    Changed only by single conditional UPDATEs or under select_for_update, so it's exact on any database.
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True, related_name='download_budget')
+    streams = models.PositiveIntegerField(default=0) # Downloads in progress
+    streams_changed_at = models.DateTimeField(null=True, blank=True) # Lease: slots leaked by killed workers expire
+    tokens = models.FloatField(default=0) # Token bucket, bytes (negative while in debt)
+    refilled_at = models.FloatField(default=0) # Unix time of the last charge; 0 means a full bucket
+
+    def __str__(self):
+        return f"{self.user} ({self.streams} streams)"
@@ -0,0 +1,125 @@
+import gzip
+import os
+import tempfile
+import zstandard
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from .models import Blob, BlobEncoding
+from .utils import is_compressible_mime
+from . import blobs
+
+# Pre-compressed transfer variants.
+# Text-heavy documents get zstd and gzip sidecars next to their blob, built
+# once in the background after upload. Downloads then pick the best encoding
+# the client accepts and send the sidecar as-is, no compression on the request path.
+
+COMPRESSIBLE_CATEGORIES = {'DOCUMENT', 'FINANCE', 'MEDICAL'}
+
+# Below this the headers cost more than compression saves
+DEFAULT_MIN_SIZE = 1024
+
+# Sidecars that don't get below this fraction of the original aren't kept
+MAX_RATIO = 0.9
+
+_READ_SIZE = 1024 * 1024
+
+SUFFIXES = {'zstd': '.zst', 'gzip': '.gz'}
+
+
+# Best first
+ENCODINGS = ['zstd', 'gzip']
+
+
+def should_compress(file_obj):
+    min_size = getattr(settings, 'PRECOMPRESS_MIN_SIZE', DEFAULT_MIN_SIZE)
+    return (
+        bool(file_obj.blob_id)
+        and file_obj.category in COMPRESSIBLE_CATEGORIES
+        and file_obj.size >= min_size
+        and is_compressible_mime(file_obj.mime_type)
+    )
+
+
+def _compress(src, dest, encoding):
+    if encoding == 'gzip':
+        # mtime=0: same input, same bytes, so the sidecar is reproducible
+        with gzip.GzipFile(fileobj=dest, mode='wb', compresslevel=6, mtime=0) as out:
+            while data := src.read(_READ_SIZE):
+                out.write(data)
+    else:
+        compressor = zstandard.ZstdCompressor(level=10)
+        compressor.copy_stream(src, dest, read_size=_READ_SIZE)
+
+
+def build_sidecars(blob_id):
+    """
+    Create the missing sidecars for a blob. Safe to re-run and to race, the unique
+    (blob, encoding) constraint keeps one row each. Returns the encodings created.
+    """
+    blob = Blob.objects.filter(pk=blob_id).first()
+    if blob is None:
+        return []
+    have = set(blob.encodings.values_list('encoding', flat=True))
+    scratch = os.path.join(settings.MEDIA_ROOT, 'tmp')
+    os.makedirs(scratch, exist_ok=True)
+    created = []
+    for encoding in ENCODINGS:
+        if encoding in have:
+            continue
+        with tempfile.NamedTemporaryFile(dir=scratch, delete=False) as out:
+            with blob.file.open('rb') as src:
+                _compress(src, out, encoding)
+            size = out.tell()
+        if size > blob.size * MAX_RATIO:
+            os.remove(out.name)
+            continue
+        name = blob.file.name + SUFFIXES[encoding]
+        blobs.place_local_file(out.name, name)
+        try:
+            with transaction.atomic():
+                BlobEncoding.objects.create(blob=blob, encoding=encoding, file=name, size=size)
+        except IntegrityError:
+            continue # Someone else finished first, their file is at the same name
+        created.append(encoding)
+    return created
+
+
+def parse_accept_encoding(header):
+    """{coding: q} from an Accept-Encoding header."""
+    accepted = {}
+    for item in (header or '').split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def negotiate(request, file_obj):
+    """
+    Best sidecar (BlobEncoding) for this request, or None to send the original bytes.
+    Client q-values win, the server's order (zstd before gzip) breaks ties.
+    """
+    if not file_obj.blob_id:
+        return None
+    accepted = parse_accept_encoding(request.headers.get('Accept-Encoding'))
+    if not accepted:
+        return None
+    sidecars = {s.encoding: s for s in BlobEncoding.objects.filter(blob_id=file_obj.blob_id)}
+    best = None
+    for encoding in ENCODINGS:
+        if encoding not in sidecars:
+            continue
+        q = accepted.get(encoding, accepted.get('*', 0.0))
+        if q > 0 and (best is None or q > best[0]):
+            best = (q, sidecars[encoding])
+    return best[1] if best else None
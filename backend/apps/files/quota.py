@@ -0,0 +1,75 @@
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from .models import File, FileVersion, ChunkedUpload, StorageUsage
+
+GB = 1024 * 1024 * 1024
+
+
+def quota_bytes(user):
+    return user.storage_quota_gb * GB
+
+
+def compute_usage(user_id):
+    """Full recount from the tables. Only used to bootstrap or reconcile the ledger."""
+    files = File.objects.filter(user_id=user_id).aggregate(total=Sum('size'))['total'] or 0
+    versions = FileVersion.objects.filter(file_item__user_id=user_id).aggregate(total=Sum('size'))['total'] or 0
+    reserved = ChunkedUpload.objects.filter(
+        user_id=user_id, status__in=['INIT', 'PROCESSING']
+    ).aggregate(total=Sum('file_size'))['total'] or 0
+    return files + versions, reserved
+
+
+def get_usage(user):
+    """The user's ledger row, created from a one-off recount the first time it's needed."""
+    usage = StorageUsage.objects.filter(user_id=user.pk).first()
+    if usage is None:
+        used, reserved = compute_usage(user.pk)
+        usage, _ = StorageUsage.objects.get_or_create(
+            user_id=user.pk,
+            defaults={'used_bytes': used, 'reserved_bytes': reserved}
+        )
+    return usage
+
+
+def charge(user_id, delta):
+    """Add delta (may be negative) to used_bytes. Single UPDATE, safe under concurrency."""
+    if delta:
+        StorageUsage.objects.filter(user_id=user_id).update(
+            used_bytes=F('used_bytes') + delta, updated_at=timezone.now()
+        )
+
+
+def reserve(user, nbytes):
+    """
+    Hold nbytes of quota for an upload that hasn't been written yet.
+    Raises ValidationError if it wouldn't fit, before any bytes are sent.
+    """
+    get_usage(user)
+    with transaction.atomic():
+        usage = StorageUsage.objects.select_for_update().get(user_id=user.pk)
+        if usage.used_bytes + usage.reserved_bytes + nbytes > quota_bytes(user):
+            raise ValidationError({"detail": "Storage quota exceeded."})
+        usage.reserved_bytes = F('reserved_bytes') + nbytes
+        usage.save(update_fields=['reserved_bytes', 'updated_at'])
+
+
+def release(user_id, nbytes):
+    """Drop a reservation (upload finished, failed or was reaped)."""
+    if nbytes:
+        StorageUsage.objects.filter(user_id=user_id).update(
+            reserved_bytes=F('reserved_bytes') - nbytes, updated_at=timezone.now()
+        )
+
+
+def reconcile(user):
+    """Rebuild one user's counters from the tables. Returns (old_used, new_used, old_reserved, new_reserved)."""
+    with transaction.atomic():
+        usage, _ = StorageUsage.objects.select_for_update().get_or_create(user_id=user.pk)
+        used, reserved = compute_usage(user.pk)
+        old = (usage.used_bytes, usage.reserved_bytes)
+        usage.used_bytes = used
+        usage.reserved_bytes = reserved
+        usage.save()
+    return old[0], used, old[1], reserved
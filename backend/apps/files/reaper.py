@@ -0,0 +1,123 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from .models import ChunkedUpload
+from . import chunked, quota, tasks
+
+# Abandoned chunked-upload sessions leave a (sparse) target file under
+# MEDIA_ROOT/chunk_uploads/<upload_id>/ and a quota reservation behind.
+# The reaper expires them, frees the scratch space and releases the quota.
+
+DEFAULT_IDLE_HOURS = 24         # no chunk received for this long
+DEFAULT_MAX_AGE_DAYS = 7        # or the session is simply this old
+DEFAULT_PROCESSING_HOURS = 1    # PROCESSING this long means the worker died (finalize is a rename)
+DEFAULT_INTERVAL = 60 * 60      # periodic in-process run, seconds (0 disables)
+ORPHAN_GRACE_SECONDS = 60 * 60
+
+
+def scratch_root():
+    return os.path.join(settings.MEDIA_ROOT, 'chunk_uploads')
+
+
+def _disk_usage(path):
+    """(apparent bytes, allocated bytes) under path. Targets are sparse, so these differ a lot."""
+    apparent = allocated = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.stat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            apparent += st.st_size
+            allocated += st.st_blocks * 512 if hasattr(st, 'st_blocks') else st.st_size
+    return apparent, allocated
+
+
+def scratch_usage():
+    """Current scratch-space usage, for the stats endpoint and alerting."""
+    root = scratch_root()
+    sessions = len(os.listdir(root)) if os.path.isdir(root) else 0
+    apparent, allocated = _disk_usage(root) if sessions else (0, 0)
+    return {
+        'sessions_on_disk': sessions,
+        'open_sessions': ChunkedUpload.objects.filter(status__in=['INIT', 'PROCESSING']).count(),
+        'apparent_bytes': apparent,
+        'allocated_bytes': allocated,
+    }
+
+
+def find_expired(idle_hours=None, max_age_days=None, processing_hours=None, now=None):
+    now = now or timezone.now()
+    idle = timedelta(hours=idle_hours if idle_hours is not None else getattr(settings, 'CHUNK_UPLOAD_IDLE_HOURS', DEFAULT_IDLE_HOURS))
+    max_age = timedelta(days=max_age_days if max_age_days is not None else getattr(settings, 'CHUNK_UPLOAD_MAX_AGE_DAYS', DEFAULT_MAX_AGE_DAYS))
+    processing = timedelta(hours=processing_hours if processing_hours is not None else getattr(settings, 'CHUNK_UPLOAD_PROCESSING_HOURS', DEFAULT_PROCESSING_HOURS))
+
+    return ChunkedUpload.objects.annotate(
+        last_seen=Coalesce('last_activity_at', 'created_at')
+    ).filter(
+        Q(status='INIT', last_seen__lt=now - idle) |
+        Q(status='INIT', created_at__lt=now - max_age) |
+        Q(status='PROCESSING', last_seen__lt=now - processing)
+    )
+
+
+def _remove(path):
+    _, allocated = _disk_usage(path)
+    shutil.rmtree(path, ignore_errors=True)
+    return allocated
+
+
+def reap(dry_run=False, workers=4, **thresholds):
+    """
+    Expire stale sessions and delete their scratch directories in parallel,
+    plus any directory with no open session behind it.
+    Returns {'sessions', 'orphans', 'freed_bytes'}.
+    """
+    expired = list(find_expired(**thresholds).values_list('upload_id', 'status', 'user_id', 'file_size'))
+    doomed = []
+    for upload_id, old_status, user_id, file_size in expired:
+        if dry_run:
+            doomed.append(chunked.session_dir(upload_id))
+            continue
+        # Conditional flip, a chunk or completion that sneaks in first wins
+        if ChunkedUpload.objects.filter(upload_id=upload_id, status=old_status).update(status='FAILED', error='Upload session expired') == 1:
+            quota.release(user_id, file_size)
+            doomed.append(chunked.session_dir(upload_id))
+
+    # Directories left behind by sessions that are already finished (or rows that no longer exist)
+    orphans = []
+    root = scratch_root()
+    if os.path.isdir(root):
+        open_ids = {str(u) for u in ChunkedUpload.objects.filter(status__in=['INIT', 'PROCESSING']).values_list('upload_id', flat=True)}
+        doomed_set = set(doomed)
+        # Grace period so a session whose row isn't committed yet doesn't look orphaned
+        cutoff = timezone.now().timestamp() - ORPHAN_GRACE_SECONDS
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if name not in open_ids and path not in doomed_set and os.path.getmtime(path) < cutoff:
+                orphans.append(path)
+
+    targets = [p for p in doomed + orphans if os.path.exists(p)]
+    if dry_run:
+        freed = sum(_disk_usage(p)[1] for p in targets)
+    else:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            freed = sum(pool.map(_remove, targets))
+
+    return {'sessions': len(expired) if dry_run else len(doomed), 'orphans': len(orphans), 'freed_bytes': freed}
+
+
+def _periodic_reap():
+    result = reap()
+    if result['sessions'] or result['orphans']:
+        print(f"Upload reaper: expired {result['sessions']} sessions, {result['orphans']} orphans, freed {result['freed_bytes']} bytes")
+
+
+def start():
+    """Start the periodic reaper in this process (called from core/wsgi.py and core/asgi.py)."""
+    tasks.run_every(getattr(settings, 'CHUNK_UPLOAD_REAPER_INTERVAL', DEFAULT_INTERVAL), _periodic_reap, 'upload-reaper')
@@ -1,10 +1,17 @@
+from django.urls import reverse
 from rest_framework import serializers
-from .models import File, FileVersion
+from .models import File, FileVersion, PhotoMetadata
+from . import downloads, signed
 
 class FileVersionSerializer(serializers.ModelSerializer):
     class Meta:
         model = FileVersion
-        fields = ['id', 'version_number', 'created_at', 'size'] # Expose download link if needed, or assume standard download by ID? Maybe not file url directly.
+        fields = ['id', 'version_number', 'created_at', 'size', 'is_delta'] # Expose download link if needed, or assume standard download by ID? Maybe not file url directly.
+
+class PhotoMetadataSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PhotoMetadata
+        fields = ['taken_at', 'width', 'height', 'orientation', 'camera_make', 'camera_model', 'latitude', 'longitude', 'altitude']
 
 class TagSerializer(serializers.ModelSerializer):
     class Meta:
@@ -17,12 +24,17 @@ class FileSerializer(serializers.ModelSerializer):
     # Actually, let's make it writable.
     tags = serializers.SerializerMethodField()
     versions = FileVersionSerializer(many=True, read_only=True)
+    thumbnail_url = serializers.SerializerMethodField()
+    signed_url = serializers.SerializerMethodField()
+    signed_thumbnail_url = serializers.SerializerMethodField()
+    photo_metadata = serializers.SerializerMethodField()
 
     class Meta:
         model = File
-        fields = ['id', 'name', 'size', 'mime_type', 'created_at', 'updated_at', 'file',
-                  'parent', 'is_folder', 'is_favorite', 'category', 'metadata', 'tags', 'file_type', 'thumbnail', 'versions']
-        read_only_fields = ['id', 'created_at', 'updated_at', 'size', 'mime_type']
+        fields = ['id', 'name', 'size', 'mime_type', 'sha256', 'created_at', 'updated_at', 'file',
+                  'parent', 'is_folder', 'is_favorite', 'category', 'metadata', 'tags', 'file_type', 'thumbnail', 'thumbnail_status', 'thumbnail_url',
+                  'signed_url', 'signed_thumbnail_url', 'photo_metadata', 'versions']
+        read_only_fields = ['id', 'created_at', 'updated_at', 'size', 'mime_type', 'sha256', 'thumbnail_status']
         extra_kwargs = {
             'name': {'required': False},
             'file': {'required': False},
@@ -32,6 +44,25 @@ class FileSerializer(serializers.ModelSerializer):
         # Simple list of tag objects or names
         return [{'id': tag.id, 'name': tag.name, 'color': tag.color} for tag in obj.tags.all()]
 
+    def get_thumbnail_url(self, obj):
+        # Versioned URL, safe for the browser to cache forever
+        if not obj.thumbnail:
+            return None
+        url = reverse('file-download', args=[obj.id])
+        return f"{url}?variant=thumbnail&v={downloads.thumbnail_token(obj)}"
+
+    def get_signed_url(self, obj):
+        # Short-lived links served without auth or DB lookups, see files/signed.py
+        return signed.signed_url(obj)
+
+    def get_signed_thumbnail_url(self, obj):
+        return signed.signed_url(obj, 'thumbnail')
+
+    def get_photo_metadata(self, obj):
+        # EXIF read by the thumbnail pass, null until then and for non-photos
+        metadata = getattr(obj, 'photo_metadata', None) if obj.file_type == 'PHOTO' else None
+        return PhotoMetadataSerializer(metadata).data if metadata is not None else None
+
     def create(self, validated_data):
         # We handle file metadata extraction in the view, but if needed here:
         # The view will pass 'user', 'name', 'size', 'mime_type' explicitly if not read_only
@@ -1,54 +1,105 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from .models import File
-from PIL import Image
-from io import BytesIO
-from django.core.files.base import ContentFile
-import os
+from .models import File, FileVersion, FileVersionChunk, ThumbnailVariant
+from . import quota, blobs, precompress, tasks, thumbcache, thumbnails
+from django.db import transaction
+
+# --- Thumbnails ---
+# Rendered on worker processes once the File is committed, see thumbnails.py.
 
 @receiver(post_save, sender=File)
-def generate_thumbnail(sender, instance, created, **kwargs):
-    if not instance.file:
+def queue_thumbnail(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and not {'file', 'file_type'} & set(update_fields):
+        return # e.g. the thumbnail itself being saved
+    loaded = getattr(instance, '_loaded_file', None)
+    instance._loaded_file = instance.file.name
+    replaced = not created and loaded is not None and loaded != instance.file.name
+    # A render already in flight sees the new content when it stores, and starts over
+    if not thumbnails.needs_thumbnail(instance, replaced) or instance.thumbnail_status == 'PENDING':
         return
-        
-    # Only process photos
-    if instance.file_type != 'PHOTO':
+    thumbnails.mark_pending(instance)
+    transaction.on_commit(lambda: thumbnails.queue(instance))
+
+@receiver(post_delete, sender=ThumbnailVariant)
+def delete_thumbnail_variant_file(sender, instance, **kwargs):
+    # Pyramid files belong to their row alone, whether it goes with its File or on regeneration
+    if instance.file:
+        instance.file.delete(save=False)
+
+
+# --- Storage ledger ---
+# Every write to File.size / FileVersion goes through these, so the per-user
+# counter stays in step no matter which code path created the row.
+
+@receiver(post_save, sender=File)
+def charge_file(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and 'size' not in update_fields:
         return
+    previous = 0 if created else getattr(instance, '_loaded_size', None)
+    if previous is None:
+        # Instance wasn't loaded from the DB, we can't know what it replaced
+        return
+    quota.charge(instance.user_id, (instance.size or 0) - previous)
+    instance._loaded_size = instance.size
+
+@receiver(post_delete, sender=File)
+def refund_file(sender, instance, **kwargs):
+    quota.charge(instance.user_id, -(getattr(instance, '_loaded_size', None) or instance.size or 0))
+
+@receiver(post_save, sender=FileVersion)
+def charge_version(sender, instance, created, **kwargs):
+    if created:
+        quota.charge(instance.file_item.user_id, instance.size)
+
+@receiver(post_delete, sender=FileVersion)
+def refund_version(sender, instance, **kwargs):
+    # Cascade deletes run before the parent File row goes, so the owner is still there to look up
+    user_id = File.objects.filter(pk=instance.file_item_id).values_list('user_id', flat=True).first()
+    if user_id:
+        quota.charge(user_id, -instance.size)
+
 
-    # Prevent infinite loop if we are saving the thumbnail
-    # If thumbnail already exists, skip (unless we want to regenerate on update, but keep simple)
-    if instance.thumbnail:
+# --- Blob references ---
+# Post-delete so queryset and cascade deletes (folders, users) release their blobs too.
+
+@receiver(post_delete, sender=File)
+def release_file_blob(sender, instance, **kwargs):
+    if instance.blob_id:
+        blobs.release(instance.blob_id)
+
+@receiver(post_delete, sender=FileVersion)
+def release_version_blob(sender, instance, **kwargs):
+    if instance.blob_id:
+        blobs.release(instance.blob_id)
+
+@receiver(post_delete, sender=FileVersionChunk)
+def release_version_chunk_blob(sender, instance, **kwargs):
+    blobs.release(instance.blob_id)
+
+
+# --- Pre-compressed sidecars ---
+
+@receiver(post_save, sender=File)
+def queue_precompress(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not {'blob', 'file', 'category', 'mime_type'} & set(update_fields):
+        return # e.g. the thumbnail being saved
+    if precompress.should_compress(instance):
+        blob_id = instance.blob_id
+        transaction.on_commit(lambda: tasks.submit(precompress.build_sidecars, blob_id))
+
+
+# --- Thumbnail cache ---
+# Entries are keyed by updated_at, so nobody asks for the old ones again once it
+# moves; this frees them right away, here and in the shared tier.
+
+@receiver(post_save, sender=File)
+def invalidate_thumbnail_cache(sender, instance, created, **kwargs):
+    loaded = getattr(instance, '_loaded_updated_at', None)
+    instance._loaded_updated_at = instance.updated_at
+    if created or loaded is None or loaded == instance.updated_at:
         return
+    thumbcache.invalidate(instance, loaded)
 
-    try:
-        # Open the original file
-        # We need to open it carefully depending on storage backend (local vs cloud)
-        # For local, .path or .open() works.
-        
-        with instance.file.open('rb') as f:
-            t_image = Image.open(f)
-            
-            # Convert to RGB if needed (e.g. PNG with alpha)
-            if t_image.mode in ('RGBA', 'LA'):
-                fill_color = (255, 255, 255) # White background
-                background = Image.new(t_image.mode[:-1], t_image.size, fill_color)
-                background.paste(t_image, t_image.split()[-1])
-                t_image = background
-            
-            # Resize
-            t_image.thumbnail((300, 300))
-            
-            # Save to buffer
-            thumb_io = BytesIO()
-            t_image.save(thumb_io, format='JPEG', quality=85)
-            
-            # Create filename
-            file_name, ext = os.path.splitext(os.path.basename(instance.file.name))
-            thumb_filename = f"{file_name}_thumb.jpg"
-            
-            # Save to model
-            instance.thumbnail.save(thumb_filename, ContentFile(thumb_io.getvalue()), save=False)
-            instance.save(update_fields=['thumbnail'])
-            
-    except Exception as e:
-        print(f"Error generating thumbnail for {instance.id}: {e}")
+@receiver(post_delete, sender=File)
+def drop_cached_thumbnail(sender, instance, **kwargs):
+    thumbcache.invalidate(instance)
@@ -0,0 +1,63 @@
+import time
+from django.conf import settings
+from django.core import signing
+from django.urls import reverse
+
+# Pre-signed download URLs.
+# The token carries everything needed to serve the bytes (owner, file id, variant,
+# storage name, expiry) under an HMAC keyed by SECRET_KEY, so the signed view
+# checks the signature and streams: no JWT, no User or File query.
+# Anyone holding the URL can fetch the file until it expires, keep the TTL short.
+
+SALT = 'files.signed-download'
+
+DEFAULT_TTL = 3600
+
+# Expiries are rounded up to this, so a file's URL stays the same for a while
+# and browsers/CDNs can reuse their cached copy across page loads
+EXPIRY_BUCKET = 600
+
+
+class ExpiredToken(signing.BadSignature):
+    pass
+
+
+def get_ttl():
+    return getattr(settings, 'SIGNED_DOWNLOAD_TTL', DEFAULT_TTL)
+
+
+def make_token(file_obj, variant=None, ttl=None, now=None):
+    """Token for a File's original (variant=None) or thumbnail. None when there's nothing to serve."""
+    field_file = file_obj.thumbnail if variant == 'thumbnail' else file_obj.file
+    if not field_file:
+        return None
+    now = now or time.time()
+    expires = int(now + (ttl or get_ttl()))
+    expires += -expires % EXPIRY_BUCKET
+    payload = {
+        'u': str(file_obj.user_id),
+        'f': str(file_obj.pk),
+        'v': variant or '',
+        'p': field_file.name,
+        'n': f"thumb_{file_obj.name}" if variant == 'thumbnail' else file_obj.name,
+        'e': expires,
+    }
+    if variant == 'thumbnail':
+        # Lets the signed view use the thumbnail cache without loading the File
+        payload['t'] = file_obj.updated_at.isoformat()
+    return signing.dumps(payload, salt=SALT, compress=True)
+
+
+def load_token(token, now=None):
+    """Payload of a valid, unexpired token. Raises BadSignature (or ExpiredToken) otherwise."""
+    payload = signing.loads(token, salt=SALT)
+    if payload['e'] < (now or time.time()):
+        raise ExpiredToken("Download link expired")
+    return payload
+
+
+def signed_url(file_obj, variant=None, ttl=None):
+    token = make_token(file_obj, variant, ttl)
+    if token is None:
+        return None
+    return reverse('file-signed-download', args=[token])
@@ -0,0 +1,73 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+
+# Local background worker pool for slow file work (upload finalization etc).
+# Lives inside each gunicorn/uvicorn worker process, no broker needed.
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'FILES_WORKER_THREADS', 4),
+                thread_name_prefix='files-worker'
+            )
+    return _executor
+
+
+def _run(fn, args, kwargs):
+    # Worker threads get their own DB connections, make sure they don't go stale
+    close_old_connections()
+    try:
+        return fn(*args, **kwargs)
+    except Exception as e:
+        print(f"Background task {fn.__name__} failed: {e}")
+        raise
+    finally:
+        close_old_connections()
+
+
+def submit(fn, *args, **kwargs):
+    """
+    Run fn in the background pool.
+    With FILES_TASKS_EAGER = True (tests, debugging) it runs inline instead.
+    """
+    if getattr(settings, 'FILES_TASKS_EAGER', False):
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            print(f"Background task {fn.__name__} failed: {e}")
+        return None
+    return get_executor().submit(_run, fn, args, kwargs)
+
+
+_periodic = {}
+
+
+def run_every(interval, fn, name=None):
+    """
+    Call fn every `interval` seconds on a daemon thread in this process.
+    Each name is only started once per process, jobs must tolerate running in several workers at once.
+    """
+    name = name or fn.__name__
+    with _executor_lock:
+        if name in _periodic or not interval:
+            return
+        stop = threading.Event()
+
+        def loop():
+            while not stop.wait(interval):
+                try:
+                    _run(fn, (), {})
+                except Exception:
+                    pass # already logged by _run, try again next round
+
+        thread = threading.Thread(target=loop, name=f'files-periodic-{name}', daemon=True)
+        _periodic[name] = stop
+        thread.start()
+    return stop
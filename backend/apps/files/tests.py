@@ -1,3 +1,1251 @@
-from django.test import TestCase
+import io
+import os
+import random
+import shutil
+import tempfile
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.core.management import call_command
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.urls import reverse
+from django.utils import timezone
+from datetime import timedelta
+from rest_framework.test import APIClient
+from rest_framework import status
+from .models import File, ChunkedUpload, StorageUsage, Blob, FileVersionChunk, PhotoMetadata, DownloadBudget
+from . import quota, delta, reaper, downloads, signed, bandwidth, thumbcache, thumbnails, imaging, thumbbench
+from . import chunked
+from .hashing import digest_stream
 
-# Create your tests here.
+User = get_user_model()
+
+MEDIA_ROOT = tempfile.mkdtemp()
+
+
+def tearDownModule():
+    shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+
+def jpeg(size=(500, 500), color='red', **save):
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new('RGB', size, color).save(buf, format='JPEG', **save)
+    return buf.getvalue()
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CONTENT_HASH_BLOCK_SIZE=5, FILES_TASKS_EAGER=True)
+class FilesTestCase(TestCase):
+    """An authenticated API client and upload helpers shared by the test cases below."""
+    user_fields = {}
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', password='password123', **self.user_fields)
+        self.client.force_authenticate(user=self.user)
+
+    def post_file(self, name, content, **data):
+        return self.client.post(reverse('file-list-create'), {
+            'file': SimpleUploadedFile(name, content), **data,
+        }, format='multipart')
+
+    def upload(self, name, content, **data):
+        # Runs the on-commit work (thumbnails, sidecars) before returning
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.post_file(name, content, **data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return File.objects.get(id=response.data['id'])
+
+
+class ChunkedUploadTests(FilesTestCase):
+    def init_upload(self, content, chunk_size, filename='data.bin', **extra):
+        response = self.client.post(reverse('upload-init'), {
+            'filename': filename,
+            'file_size': len(content),
+            'mime_type': 'application/octet-stream',
+            'chunk_size': chunk_size,
+            **extra,
+        })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['upload_id']
+
+    def send_chunk(self, upload_id, content, chunk_size, index):
+        data = content[index * chunk_size:(index + 1) * chunk_size]
+        return self.client.post(reverse('upload-chunk', args=[upload_id]), {
+            'file': SimpleUploadedFile('blob', data),
+            'chunk_index': index,
+        }, format='multipart')
+
+    def test_target_is_preallocated(self):
+        upload_id = self.init_upload(b'x' * 100, 10)
+        self.assertEqual(os.path.getsize(chunked.target_path(upload_id)), 100)
+
+    def test_out_of_order_chunks_are_written_in_place(self):
+        content = os.urandom(25)
+        upload_id = self.init_upload(content, 10)
+
+        for index in (2, 0, 1):
+            response = self.send_chunk(upload_id, content, 10, index)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.post(reverse('upload-complete', args=[upload_id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        file_obj = File.objects.get(id=response.data['id'])
+        with file_obj.file.open('rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertFalse(os.path.exists(chunked.session_dir(upload_id)))
+        self.assertEqual(ChunkedUpload.objects.get(upload_id=upload_id).status, 'COMPLETED')
+
+    def test_chunk_past_end_is_rejected(self):
+        content = b'y' * 20
+        upload_id = self.init_upload(content, 10)
+        response = self.client.post(reverse('upload-chunk', args=[upload_id]), {
+            'file': SimpleUploadedFile('blob', b'z' * 10),
+            'chunk_index': 2,
+        }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_status_reports_missing_chunks(self):
+        content = os.urandom(45)
+        upload_id = self.init_upload(content, 10)
+        for index in (0, 1, 3):
+            self.send_chunk(upload_id, content, 10, index)
+
+        response = self.client.get(reverse('upload-status', args=[upload_id]))
+        self.assertEqual(response.data['total_chunks'], 5)
+        self.assertEqual(response.data['received_chunks'], [[0, 1], [3, 3]])
+        self.assertEqual(response.data['missing_chunks'], [[2, 2], [4, 4]])
+        self.assertEqual(response.data['received_bytes'], 30)
+
+    def test_complete_rejects_incomplete_upload(self):
+        content = os.urandom(25)
+        upload_id = self.init_upload(content, 10)
+        self.send_chunk(upload_id, content, 10, 0)
+
+        response = self.client.post(reverse('upload-complete', args=[upload_id]))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['missing_chunks'], [[1, 2]])
+
+    def test_digest_is_built_from_chunk_leaves(self):
+        content = os.urandom(37)
+        upload_id = self.init_upload(content, 10)
+        for index in (3, 1, 0, 2):
+            self.send_chunk(upload_id, content, 10, index)
+
+        response = self.client.post(reverse('upload-complete', args=[upload_id]))
+        # Same digest as hashing the whole stream in one pass, whatever the chunking
+        self.assertEqual(response.data['sha256'], digest_stream([content]))
+
+    def test_received_chunk_is_never_rewritten(self):
+        content = os.urandom(20)
+        upload_id = self.init_upload(content, 10)
+        self.send_chunk(upload_id, content, 10, 0)
+
+        # Other bytes for a chunk that already landed would no longer match its recorded leaves
+        response = self.send_chunk(upload_id, b'EVILEVILEV' + content[10:], 10, 0)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        # A retry of the same bytes is fine
+        self.assertEqual(self.send_chunk(upload_id, content, 10, 0).status_code, status.HTTP_200_OK)
+        self.send_chunk(upload_id, content, 10, 1)
+
+        response = self.client.post(reverse('upload-complete', args=[upload_id]))
+        file_obj = File.objects.get(id=response.data['id'])
+        self.assertEqual(file_obj.sha256, digest_stream([content]))
+        with file_obj.file.open('rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_chunk_racing_completion_is_refused(self):
+        from unittest import mock
+        content = os.urandom(20)
+        upload_id = self.init_upload(content, 10)
+        self.send_chunk(upload_id, content, 10, 0)
+        self.send_chunk(upload_id, content, 10, 1)
+
+        # /complete lands after the chunk passed validation, before it's written
+        hash_chunk = chunked.hash_chunk
+        def complete_first(chunk):
+            self.assertTrue(chunked.begin_processing(upload_id))
+            chunked.finalize(upload_id)
+            return hash_chunk(chunk)
+        with mock.patch.object(chunked, 'hash_chunk', side_effect=complete_first):
+            response = self.send_chunk(upload_id, content, 10, 0)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        file_obj = ChunkedUpload.objects.get(upload_id=upload_id).completed_file
+        with file_obj.file.open('rb') as f:
+            self.assertEqual(f.read(), content)
+
+        # Same when the session expires and its scratch directory goes
+        upload_id = self.init_upload(content, 10)
+        def expire_first(chunk):
+            ChunkedUpload.objects.filter(upload_id=upload_id).update(status='FAILED')
+            shutil.rmtree(chunked.session_dir(upload_id))
+            return hash_chunk(chunk)
+        with mock.patch.object(chunked, 'hash_chunk', side_effect=expire_first):
+            response = self.send_chunk(upload_id, content, 10, 1)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_checksum_mismatch_fails_upload(self):
+        content = os.urandom(20)
+        upload_id = self.init_upload(content, 10, sha256='0' * 64)
+        for index in (0, 1):
+            self.send_chunk(upload_id, content, 10, index)
+
+        response = self.client.post(reverse('upload-complete', args=[upload_id]))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(ChunkedUpload.objects.get(upload_id=upload_id).status, 'FAILED')
+
+    def test_sync_long_poll_is_capped(self):
+        import time
+        upload_id = self.init_upload(b'x' * 20, 10)
+        ChunkedUpload.objects.filter(upload_id=upload_id).update(status='PROCESSING')
+        started = time.monotonic()
+        response = self.client.get(reverse('upload-status', args=[upload_id]), {'wait': 30})
+        self.assertEqual(response.data['status'], 'PROCESSING')
+        self.assertLess(time.monotonic() - started, chunked.MAX_SYNC_LONG_POLL_SECONDS + 1)
+
+    def test_unaligned_chunk_size_is_rejected(self):
+        response = self.client.post(reverse('upload-init'), {
+            'filename': 'data.bin', 'file_size': 20, 'chunk_size': 7,
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_async_complete_returns_202_and_status_reports_file(self):
+        content = os.urandom(20)
+        upload_id = self.init_upload(content, 10)
+        for index in (0, 1):
+            self.send_chunk(upload_id, content, 10, index)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('upload-complete', args=[upload_id]) + '?async=true')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], 'PROCESSING')
+
+        response = self.client.get(response.data['status_url'], {'wait': 1})
+        self.assertEqual(response.data['status'], 'COMPLETED')
+        self.assertIsNotNone(response.data['completed_file'])
+        self.assertEqual(response.data['file']['size'], 20)
+
+
+class StorageLedgerTests(FilesTestCase):
+    user_fields = {'storage_quota_gb': 1}
+
+    def test_upload_overwrite_and_delete_keep_ledger_in_step(self):
+        self.upload('notes.txt', b'a' * 100)
+        self.assertEqual(quota.get_usage(self.user).used_bytes, 100)
+
+        # Overwrite archives the old 100 bytes as a version and adds the new 40
+        self.upload('notes.txt', b'b' * 40)
+        self.assertEqual(quota.get_usage(self.user).used_bytes, 140)
+        self.assertEqual(quota.get_usage(self.user).reserved_bytes, 0)
+
+        File.objects.get(user=self.user, name='notes.txt').delete()
+        self.assertEqual(quota.get_usage(self.user).used_bytes, 0)
+
+    def test_chunked_init_reserves_and_rejects_over_quota(self):
+        response = self.client.post(reverse('upload-init'), {
+            'filename': 'big.bin', 'file_size': quota.GB - 10, 'chunk_size': 10,
+        })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(quota.get_usage(self.user).reserved_bytes, quota.GB - 10)
+
+        response = self.client.post(reverse('upload-init'), {
+            'filename': 'more.bin', 'file_size': 20, 'chunk_size': 10,
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_failed_init_gives_the_reservation_back(self):
+        from unittest import mock
+        with mock.patch.object(chunked, 'preallocate', side_effect=OSError(28, 'No space left on device')):
+            with self.assertRaises(OSError):
+                self.client.post(reverse('upload-init'), {'filename': 'big.bin', 'file_size': 100, 'chunk_size': 10})
+        self.assertEqual(quota.get_usage(self.user).reserved_bytes, 0)
+        self.assertFalse(ChunkedUpload.objects.filter(user=self.user).exists())
+
+    def test_reconcile_command_rebuilds_counters(self):
+        File.objects.create(user=self.user, name='a.txt', size=500)
+        StorageUsage.objects.filter(user=self.user).update(used_bytes=7, reserved_bytes=3)
+
+        call_command('reconcile_storage', stdout=open(os.devnull, 'w'))
+
+        usage = quota.get_usage(self.user)
+        self.assertEqual((usage.used_bytes, usage.reserved_bytes), (500, 0))
+
+
+class BlobStoreTests(FilesTestCase):
+    def test_identical_content_is_stored_once(self):
+        content = os.urandom(64)
+        first = self.upload('photo.raw', content)
+        self.client.force_authenticate(user=User.objects.create_user(username='bob', password='password123'))
+        second = self.upload('copy.raw', content)
+
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(first.file.name, second.file.name)
+        blob = Blob.objects.get(pk=first.blob_id)
+        self.assertEqual(blob.ref_count, 2)
+
+        first.delete()
+        self.assertTrue(os.path.exists(blob.file.path))
+        second.delete()
+        self.assertFalse(os.path.exists(blob.file.path))
+        self.assertFalse(Blob.objects.filter(pk=blob.pk).exists())
+
+    def chunked_upload(self, chunks, file_size):
+        response = self.client.post(reverse('upload-init'), {'filename': 'a.bin', 'file_size': file_size, 'chunk_size': 10})
+        upload_id = response.data['upload_id']
+        for index, data in chunks:
+            self.client.post(reverse('upload-chunk', args=[upload_id]), {
+                'file': SimpleUploadedFile('blob', data), 'chunk_index': index,
+            }, format='multipart')
+        return upload_id
+
+    def test_chunked_upload_cannot_plant_other_bytes_under_a_digest(self):
+        content = b'0123456789' * 2
+        upload_id = self.chunked_upload([(0, content[:10]), (0, b'EVILEVILEV'), (1, content[10:])], len(content))
+        self.client.post(reverse('upload-complete', args=[upload_id]))
+
+        # Someone else's copy dedupes onto that blob and gets their own bytes back
+        self.client.force_authenticate(user=User.objects.create_user(username='bob', password='password123'))
+        theirs = self.upload('mine.bin', content)
+        self.assertEqual(Blob.objects.get().ref_count, 2)
+        with theirs.file.open('rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_chunked_upload_needs_leaves_for_every_byte(self):
+        upload_id = self.chunked_upload([(0, b'a' * 10), (1, b'b' * 10)], 20)
+        ChunkedUpload.objects.get(upload_id=upload_id).parts.filter(chunk_index=1).delete()
+        response = self.client.post(reverse('upload-complete', args=[upload_id]))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Blob.objects.exists())
+
+    def test_overwrite_version_keeps_old_blob(self):
+        old = self.upload('doc.txt', b'version one')
+        old_blob = old.blob_id
+        current = self.upload('doc.txt', b'version two')
+
+        version = current.versions.get()
+        self.assertEqual(version.blob_id, old_blob)
+        self.assertNotEqual(current.blob_id, old_blob)
+        with version.file.open('rb') as f:
+            self.assertEqual(f.read(), b'version one')
+
+        current.delete()
+        self.assertEqual(Blob.objects.count(), 0)
+
+    def test_legacy_file_is_hardlinked_into_version_slot(self):
+        # A file from before the blob store (e.g. import_files)
+        rel_path = 'users/{0}/legacy.txt'.format(self.user.id)
+        abs_path = os.path.join(MEDIA_ROOT, rel_path)
+        os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+        with open(abs_path, 'wb') as f:
+            f.write(b'old content')
+        inode = os.stat(abs_path).st_ino
+        File.objects.create(user=self.user, name='legacy.txt', file=rel_path, size=11)
+
+        current = self.upload('legacy.txt', b'new content')
+
+        version = current.versions.get()
+        self.assertEqual(os.stat(version.file.path).st_ino, inode)
+        with version.file.open('rb') as f:
+            self.assertEqual(f.read(), b'old content')
+        self.assertFalse(os.path.exists(abs_path))
+
+
+class StreamingUploadTests(FilesTestCase):
+    def test_streamed_upload_is_hashed_sniffed_and_moved(self):
+        from PIL import Image
+        buf = io.BytesIO()
+        Image.new('RGB', (40, 30), 'red').save(buf, format='PNG')
+        content = buf.getvalue()
+
+        file_obj = self.upload('scan-without-extension', content)
+
+        self.assertEqual(file_obj.mime_type, 'image/png')
+        self.assertEqual(file_obj.file_type, 'PHOTO')
+        self.assertEqual(file_obj.sha256, digest_stream([content]))
+        with file_obj.file.open('rb') as f:
+            self.assertEqual(f.read(), content)
+        # Nothing left behind in the scratch directory
+        self.assertEqual(os.listdir(os.path.join(MEDIA_ROOT, 'tmp')), [])
+
+    def test_scratch_file_is_closed_before_the_blob_store_takes_it(self):
+        # Windows can't rename or unlink an open file, look for a held fd where /proc shows them
+        if not os.path.isdir('/proc/self/fd'):
+            self.skipTest('needs /proc')
+        from unittest import mock
+        from . import blobs
+        held = []
+        ingest_path = blobs.ingest_path
+
+        def check_unheld(src, *args):
+            for fd in os.listdir('/proc/self/fd'):
+                if os.path.realpath(f'/proc/self/fd/{fd}') == os.path.realpath(src):
+                    held.append(fd)
+            return ingest_path(src, *args)
+
+        with mock.patch.object(blobs, 'ingest_path', side_effect=check_unheld):
+            self.upload('notes.txt', b'plain text')
+            self.upload('copy.txt', b'plain text') # duplicate: unlinked rather than renamed
+        self.assertEqual(held, [])
+
+
+@override_settings(VERSION_CHUNK_SIZES=(64, 256, 1024), VERSION_DELTA_MIN_SIZE=0)
+class DeltaVersionTests(FilesTestCase):
+    def setUp(self):
+        super().setUp()
+        rng = random.Random(42)
+        self.v1 = bytes(rng.getrandbits(8) for _ in range(20000))
+
+    def test_chunk_boundaries_survive_an_insert(self):
+        edited = self.v1[:10000] + b'inserted bytes' + self.v1[10000:]
+        before = set(delta.iter_chunks(io.BytesIO(self.v1)))
+        after = list(delta.iter_chunks(io.BytesIO(edited)))
+        self.assertEqual(b''.join(after), edited)
+        shared = sum(len(c) for c in after if c in before)
+        self.assertGreater(shared, len(self.v1) * 0.8)
+
+    def test_versions_share_chunks_and_stream_back(self):
+        v2 = self.v1[:5000] + b'edit' + self.v1[5004:]
+        v3 = v2 + b'appended'
+        self.upload('disk.img', self.v1)
+        self.upload('disk.img', v2)
+        file_obj = self.upload('disk.img', v3)
+        # Overwrites only archive, compaction is left to the command
+        self.assertFalse(FileVersionChunk.objects.exists())
+        call_command('compact_versions', stdout=io.StringIO())
+
+        old = {v.version_number: v for v in file_obj.versions.all()}
+        self.assertTrue(old[1].is_delta)
+        self.assertTrue(old[2].is_delta)
+        # Far fewer distinct chunks than two full copies would need
+        distinct = FileVersionChunk.objects.filter(version__file_item=file_obj).values('blob').distinct().count()
+        self.assertLess(distinct, old[1].chunks.count() * 1.5)
+
+        response = self.client.get(reverse('file-version-download', args=[file_obj.id, old[1].id]))
+        self.assertEqual(b''.join(response.streaming_content), self.v1)
+        # Ranges across chunk boundaries only read the chunks they cover
+        response = self.client.get(reverse('file-version-download', args=[file_obj.id, old[1].id]), HTTP_RANGE='bytes=9000-12999')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(response.streaming_content), self.v1[9000:13000])
+
+        response = self.client.post(reverse('file-version-restore', args=[file_obj.id, old[2].id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        file_obj.refresh_from_db()
+        with file_obj.file.open('rb') as f:
+            self.assertEqual(f.read(), v2)
+
+        file_obj.delete()
+        self.assertEqual(Blob.objects.count(), 0)
+
+    def test_large_versions_stay_whole(self):
+        self.upload('disk.img', self.v1)
+        file_obj = self.upload('disk.img', self.v1 + b'appended')
+        call_command('compact_versions', max_size=len(self.v1) - 1, stdout=io.StringIO())
+        self.assertFalse(file_obj.versions.get().is_delta)
+        call_command('compact_versions', max_size=0, stdout=io.StringIO())
+        self.assertTrue(file_obj.versions.get().is_delta)
+
+
+class RangeDownloadTests(FilesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.content = bytes(range(256)) * 4
+        self.file_obj = self.upload('data.bin', self.content)
+        self.url = reverse('file-download', args=[self.file_obj.id])
+
+    def test_full_download_advertises_ranges(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    def test_single_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response['Content-Range'], 'bytes 100-199/1024')
+        self.assertEqual(response['Content-Length'], '100')
+        self.assertIn('attachment', response['Content-Disposition'])
+        self.assertEqual(b''.join(response.streaming_content), self.content[100:200])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-24')
+        self.assertEqual(response['Content-Range'], 'bytes 1000-1023/1024')
+        self.assertEqual(b''.join(response.streaming_content), self.content[-24:])
+
+    def test_multiple_ranges_are_merged_and_sent_as_multipart(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9, 5-19, 500-509')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges; boundary='))
+        body = b''.join(response.streaming_content)
+        self.assertEqual(int(response['Content-Length']), len(body))
+        self.assertIn(b'Content-Range: bytes 0-19/1024\r\n\r\n' + self.content[0:20], body)
+        self.assertIn(b'Content-Range: bytes 500-509/1024\r\n\r\n' + self.content[500:510], body)
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=5000-')
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(response['Content-Range'], 'bytes */1024')
+
+    def test_stale_if_range_gets_full_file(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='Thu, 01 Jan 2000 00:00:00 GMT')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+        current = response['Last-Modified']
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=current)
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+
+
+class ConditionalDownloadTests(FilesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.file_obj = self.upload('photo.jpg', jpeg((600, 400), 'blue'))
+        self.url = reverse('file-download', args=[self.file_obj.id])
+
+    def test_original_etag_is_content_digest(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['ETag'], '"{0}"'.format(self.file_obj.sha256))
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], '"{0}"'.format(self.file_obj.sha256))
+
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"something-else"')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_versioned_thumbnail_url_is_immutable(self):
+        detail = self.client.get(reverse('file-detail', args=[self.file_obj.id]))
+        thumb_url = detail.data['thumbnail_url']
+        self.assertIn('v=', thumb_url)
+
+        response = self.client.get(thumb_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertNotEqual(response['ETag'], '"{0}"'.format(self.file_obj.sha256))
+
+        response = self.client.get(thumb_url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertIn('immutable', response['Cache-Control'])
+
+        # Without the token (or with a stale one) the browser has to revalidate
+        response = self.client.get(self.url, {'variant': 'thumbnail', 'v': 'stale'})
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+
+
+class SignedDownloadTests(FilesTestCase):
+    def setUp(self):
+        super().setUp()
+        response = self.post_file('contract.txt', b'signed content')
+        self.file_obj = File.objects.get(id=response.data['id'])
+        self.url = response.data['signed_url']
+        self.anonymous = APIClient()
+
+    def test_signed_url_is_served_without_auth_or_queries(self):
+        self.assertIsNotNone(self.url)
+        DownloadBudget.objects.create(user=self.user)
+        # No auth or File lookup, only the stream slot
+        with self.assertNumQueries(1):
+            response = self.anonymous.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(response.streaming_content), b'signed content')
+        self.assertIn('public', response['Cache-Control'])
+        self.assertIn('contract.txt', response['Content-Disposition'])
+
+        response = self.anonymous.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_tampered_or_expired_links_are_refused(self):
+        token = self.url.rstrip('/').split('/')[-1]
+        tampered = reverse('file-signed-download', args=[token[:-2] + ('aa' if token[-2:] != 'aa' else 'bb')])
+        self.assertEqual(self.anonymous.get(tampered).status_code, status.HTTP_403_FORBIDDEN)
+
+        import time
+        old = signed.make_token(self.file_obj, now=time.time() - 2 * signed.get_ttl())
+        response = self.anonymous.get(reverse('file-signed-download', args=[old]))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_urls_are_stable_within_a_bucket(self):
+        import time
+        now = time.time() // signed.EXPIRY_BUCKET * signed.EXPIRY_BUCKET
+        self.assertEqual(signed.make_token(self.file_obj, now=now + 1), signed.make_token(self.file_obj, now=now + 60))
+
+
+class ThumbnailBatchTests(FilesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.photos = [self.upload(f'p{i}.jpg', jpeg(color=color)) for i, color in enumerate(['red', 'green', 'blue'])]
+        self.document = self.upload('doc.txt', b'not an image')
+
+    def thumbnail_bytes(self, file_obj):
+        with file_obj.thumbnail.open('rb') as f:
+            return f.read()
+
+    def test_pack_layout_in_requested_order_with_one_query(self):
+        import uuid
+        ids = [self.photos[2].id, self.document.id, self.photos[0].id]
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('thumbnail-batch'), {'ids': ','.join(str(i) for i in ids), 'layout': 'pack'})
+            body = b''.join(response.streaming_content)
+        self.assertEqual(response['X-Thumbnail-Count'], '2')
+
+        entries = []
+        offset = 0
+        while offset < len(body):
+            file_id = uuid.UUID(bytes=body[offset:offset + 16])
+            length = int.from_bytes(body[offset + 16:offset + 20], 'big')
+            entries.append((file_id, body[offset + 20:offset + 20 + length]))
+            offset += 20 + length
+        self.assertEqual(entries, [
+            (self.photos[2].id, self.thumbnail_bytes(self.photos[2])),
+            (self.photos[0].id, self.thumbnail_bytes(self.photos[0])),
+        ])
+
+    def test_multipart_layout_skips_other_users_files(self):
+        other = User.objects.create_user(username='neighbour', password='password123')
+        self.client.force_authenticate(user=other)
+        response = self.client.post(reverse('thumbnail-batch'), {'ids': [str(p.id) for p in self.photos]}, format='json')
+        self.assertEqual(response['X-Thumbnail-Count'], '0')
+
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(reverse('thumbnail-batch'), {'ids': [str(p.id) for p in self.photos]}, format='json')
+        self.assertTrue(response['Content-Type'].startswith('multipart/mixed; boundary='))
+        body = b''.join(response.streaming_content)
+        self.assertEqual(body.count(b'Content-Type: image/jpeg'), 3)
+        self.assertIn(self.thumbnail_bytes(self.photos[1]), body)
+        self.assertIn(f'Content-ID: <{self.photos[1].id}>'.encode(), body)
+
+
+class ThumbnailWorkerTests(FilesTestCase):
+    def test_upload_returns_pending_and_renders_after_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.post_file('pending.jpg', jpeg((800, 600)))
+        self.assertEqual(response.data['thumbnail_status'], 'PENDING')
+        photo = File.objects.get(id=response.data['id'])
+        self.assertFalse(photo.thumbnail)
+
+        for callback in callbacks:
+            callback()
+        photo.refresh_from_db()
+        self.assertEqual(photo.thumbnail_status, 'READY')
+        from PIL import Image
+        with photo.thumbnail.open('rb') as f, Image.open(f) as thumb:
+            self.assertEqual(thumb.size, (320, 240))
+
+    def test_undecodable_photo_is_marked_failed(self):
+        photo = self.upload('broken.jpg', b'not really a jpeg')
+        self.assertEqual(photo.thumbnail_status, 'FAILED')
+        self.assertFalse(photo.thumbnail)
+
+    def test_replaced_content_is_rendered_again(self):
+        from PIL import Image
+
+        def thumbnail_pixel(photo):
+            photo.refresh_from_db()
+            self.assertEqual(photo.thumbnail_status, 'READY')
+            with photo.thumbnail.open('rb') as f, Image.open(f) as thumb:
+                return thumb.convert('RGB').getpixel((0, 0))
+
+        photo = self.upload('a.jpg', jpeg(color='red'))
+        self.assertGreater(thumbnail_pixel(photo)[0], 200)
+        self.upload('a.jpg', jpeg(color='blue')) # Overwrite by name
+        self.assertGreater(thumbnail_pixel(photo)[2], 200)
+        self.assertEqual(photo.thumbnail_variants.filter(size=1280, format='jpeg').count(), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('file-version-restore', args=[photo.id, photo.versions.get().id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(thumbnail_pixel(photo)[0], 200)
+
+    def test_documents_are_left_alone(self):
+        self.assertIsNone(self.upload('notes.txt', b'plain text').thumbnail_status)
+
+    def test_process_pool_renders(self):
+        # The real pool: spawned workers import imaging.py without Django
+        path = os.path.join(MEDIA_ROOT, 'pool-source.jpg')
+        with open(path, 'wb') as f:
+            f.write(jpeg((1200, 300)))
+        try:
+            rendered = thumbnails.get_pool().submit(imaging.render_pyramid, path, (128,), ['jpeg']).result(timeout=60)
+        finally:
+            thumbnails._reset_pool()
+        self.assertEqual(rendered[(128, 'jpeg')][:3], b'\xff\xd8\xff')
+
+
+class ThumbnailEngineTests(TestCase):
+    def open(self, data):
+        from PIL import Image
+        return Image.open(io.BytesIO(data))
+
+    def test_auto_orients_from_exif(self):
+        rotated = jpeg((400, 200), exif=thumbbench.exif_bytes(orientation=6))
+        rendered = imaging.render_pyramid(rotated, (320,), ['jpeg'])
+        self.assertEqual(self.open(rendered[(320, 'jpeg')]).size, (160, 320))
+
+    def test_embedded_exif_thumbnail_used_when_big_enough(self):
+        embedded = jpeg((160, 120), 'blue')
+        photo = jpeg((4000, 3000), 'red', exif=thumbbench.exif_bytes(thumbnail=embedded))
+
+        rendered = imaging.render_pyramid(photo, imaging.PYRAMID_SIZES, ['jpeg'])
+        grid = self.open(rendered[(128, 'jpeg')]).convert('RGB')
+        self.assertEqual(grid.size, (128, 96))
+        self.assertGreater(grid.getpixel((64, 48))[2], 200) # blue: from the EXIF thumbnail
+
+        large = self.open(rendered[(320, 'jpeg')]).convert('RGB')
+        self.assertGreater(large.getpixel((160, 120))[0], 200) # red: too small, decoded the photo
+
+    def test_reduced_decode_matches_full_decode_geometry(self):
+        photo = jpeg((4000, 3000))
+        fast = imaging.render_pyramid(photo, imaging.PYRAMID_SIZES, ['jpeg'])
+        full = imaging.render_pyramid(photo, imaging.PYRAMID_SIZES, ['jpeg'], fast=False)
+        for key in fast:
+            self.assertEqual(self.open(fast[key]).size, self.open(full[key]).size)
+
+    def test_benchmark_reports_throughput_and_memory(self):
+        import json
+        out = io.StringIO()
+        call_command('benchmark_thumbnails', megapixels='0.2', formats='jpeg', copies=1, json=True, stdout=out)
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([r['group'] for r in results], ['jpeg-0.2mp', 'jpeg-0.2mp-exif'])
+        for result in results:
+            self.assertGreater(result['images_per_sec'], 0)
+            self.assertGreater(result['peak_rss_mb'], 0)
+
+
+class ThumbnailBackfillTests(FilesTestCase):
+    def setUp(self):
+        super().setUp()
+        content = jpeg((640, 480), 'teal')
+        # Created without running the on-commit render, like imported photos
+        self.photos = sorted((
+            File.objects.create(user=self.user, name=f'old{i}.jpg', file_type='PHOTO',
+                                file=SimpleUploadedFile(f'old{i}.jpg', content))
+            for i in range(4)
+        ), key=lambda f: f.pk)
+        self.checkpoint = os.path.join(MEDIA_ROOT, f'backfill-{self.user.pk}.json')
+
+    def backfill(self, **options):
+        out = io.StringIO()
+        call_command('backfill_thumbnails', workers=2, batch_size=2, checkpoint=self.checkpoint, stdout=out, **options)
+        return out.getvalue()
+
+    def test_renders_missing_thumbnails(self):
+        output = self.backfill()
+        self.assertIn('4 photos to render.', output)
+        self.assertIn('photos/s', output)
+        for photo in self.photos:
+            photo.refresh_from_db()
+            self.assertEqual(photo.thumbnail_status, 'READY')
+            self.assertTrue(photo.thumbnail_variants.exists())
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.assertIn('0 photos to render.', self.backfill())
+
+    def test_resumes_after_checkpoint(self):
+        import json
+        with open(self.checkpoint, 'w') as f:
+            json.dump({'mode': 'thumbnail', 'last_pk': str(self.photos[1].pk)}, f)
+        output = self.backfill()
+        self.assertIn(f'Resuming after {self.photos[1].pk}', output)
+        self.assertIn('2 photos to render.', output)
+        rendered = [File.objects.get(pk=p.pk).thumbnail_status for p in self.photos]
+        self.assertEqual(rendered, ['PENDING', 'PENDING', 'READY', 'READY'])
+
+    def test_missing_variant_only(self):
+        self.backfill()
+        self.photos[2].thumbnail_variants.filter(size=1280, format='jpeg').delete()
+        output = self.backfill(variant='thumb-1280.jpeg')
+        self.assertIn('1 photos to render.', output)
+        self.assertTrue(self.photos[2].thumbnail_variants.filter(size=1280, format='jpeg').exists())
+
+    def test_rejects_unknown_variant(self):
+        from django.core.management.base import CommandError
+        with self.assertRaises(CommandError):
+            self.backfill(variant='thumb-999')
+
+
+class PhotoMetadataTests(FilesTestCase):
+    def exif_jpeg(self, taken=None, offset=None, gps=False):
+        from PIL import Image, ExifTags
+        exif = Image.Exif()
+        exif[0x010F] = 'Canon'
+        exif[0x0110] = 'EOS R5'
+        exif[0x0112] = 6
+        if taken:
+            exif.get_ifd(ExifTags.IFD.Exif)[0x9003] = taken
+        if offset:
+            exif.get_ifd(ExifTags.IFD.Exif)[0x9011] = offset
+        if gps:
+            info = exif.get_ifd(ExifTags.IFD.GPSInfo)
+            info.update({1: 'N', 2: (48.0, 51.0, 29.6), 3: 'W', 4: (2.0, 17.0, 40.2), 6: 35.5})
+        return jpeg((400, 300), 'gray', exif=exif)
+
+    def test_thumbnail_pass_extracts_exif(self):
+        from datetime import datetime, timezone as dt_timezone
+        photo = self.upload('paris.jpg', self.exif_jpeg('2021:07:04 18:30:00', '+02:00', gps=True))
+        metadata = PhotoMetadata.objects.get(file_item=photo)
+        self.assertEqual(metadata.taken_at, datetime(2021, 7, 4, 16, 30, tzinfo=dt_timezone.utc))
+        self.assertEqual((metadata.width, metadata.height, metadata.orientation), (300, 400, 6))
+        self.assertEqual((metadata.camera_make, metadata.camera_model), ('Canon', 'EOS R5'))
+        self.assertAlmostEqual(metadata.latitude, 48.8582, places=4)
+        self.assertAlmostEqual(metadata.longitude, -2.2945, places=4)
+        self.assertEqual(metadata.altitude, 35.5)
+
+        data = self.client.get(reverse('file-detail', args=[photo.id])).data['photo_metadata']
+        self.assertEqual(data['camera_model'], 'EOS R5')
+
+    def test_timeline_sorts_by_capture_time(self):
+        old = self.upload('old.jpg', self.exif_jpeg('2015:01:01 10:00:00'))
+        undated = self.upload('undated.jpg', self.exif_jpeg())
+        new = self.upload('new.jpg', self.exif_jpeg('2020:06:01 10:00:00'))
+        self.assertIsNone(PhotoMetadata.objects.get(file_item=undated).taken_at)
+        response = self.client.get(reverse('file-list-create'), {'type': 'photo', 'sort': 'taken'})
+        results = response.data['results'] if isinstance(response.data, dict) else response.data
+        self.assertEqual([r['id'] for r in results], [str(new.id), str(old.id), str(undated.id)])
+
+    def test_metadata_backfill(self):
+        # Thumbnailed before metadata extraction existed
+        photo = File.objects.create(user=self.user, name='legacy.jpg', file_type='PHOTO',
+                                    file=SimpleUploadedFile('legacy.jpg', self.exif_jpeg('2019:02:03 04:05:06')))
+        out = io.StringIO()
+        call_command('backfill_thumbnails', metadata=True, workers=1,
+                     checkpoint=os.path.join(MEDIA_ROOT, 'metadata-backfill.json'), stdout=out)
+        self.assertIn('1 photos to read.', out.getvalue())
+        self.assertEqual(PhotoMetadata.objects.get(file_item=photo).taken_at.year, 2019)
+        photo.refresh_from_db()
+        self.assertFalse(photo.thumbnail) # Metadata only, nothing rendered
+
+
+class ThumbnailPyramidTests(FilesTestCase):
+    def setUp(self):
+        from PIL import Image
+        super().setUp()
+        buf = io.BytesIO()
+        Image.new('RGBA', (2000, 1000), (0, 128, 0, 255)).save(buf, format='PNG')
+        self.photo = self.upload('wide.png', buf.getvalue())
+        self.url = reverse('file-download', args=[self.photo.id])
+
+    def fetch(self, variant, **headers):
+        from PIL import Image
+        response = self.client.get(self.url, {'variant': variant}, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        image = Image.open(io.BytesIO(b''.join(response.streaming_content)))
+        return response, image
+
+    def test_pyramid_is_generated(self):
+        stored = set(self.photo.thumbnail_variants.values_list('size', 'format'))
+        expected = {(size, fmt) for size in imaging.PYRAMID_SIZES for fmt in imaging.supported_formats()}
+        self.assertEqual(stored, expected - {(imaging.BASE_SIZE, 'jpeg')})
+        _, image = self.fetch('thumbnail')
+        self.assertEqual((image.format, image.size), ('JPEG', (320, 160)))
+
+    def test_format_follows_accept_header(self):
+        best = 'AVIF' if 'avif' in imaging.supported_formats() else 'WEBP'
+        response, image = self.fetch('thumb-128', accept='image/avif,image/webp,*/*')
+        self.assertEqual((image.format, image.size), (best, (128, 64)))
+        self.assertIn('Accept', response['Vary'])
+
+        response, image = self.fetch('thumb-128', accept='image/avif;q=0,image/webp')
+        self.assertEqual(image.format, 'WEBP')
+
+        # Old clients get JPEG
+        response, image = self.fetch('thumb-1280', accept='*/*')
+        self.assertEqual((image.format, image.size), ('JPEG', (1280, 640)))
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+
+    def test_explicit_format_and_size_rounds_up(self):
+        _, image = self.fetch('thumb-200.webp')
+        self.assertEqual((image.format, image.size), ('WEBP', (320, 160)))
+        _, image = self.fetch('thumb-5000.jpg')
+        self.assertEqual(image.size, (1280, 640))
+
+    def test_legacy_thumbnail_without_pyramid(self):
+        self.photo.thumbnail_variants.all().delete()
+        _, image = self.fetch('thumb-1280', accept='image/webp')
+        self.assertEqual((image.format, image.size), ('JPEG', (320, 160)))
+
+    def test_delete_removes_variant_files(self):
+        paths = [v.file.path for v in self.photo.thumbnail_variants.all()]
+        self.assertTrue(all(os.path.exists(p) for p in paths))
+        self.photo.delete()
+        self.assertFalse(any(os.path.exists(p) for p in paths))
+
+
+@override_settings(FILE_DOWNLOAD_OFFLOAD='x-accel')
+class ThumbnailCacheTests(FilesTestCase):
+    def setUp(self):
+        thumbcache._local = None # fresh LRU and counters per test
+        super().setUp()
+        self.photo = self.upload('hot.jpg', jpeg(color='orange'))
+        self.url = reverse('file-download', args=[self.photo.id])
+
+    def fetch(self):
+        response = self.client.get(self.url, {'variant': 'thumbnail'})
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content)
+
+    def test_lru_is_bounded_by_bytes(self):
+        lru = thumbcache.ByteLRU(max_bytes=10, max_entry_bytes=6)
+        lru.put(('a', 1), b'aaaa')
+        lru.put(('b', 1), b'bbbb')
+        lru.get(('a', 1))
+        lru.put(('c', 1), b'cccc')
+        lru.put(('d', 1), b'ddddddd') # over the per-entry cap, not cached
+        self.assertIsNone(lru.get(('b', 1)))
+        self.assertEqual(lru.get(('a', 1)), b'aaaa')
+        self.assertEqual(lru.stats(), {'entries': 2, 'bytes': 8, 'max_bytes': 10, 'hits': 2, 'misses': 1, 'evictions': 1})
+
+    def test_second_request_is_served_from_memory(self):
+        first = self.fetch()
+        os.remove(self.photo.thumbnail.path)
+        self.assertEqual(self.fetch(), first) # not offloaded, and no disk read
+        self.assertEqual(thumbcache.stats()['local']['hits'], 1)
+
+    def test_regenerated_thumbnail_is_not_served_stale(self):
+        self.fetch()
+        self.photo.thumbnail.save('new_thumb.jpg', SimpleUploadedFile('new_thumb.jpg', b'new bytes'), save=False)
+        self.photo.save(update_fields=['thumbnail', 'updated_at'])
+        self.assertEqual(self.fetch(), b'new bytes')
+
+    def test_delete_drops_entries(self):
+        self.fetch()
+        self.assertEqual(thumbcache.stats()['local']['entries'], 1)
+        self.photo.delete()
+        self.assertEqual(thumbcache.stats()['local']['entries'], 0)
+
+    @override_settings(THUMBNAIL_CACHE_SHARED='default')
+    def test_shared_tier_fills_other_workers(self):
+        data = thumbcache.get_thumbnail(self.photo)
+        thumbcache._local = None # another worker, cold local tier
+        os.remove(self.photo.thumbnail.path)
+        self.assertEqual(thumbcache.get_thumbnail(self.photo), data)
+        self.assertEqual(thumbcache.stats()['shared']['hits'], 1)
+
+    @override_settings(THUMBNAIL_CACHE_SHARED='default')
+    def test_regeneration_drops_every_variant_from_shared_tier(self):
+        from django.core.cache import cache
+        picks = [thumbnails.pick(self.photo, variant, 'image/webp') for variant in ('thumbnail', 'thumb-128', 'thumb-1280')]
+        keys = [thumbcache.cache_key(self.photo, p.label) for p in picks]
+        for p in picks:
+            thumbcache.get_thumbnail(self.photo, p.file, p.label)
+        self.assertTrue(all(cache.get(thumbcache._shared_key(key)) for key in keys))
+
+        self.photo.save(update_fields=['thumbnail', 'updated_at'])
+        self.assertEqual([cache.get(thumbcache._shared_key(key)) for key in keys], [None] * 3)
+
+    def test_signed_thumbnail_uses_cache(self):
+        url = signed.signed_url(self.photo, variant='thumbnail')
+        first = b''.join(self.client.get(url).streaming_content)
+        os.remove(self.photo.thumbnail.path)
+        self.assertEqual(b''.join(self.client.get(url).streaming_content), first)
+
+
+class PrecompressedDownloadTests(FilesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.content = b'date,amount,payee\n' + b'2024-01-01,12.50,Grocery store\n' * 2000
+
+    def test_sidecar_is_built_and_negotiated(self):
+        import gzip
+        file_obj = self.upload('ledger.csv', self.content, category='FINANCE')
+        sidecar = file_obj.blob.encodings.get(encoding='gzip')
+        self.assertLess(sidecar.size, len(self.content) / 5)
+
+        url = reverse('file-download', args=[file_obj.id])
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertTrue(response['Content-Type'].startswith('text/csv'))
+        encoded = b''.join(response.streaming_content)
+        self.assertEqual(gzip.decompress(encoded), self.content)
+        self.assertNotEqual(response['ETag'], '"{0}"'.format(file_obj.sha256))
+
+        # Ranges apply to the encoded bytes
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip', HTTP_RANGE='bytes=0-9')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response['Content-Range'], f'bytes 0-9/{len(encoded)}')
+        self.assertEqual(b''.join(response.streaming_content), encoded[:10])
+
+        # zstd wins a tie
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, zstd')
+        self.assertEqual(response['Content-Encoding'], 'zstd')
+        import zstandard
+        self.assertEqual(zstandard.ZstdDecompressor().decompressobj().decompress(b''.join(response.streaming_content)), self.content)
+
+        # gzip;q=0 or no Accept-Encoding: the original bytes
+        for accept in ('gzip;q=0', ''):
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING=accept)
+            self.assertNotIn('Content-Encoding', response)
+            self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    def test_photos_and_other_categories_are_left_alone(self):
+        file_obj = self.upload('notes.csv', self.content, category='OTHER')
+        self.assertFalse(file_obj.blob.encodings.exists())
+
+    def test_sidecar_goes_with_its_blob(self):
+        file_obj = self.upload('ledger.csv', self.content, category='MEDICAL')
+        paths = [sidecar.file.path for sidecar in file_obj.blob.encodings.all()]
+        self.assertEqual(len(paths), 2)
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+        file_obj.delete()
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+
+@override_settings(FILE_DOWNLOAD_OFFLOAD=None)
+class DownloadLimitTests(FilesTestCase):
+    user_fields = {'max_download_streams': 1}
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('file-download', args=[self.upload('movie.bin', os.urandom(4000)).id])
+
+    def test_concurrent_streams_are_capped_per_user(self):
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+        # Finishing the first stream frees its slot
+        b''.join(first.streaming_content)
+        self.assertEqual(bandwidth.active_streams(self.user.pk), 0)
+        second = self.client.get(self.url)
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        b''.join(second.streaming_content)
+
+    def test_token_bucket_spaces_out_a_stream(self):
+        key = self.user.pk
+        # Burst goes out at once, then the debt is slept off at the configured rate
+        self.assertEqual(bandwidth.take(key, 1000, rate=1000, burst=1000, now=100.0), 0)
+        self.assertAlmostEqual(bandwidth.take(key, 500, rate=1000, burst=1000, now=100.0), 0.5)
+        self.assertAlmostEqual(bandwidth.take(key, 500, rate=1000, burst=1000, now=100.5), 0.5)
+        # Idle time refills, but never past the burst size
+        self.assertEqual(bandwidth.take(key, 1000, rate=1000, burst=1000, now=200.0), 0)
+
+    def test_stream_slots_are_exact_and_leases_expire(self):
+        self.assertTrue(bandwidth.acquire_stream(self.user.pk, 2))
+        self.assertTrue(bandwidth.acquire_stream(self.user.pk, 2))
+        with self.assertRaises(bandwidth.TooManyStreams):
+            bandwidth.acquire_stream(self.user.pk, 2)
+        self.assertEqual(bandwidth.active_streams(self.user.pk), 2)
+
+        # Slots held by a worker that died never come back, until nothing has moved them for a lease
+        DownloadBudget.objects.filter(user=self.user).update(streams_changed_at=timezone.now() - timedelta(days=1))
+        self.assertTrue(bandwidth.acquire_stream(self.user.pk, 2))
+        self.assertEqual(bandwidth.active_streams(self.user.pk), 1)
+        bandwidth.release_stream(self.user.pk)
+        bandwidth.release_stream(self.user.pk)
+        self.assertEqual(bandwidth.active_streams(self.user.pk), 0)
+
+    def test_user_override_and_offload_rate(self):
+        from django.http import HttpResponse
+        self.user.download_rate_kb = 512
+        limits = bandwidth.get_limits(self.user)
+        self.assertEqual(limits['rate'], 512 * 1024)
+        self.assertEqual(limits['streams'], 1)
+
+        response = HttpResponse()
+        response['X-Accel-Redirect'] = '/protected-media/x'
+        bandwidth.limit(response, self.user.pk, limits)
+        self.assertEqual(response['X-Accel-Limit-Rate'], str(512 * 1024))
+
+
+@override_settings(FILE_DOWNLOAD_OFFLOAD=None)
+class AsyncViewTests(FilesTestCase):
+    def setUp(self):
+        from rest_framework_simplejwt.tokens import AccessToken
+        super().setUp()
+        self.token = f'Bearer {AccessToken.for_user(self.user)}'
+        self.content = os.urandom(200000)
+        self.file_id = self.upload('video.bin', self.content).id
+
+    async def read(self, response):
+        body = b''.join([chunk async for chunk in response.streaming_content])
+        response.close()
+        return body
+
+    async def test_download_streams_asynchronously(self):
+        from django.test import AsyncRequestFactory
+        from .async_views import AsyncFileDownloadView
+        factory = AsyncRequestFactory()
+        view = AsyncFileDownloadView.as_view()
+
+        response = await view(factory.get('/', headers={'Authorization': self.token}), pk=self.file_id)
+        self.assertTrue(response.is_async)
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        self.assertEqual(await self.read(response), self.content)
+
+        response = await view(factory.get('/', headers={'Authorization': self.token, 'Range': 'bytes=1000-1999,5000-5099'}), pk=self.file_id)
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        body = await self.read(response)
+        self.assertEqual(int(response['Content-Length']), len(body))
+        self.assertIn(self.content[1000:2000], body)
+
+        response = await view(factory.get('/'), pk=self.file_id)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        # Same JSON body as the DRF views, not Django's HTML 404
+        import json
+        import uuid
+        response = await view(factory.get('/', headers={'Authorization': self.token}), pk=uuid.uuid4())
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(json.loads(response.content), {'detail': 'Not found.'})
+
+    async def test_chunk_upload_and_status(self):
+        from asgiref.sync import sync_to_async
+        from django.test import AsyncRequestFactory
+        from .async_views import AsyncChunkedUploadChunkView, AsyncChunkedUploadStatusView
+        factory = AsyncRequestFactory()
+        content = os.urandom(20)
+        response = await sync_to_async(self.client.post)(reverse('upload-init'), {
+            'filename': 'a.bin', 'file_size': len(content), 'chunk_size': 10,
+        })
+        upload_id = response.data['upload_id']
+
+        request = factory.post('/', {'file': SimpleUploadedFile('blob', content[10:]), 'chunk_index': 1}, headers={'Authorization': self.token})
+        response = await AsyncChunkedUploadChunkView.as_view()(request, upload_id=upload_id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        request = factory.post('/', {'file': SimpleUploadedFile('blob', b'short'), 'chunk_index': 0}, headers={'Authorization': self.token})
+        response = await AsyncChunkedUploadChunkView.as_view()(request, upload_id=upload_id)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = await AsyncChunkedUploadStatusView.as_view()(factory.get('/', headers={'Authorization': self.token}), upload_id=upload_id)
+        import json
+        data = json.loads(response.content)
+        self.assertEqual(data['missing_chunks'], [[0, 0]])
+        with open(chunked.target_path(upload_id), 'rb') as f:
+            self.assertEqual(f.read()[10:], content[10:])
+
+
+class ArchiveDownloadTests(FilesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.folder = File.objects.create(user=self.user, name='Taxes', is_folder=True)
+        self.sub = File.objects.create(user=self.user, name='2024', is_folder=True, parent=self.folder)
+        self.a = self.upload_into(self.folder, 'summary.txt', b'total: 42\n' * 100)
+        self.b = self.upload_into(self.sub, 'receipt.pdf', os.urandom(3000))
+        self.c = self.upload_into(self.sub, 'receipt.pdf', b'second receipt')
+
+    def upload_into(self, parent, name, content):
+        file_obj = self.upload(name, content)
+        file_obj.parent = parent
+        file_obj.save()
+        return file_obj
+
+    def read_zip(self, response):
+        import zipfile
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        return zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+
+    def test_folder_is_zipped_recursively(self):
+        response = self.client.get(reverse('file-archive'), {'folder': self.folder.id})
+        self.assertIn('Taxes.zip', response['Content-Disposition'])
+        archive = self.read_zip(response)
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(sorted(archive.namelist()), ['2024/receipt (2).pdf', '2024/receipt.pdf', 'summary.txt'])
+        self.assertEqual(archive.read('summary.txt'), b'total: 42\n' * 100)
+        # Text is deflated, everything else stored as-is
+        self.assertEqual(archive.getinfo('summary.txt').compress_type, 8)
+        self.assertEqual(archive.getinfo('2024/receipt.pdf').compress_type, 0)
+        contents = {archive.read('2024/receipt.pdf'), archive.read('2024/receipt (2).pdf')}
+        with self.b.file.open('rb') as f:
+            self.assertIn(f.read(), contents)
+
+    def test_selection_of_files_and_folders(self):
+        response = self.client.get(reverse('file-archive'), {'ids': f'{self.a.id},{self.sub.id}'})
+        archive = self.read_zip(response)
+        self.assertEqual(sorted(archive.namelist()), ['2024/receipt (2).pdf', '2024/receipt.pdf', 'summary.txt'])
+
+    def test_other_users_files_are_not_included(self):
+        other = User.objects.create_user(username='snoop', password='password123')
+        self.client.force_authenticate(user=other)
+        response = self.client.get(reverse('file-archive'), {'folder': self.folder.id})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get(reverse('file-archive'), {'ids': 'not-a-uuid'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(FILE_DOWNLOAD_OFFLOAD='x-accel')
+class DownloadOffloadTests(FilesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.file_obj = self.upload('notes.txt', b'offloaded bytes')
+        self.url = reverse('file-download', args=[self.file_obj.id])
+
+    def test_view_returns_internal_redirect(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + self.file_obj.file.name)
+        self.assertEqual(response.content, b'')
+        self.assertIn('notes.txt', response['Content-Disposition'])
+
+        with self.settings(FILE_DOWNLOAD_OFFLOAD='x-sendfile'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Sendfile'], self.file_obj.file.path)
+
+    def test_dev_middleware_serves_like_nginx(self):
+        # What dev settings install with FILE_DOWNLOAD_OFFLOAD=x-accel
+        with self.settings(MIDDLEWARE=settings.MIDDLEWARE + ['apps.files.middleware.DownloadOffloadMiddleware']):
+            # Fresh client, the handler builds its middleware chain once
+            self.client = APIClient()
+            self.client.force_authenticate(user=self.user)
+            response = self.client.get(self.url, HTTP_RANGE='bytes=0-8')
+        self.assertNotIn('X-Accel-Redirect', response)
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(response.streaming_content), b'offloaded')
+        self.assertIn('notes.txt', response['Content-Disposition'])
+
+    def test_redirect_outside_media_root_is_refused(self):
+        from django.http import HttpResponse
+        response = HttpResponse()
+        response['X-Accel-Redirect'] = '/protected-media/../../etc/passwd'
+        self.assertIsNone(downloads.resolve_offload(response))
+
+
+class UploadReaperTests(FilesTestCase):
+    def start_session(self):
+        response = self.client.post(reverse('upload-init'), {'filename': 'a.bin', 'file_size': 8190, 'chunk_size': 4095})
+        upload_id = response.data['upload_id']
+        self.client.post(reverse('upload-chunk', args=[upload_id]), {
+            'file': SimpleUploadedFile('blob', os.urandom(4095)), 'chunk_index': 0,
+        }, format='multipart')
+        return upload_id
+
+    def test_idle_session_is_expired_and_space_released(self):
+        stale = self.start_session()
+        fresh = self.start_session()
+        ChunkedUpload.objects.filter(upload_id=stale).update(last_activity_at=timezone.now() - timedelta(days=2))
+
+        result = reaper.reap()
+
+        self.assertEqual(result['sessions'], 1)
+        self.assertGreater(result['freed_bytes'], 0)
+        self.assertEqual(ChunkedUpload.objects.get(upload_id=stale).status, 'FAILED')
+        self.assertFalse(os.path.exists(chunked.session_dir(stale)))
+        self.assertTrue(os.path.exists(chunked.session_dir(fresh)))
+        self.assertEqual(quota.get_usage(self.user).reserved_bytes, 8190)
+
+    def test_orphaned_directory_is_removed(self):
+        orphan = chunked.session_dir('not-a-session')
+        os.makedirs(orphan)
+        old = timezone.now().timestamp() - 2 * reaper.ORPHAN_GRACE_SECONDS
+        os.utime(orphan, (old, old))
+
+        result = reaper.reap()
+
+        self.assertEqual(result['orphans'], 1)
+        self.assertFalse(os.path.exists(orphan))
+
+    def test_finalizing_session_is_not_reaped_and_quota_released_once(self):
+        upload_id = self.start_session()
+        # Last chunk long ago, /complete only now
+        ChunkedUpload.objects.filter(upload_id=upload_id).update(last_activity_at=timezone.now() - timedelta(hours=5))
+        self.assertTrue(chunked.begin_processing(upload_id))
+        self.assertEqual(reaper.reap()['sessions'], 0)
+
+        # The reaper wins once the worker looks dead; finalizing afterwards must not release again
+        ChunkedUpload.objects.filter(upload_id=upload_id).update(last_activity_at=timezone.now() - timedelta(hours=5))
+        self.assertEqual(reaper.reap()['sessions'], 1)
+        with self.assertRaises(Exception):
+            chunked.finalize(upload_id)
+        self.assertEqual(quota.get_usage(self.user).reserved_bytes, 0)
+        self.assertEqual(ChunkedUpload.objects.get(upload_id=upload_id).error, 'Upload session expired')
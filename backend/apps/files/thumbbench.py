@@ -0,0 +1,124 @@
+import multiprocessing
+import os
+import resource
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from PIL import Image
+from . import imaging
+
+# Thumbnail engine benchmark (manage.py benchmark_thumbnails).
+# Builds a synthetic corpus (sizes x formats, with and without EXIF thumbnails
+# and orientation), then times imaging.render_pyramid over each group in a
+# fresh worker process, so every group's peak RSS is its own. Django-free like
+# imaging.py.
+
+DEFAULT_MEGAPIXELS = (2, 12, 40)
+DEFAULT_FORMATS = ('jpeg', 'png', 'webp')
+
+_SAVE = {
+    'jpeg': ('JPEG', {'quality': 90}),
+    'png': ('PNG', {'compress_level': 1}),
+    'webp': ('WEBP', {'quality': 90}),
+}
+
+
+def exif_bytes(orientation=1, thumbnail=None):
+    """
+    Minimal big-endian EXIF block: IFD0 with the orientation and, when given,
+    IFD1 pointing at a JPEG thumbnail, as cameras write it. Pillow can't write IFD1.
+    """
+    ifd0 = struct.pack('>H', 1) + struct.pack('>HHIHH', 0x0112, 3, 1, orientation, 0)
+    ifd1_offset = 8 + len(ifd0) + 4 if thumbnail else 0
+    tiff = b'MM\x00\x2a' + struct.pack('>I', 8) + ifd0 + struct.pack('>I', ifd1_offset)
+    if thumbnail:
+        thumb_offset = ifd1_offset + 2 + 2 * 12 + 4
+        tiff += struct.pack('>H', 2)
+        tiff += struct.pack('>HHII', 0x0201, 4, 1, thumb_offset)
+        tiff += struct.pack('>HHII', 0x0202, 4, 1, len(thumbnail))
+        tiff += struct.pack('>I', 0) + thumbnail
+    return b'Exif\x00\x00' + tiff
+
+
+def synthetic_photo(megapixels):
+    """
+    A 4:3 RGB image of smooth blotches plus a little grain, so decoders and
+    encoders work about as hard as on a photo (pure noise would be far harder).
+    """
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = width * 3 // 4
+    channels = []
+    for i in range(3):
+        coarse = Image.effect_noise((max(1, width // 64), max(1, height // 64)), 64 + 16 * i)
+        channels.append(coarse.resize((width, height), Image.Resampling.BILINEAR))
+    grain = Image.effect_noise((width, height), 6)
+    return Image.merge('RGB', [Image.blend(channel, grain, 0.15) for channel in channels])
+
+
+def build_corpus(directory, megapixels=DEFAULT_MEGAPIXELS, formats=DEFAULT_FORMATS, copies=3):
+    """
+    Write the corpus into directory, returns {group name: [paths]}.
+    JPEG groups also get an "exif" variant: rotated (orientation 6) with a 160x120 embedded thumbnail.
+    """
+    os.makedirs(directory, exist_ok=True)
+    groups = {}
+    for mp in megapixels:
+        photo = synthetic_photo(mp)
+        for fmt in formats:
+            pil_format, options = _SAVE[fmt]
+            variants = [('', {})]
+            if fmt == 'jpeg':
+                thumb = photo.copy()
+                thumb.thumbnail((160, 160))
+                buf = BytesIO()
+                thumb.save(buf, format='JPEG', quality=80)
+                variants.append(('-exif', {'exif': exif_bytes(6, buf.getvalue())}))
+            for suffix, extra in variants:
+                name = f'{fmt}-{mp}mp{suffix}'
+                path = os.path.join(directory, f'{name}.{fmt}')
+                photo.save(path, format=pil_format, **options, **extra)
+                groups[name] = [path] * copies # Same file: decode cost is what's measured, not the disk
+    return groups
+
+
+def _peak_rss_kb():
+    # VmHWM belongs to this process image; ru_maxrss survives exec and would report the parent's peak on Linux
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run_group(paths, sizes, formats, fast):
+    started = time.perf_counter()
+    for path in paths:
+        imaging.render_pyramid(path, sizes, formats, fast=fast)
+    elapsed = time.perf_counter() - started
+    return len(paths), elapsed, _peak_rss_kb()
+
+
+def run(groups, sizes=imaging.PYRAMID_SIZES, formats=None, modes=('fast',)):
+    """
+    Yields one result dict per (group, mode): images, seconds, images_per_sec, peak_rss_mb.
+    Modes: 'fast' (the engine as used), 'full' (full-resolution decode, for comparison).
+    formats are the output formats, all the server supports by default.
+    """
+    context = multiprocessing.get_context('spawn')
+    for name, paths in groups.items():
+        for mode in modes:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                count, seconds, rss_kb = pool.submit(_run_group, paths, tuple(sizes), formats, mode == 'fast').result()
+            yield {
+                'group': name,
+                'mode': mode,
+                'sizes': list(sizes),
+                'images': count,
+                'seconds': round(seconds, 3),
+                'images_per_sec': round(count / seconds, 2) if seconds else None,
+                'peak_rss_mb': round(rss_kb / 1024, 1),
+            }
@@ -0,0 +1,202 @@
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.storage import default_storage
+from . import imaging
+
+# Hot-thumbnail cache.
+# Two tiers: an in-process LRU bounded by total bytes (not entries, thumbnails
+# vary a lot in size), and optionally a shared Django cache so every worker
+# benefits from the others' reads. Keys are (file id, updated_at[, variant]),
+# a File that changes gets new keys; signals.py drops the old ones in both
+# tiers right away rather than leaving them to expire.
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# Bigger thumbnails than this go straight to disk instead of evicting dozens of small ones
+DEFAULT_MAX_ENTRY_BYTES = 1024 * 1024
+
+SHARED_TIMEOUT = 24 * 3600
+
+
+class ByteLRU:
+    """Thread-safe LRU of bytes values, evicting least recently used entries past max_bytes."""
+
+    def __init__(self, max_bytes, max_entry_bytes=None):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes or max_bytes
+        self._data = OrderedDict()
+        self._by_file = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            data = self._data.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_entry_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._size -= len(self._data.pop(key))
+            self._data[key] = data
+            self._by_file.setdefault(key[0], set()).add(key)
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                old_key, old = self._data.popitem(last=False)
+                self._forget(old_key)
+                self._size -= len(old)
+                self.evictions += 1
+
+    def _forget(self, key):
+        keys = self._by_file.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_file[key[0]]
+
+    def invalidate(self, file_id):
+        with self._lock:
+            for key in self._by_file.pop(file_id, ()):
+                self._size -= len(self._data.pop(key))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._by_file.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+_local = None
+_local_lock = threading.Lock()
+_shared_hits = 0
+_shared_misses = 0
+
+
+def get_local():
+    global _local
+    with _local_lock:
+        if _local is None:
+            _local = ByteLRU(
+                getattr(settings, 'THUMBNAIL_CACHE_BYTES', DEFAULT_MAX_BYTES),
+                getattr(settings, 'THUMBNAIL_CACHE_MAX_ENTRY_BYTES', DEFAULT_MAX_ENTRY_BYTES),
+            )
+    return _local
+
+
+def _shared():
+    alias = getattr(settings, 'THUMBNAIL_CACHE_SHARED', None)
+    return caches[alias] if alias else None
+
+
+def cache_key(file_obj, label='', updated_at=None):
+    # label tells pyramid variants apart (thumbnails.pick), '' is File.thumbnail
+    key = (str(file_obj.pk), (updated_at or file_obj.updated_at).isoformat())
+    return key + (label,) if label else key
+
+
+def labels():
+    """Every label a File's thumbnails can be cached under: '' and each pyramid level and format."""
+    return [''] + [f'{size}.{fmt}' for size in imaging.PYRAMID_SIZES for fmt in imaging.FORMATS]
+
+
+def _shared_key(key):
+    return 'files:thumb:' + ':'.join(key)
+
+
+def _read(field_file):
+    try:
+        with field_file.open('rb') as f:
+            return f.read()
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def read_path(name):
+    """Loader for callers that only have the storage name (signed URLs)."""
+    try:
+        with default_storage.open(name, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def get(key, load):
+    """
+    Cached bytes for key, a (file id, updated_at) pair. On a miss in both tiers
+    load() reads them (None when there's nothing to read, which isn't cached).
+    """
+    global _shared_hits, _shared_misses
+    local = get_local()
+    data = local.get(key)
+    if data is not None:
+        return data
+
+    shared = _shared()
+    if shared is not None:
+        data = shared.get(_shared_key(key))
+        if data is not None:
+            _shared_hits += 1
+            local.put(key, data)
+            return data
+        _shared_misses += 1
+
+    data = load()
+    if data is None:
+        return None
+    local.put(key, data)
+    if shared is not None and len(data) <= local.max_entry_bytes:
+        shared.set(_shared_key(key), data, timeout=SHARED_TIMEOUT)
+    return data
+
+
+def get_thumbnail(file_obj, field_file=None, label=''):
+    """
+    The File's thumbnail bytes (or those of one of its variants, given its file and label),
+    None if there's none or it went missing from disk.
+    """
+    field_file = file_obj.thumbnail if field_file is None else field_file
+    if not field_file:
+        return None
+    return get(cache_key(file_obj, label), lambda: _read(field_file))
+
+
+def invalidate(file_obj, updated_at=None):
+    """
+    Drop a File's cached thumbnails: all of them locally, and in the shared tier
+    every variant's key for updated_at (default: the File's current one).
+    """
+    get_local().invalidate(str(file_obj.pk))
+    shared = _shared()
+    updated_at = updated_at or file_obj.updated_at
+    if shared is not None and updated_at:
+        shared.delete_many([_shared_key(cache_key(file_obj, label, updated_at)) for label in labels()])
+
+
+def stats():
+    data = {'local': get_local().stats()}
+    if _shared() is not None:
+        data['shared'] = {'hits': _shared_hits, 'misses': _shared_misses}
+    return data
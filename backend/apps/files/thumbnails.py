@@ -0,0 +1,332 @@
+import multiprocessing
+import os
+import re
+import threading
+from collections import namedtuple
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from .models import File, PhotoMetadata, ThumbnailVariant
+from . import imaging, tasks
+
+# Background thumbnailing.
+# Saving a photo only marks it PENDING; once the transaction commits, decoding
+# and resizing run on a pool of worker processes (one per core by default),
+# so uploads return as soon as the bytes are stored and a burst of photos is
+# spread over every core instead of paying the decode one by one in post_save.
+# Results are written back by the files task pool (tasks.py), which also keeps
+# the pool's result thread free for the next one.
+#
+# Each photo gets a pyramid (imaging.PYRAMID_SIZES) in JPEG plus WebP/AVIF when
+# Pillow can write them. The 320px JPEG is File.thumbnail, the rest are
+# ThumbnailVariant rows, picked per request by the download `variant`.
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def new_pool(workers=None):
+    # spawn, not fork: forking a threaded server process can copy held locks
+    return ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=multiprocessing.get_context('spawn'))
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = new_pool(getattr(settings, 'THUMBNAIL_WORKERS', None))
+    return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def needs_thumbnail(file_obj, replaced=False):
+    """A photo without a thumbnail, or whose content was just replaced (overwrite, restore)."""
+    return bool(file_obj.file) and file_obj.file_type == 'PHOTO' and (replaced or not file_obj.thumbnail)
+
+
+def render_source(field_file):
+    # Workers open local files themselves; other storages have to ship the bytes
+    try:
+        return field_file.path
+    except NotImplementedError:
+        with field_file.open('rb') as f:
+            return f.read()
+
+
+def thumbnail_name(file_name, size=None, fmt='jpeg'):
+    base, _ = os.path.splitext(os.path.basename(file_name))
+    if size is None:
+        return f"{base}_thumb.jpg"
+    return f"{base}_thumb_{size}.{imaging.FORMATS[fmt][2]}"
+
+
+def mark_pending(file_obj):
+    # A queryset update: no auto_now bump, no signals re-entering
+    File.objects.filter(pk=file_obj.pk).update(thumbnail_status='PENDING')
+    file_obj.thumbnail_status = 'PENDING'
+
+
+def queue(file_obj):
+    """
+    Render the File's thumbnail in the background (inline with FILES_TASKS_EAGER).
+    Call after the File is committed, the worker result looks it up again by id.
+    """
+    file_id, file_name = file_obj.pk, file_obj.file.name
+    try:
+        source = render_source(file_obj.file)
+    except (FileNotFoundError, ValueError) as e:
+        mark_failed(file_id, e)
+        return
+    if getattr(settings, 'FILES_TASKS_EAGER', False):
+        try:
+            rendered, metadata = imaging.render_photo(source)
+        except Exception as e:
+            mark_failed(file_id, e)
+            return
+        store(file_id, file_name, rendered, metadata)
+        return
+
+    try:
+        future = get_pool().submit(imaging.render_photo, source)
+    except BrokenProcessPool:
+        # A worker died (OOM on a huge image...), start a fresh pool
+        _reset_pool()
+        future = get_pool().submit(imaging.render_photo, source)
+    future.add_done_callback(lambda f: tasks.submit(_finish, file_id, file_name, f))
+
+
+def _finish(file_id, file_name, future):
+    try:
+        rendered, metadata = future.result()
+    except Exception as e:
+        mark_failed(file_id, e)
+        return
+    store(file_id, file_name, rendered, metadata)
+
+
+def store(file_id, file_name, rendered, metadata=None):
+    """
+    Save a rendered pyramid ({(size, format): bytes}) onto the File, replacing any
+    previous one, with the photo's metadata when given. A File deleted meanwhile is skipped.
+    """
+    file_obj = File.objects.filter(pk=file_id).first()
+    if file_obj is None:
+        return
+    if file_obj.file.name != file_name:
+        queue(file_obj) # Content replaced while rendering, this one is stale
+        return
+
+    rendered = dict(rendered)
+    base = rendered.pop((imaging.BASE_SIZE, 'jpeg'))
+    old_thumbnail = file_obj.thumbnail.name if file_obj.thumbnail else None
+    with transaction.atomic():
+        # Their files go in the post_delete signal
+        file_obj.thumbnail_variants.all().delete()
+        # Saved before the old one is removed, so the new file never reuses its name (path ETags, signed links)
+        file_obj.thumbnail.save(thumbnail_name(file_name), ContentFile(base), save=False)
+        variants = []
+        for (size, fmt), data in sorted(rendered.items()):
+            variant = ThumbnailVariant(file_item=file_obj, size=size, format=fmt)
+            variant.file.save(thumbnail_name(file_name, size, fmt), ContentFile(data), save=False)
+            variants.append(variant)
+        ThumbnailVariant.objects.bulk_create(variants)
+        if metadata is not None:
+            store_metadata(file_obj, metadata)
+        file_obj.thumbnail_status = 'READY'
+        # updated_at too: it keys the thumbnail cache, every worker must see a new key
+        file_obj.save(update_fields=['thumbnail', 'thumbnail_status', 'updated_at'])
+    if old_thumbnail:
+        file_obj.thumbnail.storage.delete(old_thumbnail)
+
+
+def parse_taken_at(value):
+    """Aware datetime from EXIF 'YYYY:MM:DD HH:MM:SS[+HH:MM]'; no offset means the server's time zone."""
+    if not value:
+        return None
+    try:
+        taken = datetime.strptime(value[:19], '%Y:%m:%d %H:%M:%S')
+    except ValueError:
+        return None # '0000:00:00 00:00:00' and other camera defaults
+    offset = value[19:]
+    if offset:
+        try:
+            return taken.replace(tzinfo=datetime.strptime(offset, '%z').tzinfo)
+        except ValueError:
+            pass
+    return timezone.make_aware(taken)
+
+
+def store_metadata(file_obj, metadata):
+    PhotoMetadata.objects.update_or_create(file_item=file_obj, defaults={
+        'taken_at': parse_taken_at(metadata.get('taken_at')),
+        'width': metadata.get('width'),
+        'height': metadata.get('height'),
+        'orientation': metadata.get('orientation') or 1,
+        'camera_make': (metadata.get('camera_make') or '')[:100] or None,
+        'camera_model': (metadata.get('camera_model') or '')[:100] or None,
+        'latitude': metadata.get('latitude'),
+        'longitude': metadata.get('longitude'),
+        'altitude': metadata.get('altitude'),
+    })
+
+
+def mark_failed(file_id, error):
+    print(f"Error generating thumbnail for {file_id}: {error}")
+    File.objects.filter(pk=file_id).update(thumbnail_status='FAILED')
+
+
+# --- Picking a variant for a download ---
+
+Pick = namedtuple('Pick', ['file', 'label', 'extension', 'content_type', 'negotiated'])
+
+# variant=thumb-<size>[.<format>], e.g. thumb-128, thumb-1280.webp
+VARIANT_RE = re.compile(r'^thumb-(\d{1,5})(?:\.(jpeg|jpg|webp|avif))?$')
+
+
+def parse_variant(variant):
+    """(size, format or None) for a pyramid variant, None for anything else."""
+    match = VARIANT_RE.match(variant or '')
+    if not match:
+        return None
+    fmt = match.group(2)
+    return int(match.group(1)), 'jpeg' if fmt == 'jpg' else fmt
+
+
+def _accepts(accept, content_type):
+    for item in (accept or '').split(','):
+        parts = [p.strip() for p in item.split(';')]
+        if parts[0].lower() == content_type:
+            return not any(p.replace(' ', '') in ('q=0', 'q=0.0') for p in parts[1:])
+    return False
+
+
+def pick(file_obj, variant, accept=None):
+    """
+    What to send for a thumbnail `variant`, or None when the File has no thumbnail.
+    'thumbnail' is always File.thumbnail. For thumb-<size> the smallest level at
+    least that big is used (the largest one past the top); without an explicit
+    format the best one the Accept header allows, JPEG for everyone else.
+    Levels or formats that weren't generated fall back to JPEG, then to File.thumbnail.
+    """
+    if not file_obj.thumbnail:
+        return None
+    base = Pick(file_obj.thumbnail, '', 'jpg', 'image/jpeg', False)
+    parsed = parse_variant(variant)
+    if parsed is None:
+        return base
+    wanted, fmt = parsed
+
+    levels = {imaging.BASE_SIZE: {'jpeg': None}}
+    for v in file_obj.thumbnail_variants.all():
+        levels.setdefault(v.size, {})[v.format] = v
+    bigger = [size for size in levels if size >= wanted]
+    size = min(bigger) if bigger else max(levels)
+
+    negotiated = fmt is None
+    if negotiated:
+        fmt = next((f for f in ('avif', 'webp') if f in levels[size] and _accepts(accept, imaging.FORMATS[f][3])), 'jpeg')
+    chosen = levels[size].get(fmt) or levels[size].get('jpeg')
+    if chosen is None:
+        return base._replace(negotiated=negotiated)
+    _, _, extension, content_type = imaging.FORMATS[chosen.format]
+    return Pick(chosen.file, f'{size}.{chosen.format}', extension, content_type, negotiated)
+
+
+# --- Backfill ---
+# Photos from before thumbnailing (import_files, integrations) or before a
+# pyramid level/format existed. Walked in primary-key order so a run can stop
+# anywhere and resume after the last finished batch (backfill_thumbnails).
+
+def backfill_queryset(variant=None, regenerate=False, metadata=False):
+    """
+    Photos to (re)process: all of them with regenerate, those without PhotoMetadata
+    with metadata, else those lacking File.thumbnail or, given a variant
+    (thumb-<size>[.<format>]), lacking that level/format.
+    Raises ValueError for a variant the pyramid doesn't produce.
+    """
+    photos = File.objects.filter(file_type='PHOTO').exclude(file='').exclude(file__isnull=True)
+    if regenerate:
+        return photos
+    if metadata:
+        return photos.filter(photo_metadata__isnull=True)
+    parsed = parse_variant(variant) if variant else None
+    if variant and parsed is None:
+        raise ValueError(f"Not a thumbnail variant: {variant!r}")
+    size, fmt = parsed or (imaging.BASE_SIZE, 'jpeg')
+    fmt = fmt or 'jpeg'
+    if size not in imaging.PYRAMID_SIZES or fmt not in imaging.supported_formats():
+        raise ValueError(f"The pyramid has no {size}px {fmt}: sizes {imaging.PYRAMID_SIZES}, formats {imaging.supported_formats()}")
+    missing_thumbnail = Q(thumbnail='') | Q(thumbnail__isnull=True)
+    if (size, fmt) == (imaging.BASE_SIZE, 'jpeg'):
+        return photos.filter(missing_thumbnail)
+    has_variant = ThumbnailVariant.objects.filter(file_item=OuterRef('pk'), size=size, format=fmt)
+    return photos.filter(missing_thumbnail | ~Exists(has_variant))
+
+
+def backfill(queryset, workers=None, batch_size=200, after=None, metadata_only=False):
+    """
+    Render every File of queryset after primary key `after` on a process pool,
+    a batch at a time, or with metadata_only just read their EXIF (no decode).
+    Yields {'last_pk', 'rendered', 'failed'} as each batch is fully stored:
+    everything up to last_pk is done, the resume point.
+    """
+    task = imaging.read_photo_metadata if metadata_only else imaging.render_photo
+    pool = new_pool(workers)
+    try:
+        while True:
+            batch = queryset.order_by('pk')
+            if after is not None:
+                batch = batch.filter(pk__gt=after)
+            batch = list(batch.only('id', 'file')[:batch_size])
+            if not batch:
+                return
+            rendered = failed = 0
+            futures = {}
+            for file_obj in batch:
+                try:
+                    futures[pool.submit(task, render_source(file_obj.file))] = file_obj
+                except (FileNotFoundError, ValueError) as e:
+                    _backfill_failed(file_obj, e, metadata_only)
+                    failed += 1
+            broken = False
+            for future in as_completed(futures):
+                file_obj = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # A worker killed mid-image (OOM) takes the pool and the rest of the batch with it
+                    broken = broken or isinstance(e, BrokenProcessPool)
+                    _backfill_failed(file_obj, e, metadata_only)
+                    failed += 1
+                    continue
+                if metadata_only:
+                    store_metadata(file_obj, result)
+                else:
+                    store(file_obj.pk, file_obj.file.name, *result)
+                rendered += 1
+            if broken:
+                pool.shutdown(wait=False)
+                pool = new_pool(workers)
+            after = batch[-1].pk
+            yield {'last_pk': after, 'rendered': rendered, 'failed': failed}
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _backfill_failed(file_obj, error, metadata_only):
+    if metadata_only:
+        print(f"Error reading metadata of {file_obj.pk}: {error}") # Its thumbnail may well be fine
+    else:
+        mark_failed(file_obj.pk, error)
@@ -1,15 +1,35 @@
+from django.conf import settings
 from django.urls import path
-from .views import FileListCreateView, FileDetailView, FileDownloadView, FileStatsView, StorageStatsView, ChunkedUploadInitView, ChunkedUploadChunkView, ChunkedUploadCompleteView
+from .views import FileListCreateView, FileDetailView, FileDownloadView, FileVersionDownloadView, FileVersionRestoreView, ArchiveDownloadView, SignedDownloadView, ThumbnailBatchView, FileStatsView, StorageStatsView, ScratchUsageView, ThumbnailCacheStatsView, ChunkedUploadInitView, ChunkedUploadChunkView, ChunkedUploadStatusView, ChunkedUploadCompleteView
+
+# Under ASGI (uvicorn) the long-lived views can run async, see files/async_views.py
+if getattr(settings, 'FILES_ASYNC_VIEWS', False):
+    from .async_views import AsyncFileDownloadView, AsyncChunkedUploadChunkView, AsyncChunkedUploadStatusView
+    download_view = AsyncFileDownloadView.as_view()
+    chunk_view = AsyncChunkedUploadChunkView.as_view()
+    status_view = AsyncChunkedUploadStatusView.as_view()
+else:
+    download_view = FileDownloadView.as_view()
+    chunk_view = ChunkedUploadChunkView.as_view()
+    status_view = ChunkedUploadStatusView.as_view()
 
 urlpatterns = [
     path('', FileListCreateView.as_view(), name='file-list-create'),
     path('<uuid:pk>/', FileDetailView.as_view(), name='file-detail'),
-    path('<uuid:pk>/download/', FileDownloadView.as_view(), name='file-download'),
+    path('<uuid:pk>/download/', download_view, name='file-download'),
+    path('<uuid:pk>/versions/<uuid:version_id>/download/', FileVersionDownloadView.as_view(), name='file-version-download'),
+    path('<uuid:pk>/versions/<uuid:version_id>/restore/', FileVersionRestoreView.as_view(), name='file-version-restore'),
+    path('signed/<str:token>/', SignedDownloadView.as_view(), name='file-signed-download'),
+    path('thumbnails/batch/', ThumbnailBatchView.as_view(), name='thumbnail-batch'),
+    path('archive/', ArchiveDownloadView.as_view(), name='file-archive'),
     path('stats/', FileStatsView.as_view(), name='file-stats'),
     path('storage/stats/', StorageStatsView.as_view(), name='storage-stats'),
+    path('storage/scratch/', ScratchUsageView.as_view(), name='storage-scratch'),
+    path('thumbnails/cache/', ThumbnailCacheStatsView.as_view(), name='thumbnail-cache-stats'),
     
     # Chunked Uploads
     path('upload/init/', ChunkedUploadInitView.as_view(), name='upload-init'),
-    path('upload/chunk/<uuid:upload_id>/', ChunkedUploadChunkView.as_view(), name='upload-chunk'),
+    path('upload/chunk/<uuid:upload_id>/', chunk_view, name='upload-chunk'),
+    path('upload/status/<uuid:upload_id>/', status_view, name='upload-status'),
     path('upload/complete/<uuid:upload_id>/', ChunkedUploadCompleteView.as_view(), name='upload-complete'),
 ]
@@ -33,3 +33,49 @@ def get_storage_stats(path="/data"):
             "free_gb": 0,
             "used_percent": 0
         }
+
+
+# Magic numbers for the types we care about (photos, videos, documents).
+# Ambiguous containers like ZIP are left out on purpose, .docx/.xlsx are ZIPs
+# and the file name says more about them than the bytes do.
+MAGIC_NUMBERS = [
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (8, b'WEBP', 'image/webp'),
+    (4, b'ftypheic', 'image/heic'),
+    (4, b'ftypheix', 'image/heic'),
+    (4, b'ftypmif1', 'image/heif'),
+    (4, b'ftypavif', 'image/avif'),
+    (4, b'ftypqt', 'video/quicktime'),
+    (4, b'ftyp', 'video/mp4'), # after the more specific ftyp brands
+    (0, b'\x1aE\xdf\xa3', 'video/webm'),
+    (0, b'II*\x00', 'image/tiff'),
+    (0, b'MM\x00*', 'image/tiff'),
+    (0, b'%PDF-', 'application/pdf'),
+]
+
+def sniff_mime_type(head):
+    """
+    Guess a MIME type from the first bytes of a file.
+    Returns None when nothing matches, callers fall back to the file name.
+    """
+    for offset, magic, mime_type in MAGIC_NUMBERS:
+        if head[offset:offset + len(magic)] == magic:
+            return mime_type
+    return None
+
+
+# Formats that shrink well under gzip/zstd. Everything else (JPEG, MP4, PDF,
+# .docx/.xlsx which are ZIPs) is already compressed.
+COMPRESSIBLE_TYPES = {
+    'application/json', 'application/xml', 'application/javascript', 'application/sql',
+    'application/x-yaml', 'application/rtf', 'application/x-ndjson', 'application/msword',
+    'application/vnd.ms-excel', 'image/svg+xml', 'image/bmp',
+}
+
+
+def is_compressible_mime(mime_type):
+    mime_type = (mime_type or '').split(';')[0].strip().lower()
+    return mime_type.startswith('text/') or mime_type in COMPRESSIBLE_TYPES
@@ -0,0 +1,129 @@
+import os
+import shutil
+from django.core.files.storage import default_storage
+from .models import FileVersion
+from . import blobs, delta
+
+# Linux FICLONE ioctl: copy-on-write clone on btrfs/xfs, no data is copied
+FICLONE = 0x40049409
+
+
+def next_version_number(file_obj):
+    last_version = file_obj.versions.first() # Meta ordering is -version_number
+    return (last_version.version_number + 1) if last_version else 1
+
+
+def _reflink(src, dest):
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError("reflink not supported on this platform")
+    with open(src, 'rb') as s, open(dest, 'xb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(dest)
+            raise
+
+
+def _link_or_copy(src, dest):
+    """Cheapest way to make dest have src's content: hardlink, then reflink, then a streamed copy."""
+    try:
+        os.link(src, dest)
+        return
+    except FileExistsError:
+        raise
+    except OSError:
+        pass # Different volume or no hardlink support
+    try:
+        _reflink(src, dest)
+        return
+    except FileExistsError:
+        raise
+    except OSError:
+        pass
+    with open(src, 'rb') as s, open(dest, 'xb') as d:
+        shutil.copyfileobj(s, d, 1024 * 1024)
+
+
+def archive_current(file_obj):
+    """
+    Snapshot a File's current content as a new FileVersion before it gets overwritten.
+    Constant time: a blob reference hand-over, or a hardlink/reflink for legacy files.
+    Returns the FileVersion, or None if there was nothing to archive.
+    """
+    # Check if physical file exists before archiving
+    if not file_obj.file:
+        return None
+
+    fv = FileVersion(
+        file_item=file_obj,
+        version_number=next_version_number(file_obj),
+        size=file_obj.size,
+        sha256=file_obj.sha256
+    )
+
+    if file_obj.blob_id:
+        # Blob-backed: the version takes over the File's blob reference, no bytes move.
+        # The caller points the File at its new blob without releasing this one.
+        fv.blob_id = file_obj.blob_id
+        fv.file.name = file_obj.file.name
+        fv.save()
+        # manage.py compact_versions later re-stores it as shared delta chunks, once the File has moved on
+        return fv
+
+    # Legacy file outside the blob store: link it into the version slot
+    storage = file_obj.file.storage
+    field = fv.file.field
+    name = field.generate_filename(fv, file_obj.name)
+    try:
+        src = storage.path(file_obj.file.name)
+    except NotImplementedError:
+        # Remote storage, stream it across (chunked, never the whole file in RAM)
+        with file_obj.file.open('rb') as f:
+            fv.file.save(file_obj.name, f, save=False)
+    else:
+        while True:
+            name = storage.get_available_name(name, max_length=field.max_length)
+            dest = storage.path(name)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            try:
+                _link_or_copy(src, dest)
+            except FileExistsError:
+                continue # Lost a race for the name, pick another
+            break
+        fv.file.name = name
+    fv.save()
+    return fv
+
+
+def drop_replaced(name):
+    """
+    Delete a legacy File's old physical file once the File points at new content.
+    The archived FileVersion has its own link to it, so the data survives.
+    """
+    if name and default_storage.exists(name):
+        default_storage.delete(name)
+
+
+def restore(file_obj, version):
+    """
+    Make an old version the File's current content again.
+    The current content is archived first, so a restore can itself be undone.
+    """
+    blob = delta.materialize(version)
+    replaced_name = None
+    try:
+        if archive_current(file_obj) and not file_obj.blob_id:
+            replaced_name = file_obj.file.name
+        file_obj.blob = blob
+        file_obj.file.name = blob.file.name
+        file_obj.size = version.size
+        file_obj.sha256 = blob.sha256
+        file_obj.save()
+    except Exception:
+        blobs.release(blob.pk)
+        raise
+    drop_replaced(replaced_name)
+    return file_obj
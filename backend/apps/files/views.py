@@ -4,19 +4,38 @@ from rest_framework import generics, permissions, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.parsers import MultiPartParser, FormParser
-from rest_framework.exceptions import ValidationError
-from django.http import FileResponse, Http404
+from rest_framework.exceptions import ValidationError, Throttled
+from rest_framework.negotiation import BaseContentNegotiation
+from django.http import Http404, HttpResponse, HttpResponseForbidden, StreamingHttpResponse
+from django.views import View
+from django.core import signing
+from django.core.files.storage import default_storage
+from django.utils.http import content_disposition_header
+from django.utils.cache import patch_vary_headers
 from django.shortcuts import get_object_or_404
-from django.db.models import Sum, Count
-from .models import File
+from django.db.models import F, Sum, Count
+from .models import File, FileVersion
 from .serializers import FileSerializer
+from .hashing import digest_stream
+from .uploadhandlers import StreamingBlobUploadHandler, StreamedUploadedFile
+from . import quota, blobs, versions, delta, reaper, downloads, archives, signed, precompress, bandwidth, thumbcache, thumbnails
+import io
 import mimetypes
+import os
+import shutil
+import time
+import uuid
 
 class FileListCreateView(generics.ListCreateAPIView):
     serializer_class = FileSerializer
     permission_classes = [permissions.IsAuthenticated]
     parser_classes = [MultiPartParser, FormParser]
 
+    def initialize_request(self, request, *args, **kwargs):
+        # Stream uploads straight into MEDIA_ROOT (hashing + sniffing as they arrive) instead of spooling to /tmp
+        request.upload_handlers = [StreamingBlobUploadHandler(request)]
+        return super().initialize_request(request, *args, **kwargs)
+
     def get_queryset(self): # Modified for Admin Access
         user = self.request.user
         
@@ -25,6 +44,11 @@ class FileListCreateView(generics.ListCreateAPIView):
             queryset = File.objects.all().order_by('-is_folder', '-created_at')
         else:
             queryset = File.objects.filter(user=user).order_by('-is_folder', '-created_at')
+        queryset = queryset.select_related('photo_metadata')
+
+        # Photo timeline: newest capture first, photos not yet read (or without a date) last
+        if self.request.query_params.get('sort') == 'taken':
+            queryset = queryset.order_by(F('photo_metadata__taken_at').desc(nulls_last=True), '-created_at')
         
         # Filter by Type
         file_type = self.request.query_params.get('type')
@@ -76,14 +100,11 @@ class FileListCreateView(generics.ListCreateAPIView):
         name = uploaded_file.name
         size = uploaded_file.size
 
-        # Check Quota
-        quota_bytes = user.storage_quota_gb * 1024 * 1024 * 1024
-        current_usage = File.objects.filter(user=user).aggregate(total=Sum('size'))['total'] or 0
-        
-        if current_usage + size > quota_bytes:
-            raise ValidationError({"detail": f"Storage quota exceeded."})
+        # Check Quota (single ledger row, the reservation is swapped for the real charge on save)
+        quota.reserve(user, size)
 
-        mime_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        # Sniffed from the bytes while streaming when possible, otherwise guessed from the name
+        mime_type = getattr(uploaded_file, 'sniffed_type', None) or mimetypes.guess_type(name)[0] or 'application/octet-stream'
         
         # Auto-Categorization Logic
         file_type = 'FILE'
@@ -109,10 +130,11 @@ class FileListCreateView(generics.ListCreateAPIView):
         if metadata is None:
             metadata = {}
 
+        # Content digest (hash tree, same as chunked uploads) decides which blob this is
+        # (already computed by StreamingBlobUploadHandler, otherwise one pass over the spooled upload)
+        digest = getattr(uploaded_file, 'sha256', None) or digest_stream(uploaded_file.chunks())
+
         # Check for existing file collision
-        from .models import FileVersion
-        from django.core.files.base import ContentFile
-        
         parent_uuid = parent_id if parent_id and parent_id != 'root' else None
         
         # Only check collision for FILES, not folders (folders allow duplicates? or handle separately. Logic above handles folders)
@@ -120,46 +142,51 @@ class FileListCreateView(generics.ListCreateAPIView):
         
         existing_file = File.objects.filter(user=user, parent_id=parent_uuid, name=name, is_folder=False).first()
         
+        replaced_name = None
         if existing_file:
              # --- VERSIONING LOGIC ---
              try:
-                 # Check if physical file exists before archiving
-                 if existing_file.file:
-                     # Calculate next version number
-                     last_version = existing_file.versions.first() # Meta ordering is -version_number
-                     next_version_num = (last_version.version_number + 1) if last_version else 1
-                     
-                     # Create Archive
-                     # We read the file content to save a copy in versions storage
-                     # Optim usage: If storage supports copy, use that. But generic approach: read/write.
-                     with existing_file.file.open('rb') as f:
-                        content = f.read()
-                        fv = FileVersion(
-                            file_item=existing_file,
-                            version_number=next_version_num,
-                            size=existing_file.size
-                        )
-                        # Save content to new path (upload_to handles path generation)
-                        # We use existing name, path gen will prefix with 'versions/...'
-                        fv.file.save(existing_file.name, ContentFile(content))
-                        fv.save()
+                 # Constant time, no bytes pass through here (blob hand-over or hardlink)
+                 if versions.archive_current(existing_file) and not existing_file.blob_id:
+                     replaced_name = existing_file.file.name
              except Exception as e:
                  print(f"Error creating version archive: {e}")
                  # Proceed with update anyway? Yes, improved UX over failure.
+                 # Nothing took over the old blob reference, so drop it
+                 if existing_file.blob_id:
+                     blobs.release(existing_file.blob_id)
             
              # Set instance to trigger UPDATE instead of CREATE
              serializer.instance = existing_file
 
-        serializer.save(
-            user=user,
-            name=name,
-            size=size,
-            mime_type=mime_type,
-            file_type=file_type,
-            category=category,
-            metadata=metadata,
-            parent_id=parent_id if parent_id and parent_id != 'root' else None
-        )
+        try:
+            # Only writes bytes if nobody has stored this content before
+            if isinstance(uploaded_file, StreamedUploadedFile):
+                # Already on the right volume: renamed into the blob store, or unlinked if it's a duplicate
+                blob = blobs.ingest_path(uploaded_file.temporary_file_path(), digest, size)
+            else:
+                blob = blobs.ingest_upload(uploaded_file, digest)
+            try:
+                serializer.save(
+                    user=user,
+                    name=name,
+                    size=size,
+                    mime_type=mime_type,
+                    sha256=digest,
+                    blob=blob,
+                    file=blob.file.name,
+                    file_type=file_type,
+                    category=category,
+                    metadata=metadata,
+                    parent_id=parent_uuid
+                )
+            except Exception:
+                blobs.release(blob.pk)
+                raise
+            # Legacy file was linked into the version slot, its old path is no longer used
+            versions.drop_replaced(replaced_name)
+        finally:
+            quota.release(user.pk, size)
 
 class FileDetailView(generics.RetrieveUpdateDestroyAPIView):
     serializer_class = FileSerializer
@@ -168,35 +195,253 @@ class FileDetailView(generics.RetrieveUpdateDestroyAPIView):
     def get_queryset(self):
         return File.objects.filter(user=self.request.user)
 
+class DownloadContentNegotiation(BaseContentNegotiation):
+    """
+    Downloads answer with file bytes, not a rendered payload: DRF must not 406 a
+    client whose Accept lists only image types (thumbnail format negotiation).
+    Errors still render with the first renderer (JSON).
+    """
+
+    def select_parser(self, request, parsers):
+        return parsers[0]
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return renderers[0], renderers[0].media_type
+
+def limit_download(request, response):
+    """Per-user bandwidth and concurrent-stream limits (files/bandwidth.py), 429 when all slots are busy."""
+    try:
+        return bandwidth.limit(response, request.user.pk, bandwidth.get_limits(request.user))
+    except bandwidth.TooManyStreams:
+        raise Throttled(detail="Too many downloads in progress, wait for one to finish.")
+
+def file_download_response(request, file_instance, use_async=False):
+    """
+    Everything FileDownloadView does once the File is looked up; shared with the async view.
+    Raises Http404, or bandwidth.TooManyStreams when the user has no stream slot left.
+    """
+    variant = request.GET.get('variant')
+    file_handle = file_instance.file
+    filename = file_instance.name
+    content_type = None
+    is_thumbnail = False
+    thumb = None
+
+    # 'thumbnail', or a pyramid level/format: thumb-<size>[.<format>] (see files/thumbnails.py)
+    if variant == 'thumbnail' or thumbnails.parse_variant(variant):
+        thumb = thumbnails.pick(file_instance, variant, request.headers.get('Accept'))
+        if thumb is not None:
+            file_handle = thumb.file
+            base, _ = os.path.splitext(filename)
+            filename = f"thumb_{base}_{thumb.label.split('.')[0]}.{thumb.extension}" if thumb.label else f"thumb_{filename}"
+            content_type = thumb.content_type
+            is_thumbnail = True
+        else:
+             # Fallback to original if no thumbnail (or 404? Fallback is safer for UI)
+             pass
+
+    if not file_handle:
+        raise Http404("File not found on server")
+
+    # Revalidation: answer 304 before touching the disk
+    etag = downloads.thumbnail_etag(file_instance, file_handle) if is_thumbnail else downloads.file_etag(file_instance)
+    last_modified = file_instance.updated_at
+
+    # Compressible documents: send the best pre-compressed sidecar the client accepts
+    sidecar = None if is_thumbnail else precompress.negotiate(request, file_instance)
+    if sidecar is not None:
+        file_handle = sidecar.file
+        etag = downloads.encoded_etag(etag, sidecar.encoding)
+    # Thumbnail URLs carrying the current `v` token never change, browsers can keep them for good
+    immutable = is_thumbnail and request.GET.get('v') == downloads.thumbnail_token(file_instance)
+    response = downloads.not_modified(request, etag, last_modified)
+    if response is None:
+        # Open the file for streaming (Range requests only read the bytes asked for, of the sent representation)
+        try:
+            if is_thumbnail:
+                # Hot thumbnails come from memory (files/thumbcache.py), a few KB is cheaper to send than to offload
+                data = thumbcache.get_thumbnail(file_instance, file_handle, thumb.label)
+                if data is None:
+                    raise FileNotFoundError(file_handle.name)
+                response = downloads.serve_file(request, io.BytesIO(data), filename, content_type=content_type,
+                                                etag=etag, last_modified=last_modified, use_async=use_async)
+            else:
+                # Offload mode: nginx streams it from disk, this worker is free again
+                response = downloads.offload_file(file_handle.name, filename, etag=etag, last_modified=last_modified, storage=file_handle.storage)
+            if response is None:
+                # as_attachment=True forces download
+                response = downloads.serve_file(request, file_handle.open('rb'), filename, etag=etag, last_modified=last_modified, use_async=use_async)
+        except (FileNotFoundError, ValueError):
+            # ValueError can happen if field is empty
+            raise Http404("File not found on server")
+
+    if sidecar is not None and response.status_code != status.HTTP_304_NOT_MODIFIED:
+        response['Content-Encoding'] = sidecar.encoding
+    if not is_thumbnail and precompress.should_compress(file_instance):
+        patch_vary_headers(response, ['Accept-Encoding'])
+    if is_thumbnail and thumb.negotiated:
+        patch_vary_headers(response, ['Accept'])
+    downloads.set_validators(response, etag, last_modified, immutable)
+    # Thumbnails are tiny and fetched dozens at a time by the grid, only originals are shaped
+    if is_thumbnail:
+        return response
+    return bandwidth.limit(response, request.user.pk, bandwidth.get_limits(request.user))
+
 class FileDownloadView(generics.RetrieveAPIView):
     permission_classes = [permissions.IsAuthenticated]
+    content_negotiation_class = DownloadContentNegotiation
 
     def get(self, request, pk):
         file_instance = get_object_or_404(File, pk=pk, user=request.user)
-        
-        variant = request.query_params.get('variant')
-        file_handle = file_instance.file
-        filename = file_instance.name
-
-        if variant == 'thumbnail':
-            if file_instance.thumbnail:
-                file_handle = file_instance.thumbnail
-                filename = f"thumb_{filename}"
-            else:
-                 # Fallback to original if no thumbnail (or 404? Fallback is safer for UI)
-                 pass
+        try:
+            return file_download_response(request, file_instance)
+        except bandwidth.TooManyStreams:
+            raise Throttled(detail="Too many downloads in progress, wait for one to finish.")
+
+class FileVersionDownloadView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
 
-        # Open the file for streaming
+    def get(self, request, pk, version_id):
+        version = get_object_or_404(FileVersion.objects.select_related('file_item'), pk=version_id, file_item_id=pk, file_item__user=request.user)
+        filename = f"v{version.version_number}_{version.file_item.name}"
+        etag = downloads.version_etag(version)
+        response = downloads.not_modified(request, etag, version.created_at)
+        if response is not None:
+            return downloads.set_validators(response, etag, version.created_at)
         try:
-            # as_attachment=True forces download
-            if not file_handle:
-                raise FileNotFoundError
-                
-            response = FileResponse(file_handle.open('rb'), as_attachment=True, filename=filename)
-            return response
+            response = None
+            if not version.is_delta:
+                response = downloads.offload_file(version.file.name, filename, etag=etag, last_modified=version.created_at, storage=version.file.storage)
+            if response is None:
+                # Delta versions are seekable too, a range only opens the chunks it covers
+                response = downloads.serve_file(request, delta.open_version(version), filename, etag=etag, last_modified=version.created_at)
+        except (FileNotFoundError, ValueError):
+            raise Http404("File not found on server")
+        return limit_download(request, downloads.set_validators(response, etag, version.created_at))
+
+class SignedDownloadView(View):
+    """
+    Serves pre-signed URLs (see files/signed.py). Deliberately a plain Django view:
+    no DRF authentication, no database, only the HMAC and expiry are checked.
+    """
+
+    def get(self, request, token):
+        try:
+            payload = signed.load_token(token)
+        except signing.BadSignature:
+            return HttpResponseForbidden("Invalid or expired link")
+
+        name = payload['p']
+        etag = downloads.path_etag(name)
+        max_age = max(0, int(payload['e'] - time.time()))
+        response = downloads.not_modified(request, etag)
+        if response is not None:
+            return downloads.set_validators(response, etag, public_max_age=max_age)
+
+        try:
+            response = None
+            if payload['v'] == 'thumbnail' and payload.get('t'):
+                data = thumbcache.get((payload['f'], payload['t']), lambda: thumbcache.read_path(name))
+                if data is None:
+                    raise FileNotFoundError(name)
+                response = downloads.serve_file(request, io.BytesIO(data), payload['n'], etag=etag)
+            else:
+                response = downloads.offload_file(name, payload['n'], etag=etag)
+            if response is None:
+                response = downloads.serve_file(request, default_storage.open(name, 'rb'), payload['n'], etag=etag)
         except (FileNotFoundError, ValueError):
-            # ValueError can happen if field is empty
             raise Http404("File not found on server")
+        downloads.set_validators(response, etag, public_max_age=max_age)
+        if payload['v'] == 'thumbnail':
+            return response
+        # Default-tier limits: per-user overrides would need the User row this view avoids loading
+        try:
+            return bandwidth.limit(response, payload['u'], bandwidth.get_limits())
+        except bandwidth.TooManyStreams:
+            return HttpResponse("Too many downloads in progress, wait for one to finish.", status=429)
+
+class ThumbnailBatchView(APIView):
+    """
+    Many thumbnails in one response, for grid views.
+    GET ?ids=<uuid>,<uuid>... or POST {"ids": [...]}; ?layout=multipart (default) or ?layout=pack.
+    Files without a thumbnail (or not owned by the caller) are left out.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        raw_ids = [i for value in request.query_params.getlist('ids') for i in value.split(',') if i]
+        return self.respond(request, raw_ids)
+
+    def post(self, request):
+        raw_ids = request.data.get('ids') or []
+        if not isinstance(raw_ids, list):
+            raise ValidationError({'ids': "Expected a list of file ids."})
+        return self.respond(request, raw_ids)
+
+    def respond(self, request, raw_ids):
+        max_batch = getattr(settings, 'THUMBNAIL_BATCH_MAX', 500)
+        if not raw_ids:
+            raise ValidationError({'ids': "This field is required."})
+        if len(raw_ids) > max_batch:
+            raise ValidationError({'ids': f"At most {max_batch} ids per request."})
+        try:
+            ids = [uuid.UUID(str(i)) for i in raw_ids]
+        except ValueError:
+            raise ValidationError({'ids': "Invalid file id."})
+
+        # Ownership for the whole batch in one query, then served in the order asked for
+        found = File.objects.filter(user=request.user, pk__in=ids).exclude(thumbnail='').exclude(thumbnail__isnull=True) \
+            .only('id', 'thumbnail', 'updated_at')
+        by_id = {f.pk: f for f in found}
+        files = [by_id[i] for i in dict.fromkeys(ids) if i in by_id]
+
+        if request.query_params.get('layout') == 'pack':
+            response = StreamingHttpResponse(downloads.iter_thumbnail_pack(files), content_type=downloads.PACK_CONTENT_TYPE)
+        else:
+            boundary = uuid.uuid4().hex
+            response = StreamingHttpResponse(downloads.iter_thumbnail_multipart(files, boundary),
+                                             content_type=f'multipart/mixed; boundary={boundary}')
+        response['X-Thumbnail-Count'] = str(len(files))
+        response['Cache-Control'] = 'private, no-store'
+        return response
+
+class ArchiveDownloadView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        """
+        ZIP of a folder (?folder=<uuid>) or a selection (?ids=<uuid>,<uuid>,...), streamed as it is built.
+        """
+        folder_id = request.query_params.get('folder')
+        raw_ids = [i for value in request.query_params.getlist('ids') for i in value.split(',') if i]
+        if not folder_id and not raw_ids:
+            raise ValidationError({'detail': "Pass 'folder' or 'ids'."})
+        try:
+            folder_id = uuid.UUID(folder_id) if folder_id else None
+            ids = [uuid.UUID(i) for i in raw_ids]
+        except ValueError:
+            raise ValidationError({'detail': "Invalid file id."})
+
+        entries = archives.collect_entries(request.user, folder_id=folder_id, ids=ids)
+        if entries is None:
+            raise Http404("Nothing to download")
+
+        if folder_id:
+            filename = f"{File.objects.get(pk=folder_id).name}.zip"
+        else:
+            filename = "files.zip"
+        response = StreamingHttpResponse(archives.stream_zip(entries), content_type='application/zip')
+        response['Content-Disposition'] = content_disposition_header(True, filename)
+        response['Cache-Control'] = 'no-store'
+        return limit_download(request, response)
+
+class FileVersionRestoreView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, pk, version_id):
+        version = get_object_or_404(FileVersion.objects.select_related('file_item'), pk=version_id, file_item_id=pk, file_item__user=request.user)
+        file_obj = versions.restore(version.file_item, version)
+        return Response(FileSerializer(file_obj).data)
 
 class FileStatsView(APIView):
     permission_classes = [permissions.IsAuthenticated]
@@ -238,22 +483,40 @@ class StorageStatsView(APIView):
 
         # User Quota Stats
         user = request.user
-        user_used_bytes = File.objects.filter(user=user).aggregate(total=Sum('size'))['total'] or 0
-        user_quota_bytes = user.storage_quota_gb * 1024 * 1024 * 1024
+        usage = quota.get_usage(user)
+        user_used_bytes = usage.used_bytes
+        user_quota_bytes = quota.quota_bytes(user)
         
         return Response({
             "disk": disk_stats,
             "quota": {
                 "total_gb": user.storage_quota_gb,
                 "used_bytes": user_used_bytes,
-                "remaining_bytes": max(0, user_quota_bytes - user_used_bytes),
+                "reserved_bytes": usage.reserved_bytes,
+                "remaining_bytes": max(0, user_quota_bytes - user_used_bytes - usage.reserved_bytes),
                 "used_percent": round((user_used_bytes / user_quota_bytes) * 100, 2) if user_quota_bytes > 0 else 0
             }
         })
 
+class ScratchUsageView(APIView):
+    """Chunked-upload scratch space, for operators to alert on."""
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response(reaper.scratch_usage())
+
+class ThumbnailCacheStatsView(APIView):
+    """Hit/miss counters of this worker's thumbnail cache (and of its shared tier, when configured)."""
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response(thumbcache.stats())
+
 # --- Chunked Upload Views ---
 from .models import ChunkedUpload
-import os
+from . import chunked, tasks
+from django.db import transaction
+from django.urls import reverse
 
 class ChunkedUploadInitView(APIView):
     permission_classes = [permissions.IsAuthenticated]
@@ -262,23 +525,49 @@ class ChunkedUploadInitView(APIView):
         filename = request.data.get('filename')
         file_size = request.data.get('file_size') # Total size
         mime_type = request.data.get('mime_type')
+        chunk_size = request.data.get('chunk_size') or chunked.get_chunk_size()
         
         if not filename or not file_size:
             raise ValidationError("filename and file_size are required")
-            
-        upload = ChunkedUpload.objects.create(
-            user=request.user,
-            filename=filename,
-            file_size=file_size,
-            mime_type=mime_type,
-            status='INIT'
-        )
-        
-        # Ensure temp dir exists
-        temp_dir = os.path.join(settings.MEDIA_ROOT, 'chunk_uploads', str(upload.upload_id))
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        return Response({'upload_id': upload.upload_id})
+
+        try:
+            file_size = int(file_size)
+            chunk_size = int(chunk_size)
+        except (TypeError, ValueError):
+            raise ValidationError("file_size and chunk_size must be integers")
+
+        if file_size < 0 or chunk_size <= 0:
+            raise ValidationError("file_size and chunk_size must be positive")
+
+        if not chunked.chunk_size_is_aligned(chunk_size):
+            raise ValidationError(f"chunk_size must be a multiple of {chunked.get_block_size()} bytes")
+
+        # Hold the quota now so an upload that can't fit is refused before any bytes are sent
+        quota.reserve(request.user, file_size)
+
+        upload = None
+        try:
+            upload = ChunkedUpload.objects.create(
+                user=request.user,
+                filename=filename,
+                file_size=file_size,
+                chunk_size=chunk_size,
+                mime_type=mime_type,
+                sha256=request.data.get('sha256') or None, # Expected digest, checked on completion
+                status='INIT'
+            )
+
+            # Sparse target file, chunks get written straight into it
+            chunked.preallocate(upload)
+        except Exception:
+            # Disk full, DB error...: no usable session for the reaper to find later, give it all back now
+            if upload is not None:
+                shutil.rmtree(chunked.session_dir(upload.upload_id), ignore_errors=True)
+                upload.delete()
+            quota.release(request.user.pk, file_size)
+            raise
+
+        return Response({'upload_id': upload.upload_id, 'chunk_size': upload.chunk_size})
 
 class ChunkedUploadChunkView(APIView):
     permission_classes = [permissions.IsAuthenticated]
@@ -288,131 +577,99 @@ class ChunkedUploadChunkView(APIView):
         upload = get_object_or_404(ChunkedUpload, upload_id=upload_id, user=request.user)
         
         chunk = request.FILES.get('file')
-        chunk_index = request.data.get('chunk_index') # 0-based index
-        
-        if not chunk or chunk_index is None:
-             raise ValidationError("file and chunk_index are required")
-             
-        # Save chunk
-        temp_dir = os.path.join(settings.MEDIA_ROOT, 'chunk_uploads', str(upload_id))
-        chunk_path = os.path.join(temp_dir, str(chunk_index))
-        
-        with open(chunk_path, 'wb+') as destination:
-            for c in chunk.chunks():
-                destination.write(c)
+        chunk_index = chunked.validate_chunk(upload, chunk, request.data.get('chunk_index')) # 0-based index
+
+        # Hash first, then pwrite the chunk at its byte offset in the preallocated file under the session lock
+        block_digests = chunked.hash_chunk(chunk)
+        chunked.store_chunk(upload_id, chunk_index, chunk, block_digests)
                 
-        return Response({'status': 'received'})
+        return Response({
+            'status': 'received',
+            'chunk_index': chunk_index,
+            'block_sha256': [block_digests[i:i + 32].hex() for i in range(0, len(block_digests), 32)],
+        })
+
+def upload_status_data(upload):
+    data = chunked.manifest(upload)
+    data['completed_file'] = upload.completed_file_id
+    data['error'] = upload.error
+    if upload.status == 'COMPLETED' and upload.completed_file:
+        data['file'] = FileSerializer(upload.completed_file).data
+    return data
+
+class ChunkedUploadStatusView(APIView):
+    """
+    Which chunks have landed, so clients can resume or upload the gaps in parallel.
+    Also the polling endpoint for async completion: ?wait=<seconds> long-polls while PROCESSING,
+    briefly here (it holds a worker), longer in the async view.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, upload_id):
+        upload = get_object_or_404(ChunkedUpload, upload_id=upload_id, user=request.user)
+
+        try:
+            wait = min(float(request.query_params.get('wait', 0)), chunked.MAX_SYNC_LONG_POLL_SECONDS)
+        except ValueError:
+            wait = 0
+        if wait > 0:
+            upload = chunked.wait_while_processing(upload, wait)
+
+        return Response(upload_status_data(upload))
 
 class ChunkedUploadCompleteView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def post(self, request, upload_id):
         upload = get_object_or_404(ChunkedUpload, upload_id=upload_id, user=request.user)
-        
-        # Assemble
-        temp_dir = os.path.join(settings.MEDIA_ROOT, 'chunk_uploads', str(upload_id))
-        if not os.path.exists(temp_dir):
+
+        if upload.status == 'COMPLETED' and upload.completed_file:
+            return Response(FileSerializer(upload.completed_file).data)
+        if upload.status == 'PROCESSING':
+            return self.accepted(upload)
+        if upload.status == 'FAILED':
+            raise ValidationError(upload.error or "Upload failed")
+        
+        if not os.path.exists(chunked.target_path(upload_id)):
             raise ValidationError("Upload session not found or expired")
-            
-        chunks = sorted([int(f) for f in os.listdir(temp_dir)])
-        if not chunks:
-             raise ValidationError("No chunks found")
-             
-        # Create final file
-        from django.core.files.base import ContentFile
-        
-        # We need to reuse the File creation logic (with versioning! and quota!)
-        # So we can fake a request to FileListCreateView or just reuse the logic.
-        # Reusing logic is better.
-        
-        # 1. Assemble to a single temp file
-        final_temp_path = os.path.join(temp_dir, 'final_assembly')
-        with open(final_temp_path, 'wb') as final_file:
-            for i in chunks:
-                chunk_path = os.path.join(temp_dir, str(i))
-                with open(chunk_path, 'rb') as cf:
-                    final_file.write(cf.read())
-        
-        # 2. Check Quota (again)
-        # ... logic reused ...
-        
-        # 3. Create File Object
-        file_obj = None
-        with open(final_temp_path, 'rb') as f:
-             # Create a valid Django File object
-             content = ContentFile(f.read(), name=upload.filename)
-             
-             # Re-use serialization logic to handle versioning/collisions properly?
-             # Or just manual creation.
-             # Let's verify collision
-             
-             # Call helper or inline logic
-             # Inline logic for MVP to ensure it works
-             
-             # Metadata Handling
-             metadata = request.data.get('metadata')
-             if isinstance(metadata, str):
-                 import json
-                 try:
-                     metadata = json.loads(metadata)
-                 except:
-                     metadata = {}
-             
-             file_instance = File(
-                 user=request.user,
-                 name=upload.filename,
-                 size=upload.file_size,
-                 mime_type=upload.mime_type,
-                 metadata=metadata or {}, 
-             )
-             
-             # Categorization logic (re-use?)
-             if upload.mime_type and upload.mime_type.startswith('image/'):
-                 file_instance.file_type = 'PHOTO'
-                 file_instance.category = 'PHOTO'
-             elif upload.mime_type and upload.mime_type.startswith('video/'):
-                 file_instance.file_type = 'VIDEO'
-                 file_instance.category = 'VIDEO'
-                 
-             # Parent ID
-             parent_id = request.data.get('parent_id')
-             if parent_id and parent_id != 'root':
-                 file_instance.parent_id = parent_id
-             
-             # VERSIONING HANDLER
-             existing = File.objects.filter(user=request.user, parent_id=file_instance.parent_id, name=upload.filename, is_folder=False).first()
-             if existing:
-                  from .models import FileVersion
-                  # Archive logic
-                  if existing.file:
-                      last_v = existing.versions.first()
-                      next_v = (last_v.version_number + 1) if last_v else 1
-                      with existing.file.open('rb') as old_f:
-                           fv = FileVersion(
-                               file_item=existing,
-                               version_number=next_v,
-                               size=existing.size
-                           )
-                           fv.file.save(existing.name, ContentFile(old_f.read()))
-                           fv.save()
-                  file_instance = existing # Update existing
-                  file_instance.size = upload.file_size
-                  file_instance.mime_type = upload.mime_type
-                  if metadata:
-                      file_instance.metadata = metadata
-                  
-             
-             # Save main file
-             file_instance.file.save(upload.filename, content)
-             file_instance.save()
-             file_obj = file_instance
-
-        # Cleanup
-        import shutil
-        shutil.rmtree(temp_dir)
-        
-        upload.status = 'COMPLETED'
-        upload.completed_file = file_obj
-        upload.save()
-        
-        return Response(FileSerializer(file_obj).data)
\ No newline at end of file
+
+        missing = chunked.missing_indexes(upload)
+        if missing:
+            return Response(
+                {"detail": "Upload is incomplete", "missing_chunks": chunked.as_ranges(missing)},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # Metadata Handling
+        metadata = request.data.get('metadata')
+        if isinstance(metadata, str):
+            import json
+            try:
+                metadata = json.loads(metadata)
+            except:
+                metadata = {}
+        parent_id = request.data.get('parent_id')
+
+        # INIT -> PROCESSING exactly once, a second concurrent complete just gets the 202
+        if not chunked.begin_processing(upload_id):
+            upload.refresh_from_db()
+            return self.accepted(upload)
+
+        run_async = request.data.get('async') in ('true', True) or request.query_params.get('async') == 'true' \
+            or getattr(settings, 'CHUNK_UPLOAD_ASYNC_FINALIZE', False)
+
+        if run_async:
+            # Hand off once PROCESSING is committed so the worker sees it
+            transaction.on_commit(lambda: tasks.submit(chunked.finalize, upload_id, metadata, parent_id))
+            upload.status = 'PROCESSING'
+            return self.accepted(upload)
+
+        file_obj = chunked.finalize(upload_id, metadata, parent_id)
+        return Response(FileSerializer(file_obj).data)
+
+    def accepted(self, upload):
+        return Response({
+            'upload_id': upload.upload_id,
+            'status': upload.status,
+            'status_url': reverse('upload-status', args=[upload.upload_id]),
+        }, status=status.HTTP_202_ACCEPTED)
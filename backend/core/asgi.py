@@ -14,3 +14,7 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings.dev')
 
 application = get_asgi_application()
+
+# Periodic in-process jobs, only in server processes (not manage.py commands)
+from apps.files import reaper
+reaper.start()
@@ -1,4 +1,5 @@
 from .base import *
+import os
 
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = 'django-insecure-zn3wc67pen#kue2jh$5xjr=o4y8bad8t^@700o6c55_=mu04il'
@@ -24,3 +25,9 @@ MEDIA_ROOT = BASE_DIR / 'media'
 # CORS Settings
 CORS_ALLOW_ALL_ORIGINS = True
 
+
+# Downloads stream from Django (range handling, bandwidth limits) unless FILE_DOWNLOAD_OFFLOAD=x-accel
+# is set to try the nginx path, with the middleware standing in for nginx and serving the file itself
+FILE_DOWNLOAD_OFFLOAD = os.environ.get('FILE_DOWNLOAD_OFFLOAD')
+if FILE_DOWNLOAD_OFFLOAD:
+    MIDDLEWARE = MIDDLEWARE + ['apps.files.middleware.DownloadOffloadMiddleware']
@@ -21,3 +21,26 @@ DATABASES = {
 MEDIA_URL = '/media/'
 MEDIA_ROOT = '/data/'
 
+
+# 'x-accel' behind nginx (needs an internal location at FILE_DOWNLOAD_ACCEL_PREFIX aliased to MEDIA_ROOT),
+# 'x-sendfile' behind Apache/lighttpd, unset to stream from Django
+FILE_DOWNLOAD_OFFLOAD = os.environ.get('FILE_DOWNLOAD_OFFLOAD')
+FILE_DOWNLOAD_ACCEL_PREFIX = os.environ.get('FILE_DOWNLOAD_ACCEL_PREFIX', '/protected-media/')
+
+# Shared by every gunicorn worker
+if os.environ.get('REDIS_URL'):
+    CACHES = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': os.environ['REDIS_URL']}}
+    # Second tier for hot thumbnails (apps/files/thumbcache.py); a database cache would be slower than the disk
+    THUMBNAIL_CACHE_SHARED = 'default'
+else:
+    CACHES = {'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'django_cache'}}
+
+# Serve downloads, chunk uploads and the upload-status long poll from async views (files/async_views.py).
+# Worth it under ASGI: gunicorn -k uvicorn.workers.UvicornWorker core.asgi:application
+FILES_ASYNC_VIEWS = os.environ.get('FILES_ASYNC_VIEWS', '').lower() in ('1', 'true', 'yes')
+
+# Processes rendering thumbnails, per app server worker (default: one per core)
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', 0)) or None
+
+# Per-worker memory for hot thumbnails, in bytes
+THUMBNAIL_CACHE_BYTES = int(os.environ.get('THUMBNAIL_CACHE_BYTES', 64 * 1024 * 1024))
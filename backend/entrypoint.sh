@@ -10,6 +10,7 @@
 # Apply database migrations
 echo "Applying database migrations..."
 python manage.py migrate
+python manage.py createcachetable
 
 # Collect static files
 echo "Collecting static files..."